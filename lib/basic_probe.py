@@ -22,10 +22,14 @@ import json
 import hal
 try:
     from .event_filter import EventFilter
+    from .probe_worker import ProbeWorker
+    from .probe_job import ProbeJob
 except ImportError:
     from lib.event_filter import EventFilter
+    from lib.probe_worker import ProbeWorker
+    from lib.probe_job import ProbeJob
 from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import QProcess, QEvent, QObject, QRegExp, QFile, Qt
+from PyQt5.QtCore import QEvent, QObject, QRegExp, QFile, Qt
 from PyQt5.QtWidgets import QWidget, QLineEdit, QVBoxLayout, QHBoxLayout, QPushButton, QTextEdit
 from PyQt5 import QtGui, uic
 from qtvcp.widgets.widget_baseclass import _HalWidgetBase
@@ -81,9 +85,12 @@ class BasicProbe(QWidget, _HalWidgetBase):
         except Exception as e:
             print(e)
             self.tool_db = None
-        self.proc = None
+        self.worker = ProbeWorker(SUBPROGRAM, self)
+        self.worker.started.connect(self.process_started)
+        self.worker.reply.connect(self.parse_reply)
         self.test_mode = False
         self.help = HelpPage()
+        self.job = ProbeJob(self)
         
         self.probe_settings = []
         self.setMinimumSize(600, 420)
@@ -164,6 +171,7 @@ class BasicProbe(QWidget, _HalWidgetBase):
         self.clear_buttonGroup.buttonClicked.connect(self.clear_results_clicked)
         self.btn_load_probe.pressed.connect(self.load_probe_pressed)
         self.btn_probe_help.pressed.connect(self.probe_help_pressed)
+        self.btn_probe_job.pressed.connect(self.probe_job_pressed)
         self.btn_measure_tool.pressed.connect(self.get_tool_to_measure)
         self.stackedWidget_probe_buttons.setCurrentIndex(0)
         if self.debug_mode == 10:
@@ -216,6 +224,8 @@ class BasicProbe(QWidget, _HalWidgetBase):
         self.HAL_GCOMP_.comp.setprefix('qtbasicprobe')
         self.probe_out = self.HAL_GCOMP_.newpin("probe-out", hal.HAL_BIT, hal.HAL_OUT)
         self.HAL_GCOMP_.comp.setprefix(oldname)
+        # the probe subprogram is started once and kept running
+        self.worker.start()
 
     def _hal_cleanup(self):
         if self.PREFS_:
@@ -223,7 +233,7 @@ class BasicProbe(QWidget, _HalWidgetBase):
             for probe in self.probe_settings:
                 self.PREFS_.putpref(probe.objectName(), probe.text(), str, 'BASIC_PROBE_OPTIONS')
             self.PREFS_.putpref('zero_reference', str(self.ts_zero), str, 'BASIC_PROBE_OPTIONS')
-        if self.proc is not None: self.proc.terminate()
+        self.worker.stop()
 
 # STATUS messages
     def dialog_return(self, w, message):
@@ -271,52 +281,63 @@ class BasicProbe(QWidget, _HalWidgetBase):
 #################
 # process control
 #################
-    def start_process(self):
-        self.proc = QProcess()
-        self.proc.setReadChannel(QProcess.StandardOutput)
-        self.proc.started.connect(self.process_started)
-        self.proc.readyReadStandardOutput.connect(self.read_stdout)
-        self.proc.readyReadStandardError.connect(self.read_stderror)
-        self.proc.finished.connect(self.process_finished)
-        self.proc.start(f'python3 {SUBPROGRAM}')
-
-    def start_probe(self, cmd):
+    def start_probe(self, cmd, parms=None):
+        if parms is None: parms = self.send_dict
         if self.test_mode:
-            string_to_send = cmd + '$' + json.dumps(self.send_dict) + '\n'
-            print(string_to_send)
-            return
-        if self.proc is not None:
+            print(json.dumps({'cmd': cmd, 'parms': parms}))
+            return False
+        if self.worker.busy:
             self.parent.add_status("Probe Routine processor is busy", WARNING)
-            return
+            return False
         if int(self.lineEdit_probe_tool.text()) != STATUS.get_current_tool():
             self.parent.add_status("Probe tool not mounted in spindle", WARNING)
-            return
-        self.start_process()
-        string_to_send = cmd + '$' + json.dumps(self.send_dict) + '\n'
-#        print("String to send ", string_to_send)
+            return False
         STATUS.block_error_polling()
-        self.proc.writeData(bytes(string_to_send, 'utf-8'))
+        if self.worker.send(cmd, parms) is None:
+            STATUS.unblock_error_polling()
+            self.parent.add_status("Probe Routine processor is not running", WARNING)
+            return False
+        return True
 
-    def process_started(self):
-        self.parent.add_status(f"Basic_Probe subprogram started with PID {self.proc.processId()}")
+    # the current parameters are the defaults for every feature of the job
+    def start_job(self, entries, safe_z):
+        self.get_parms()
+        return self.start_probe('run_job', {'parms': self.send_dict, 'entries': entries, 'safe_z': safe_z})
 
-    def read_stdout(self):
-        qba = self.proc.readAllStandardOutput()
-        line = qba.data()
-        self.parse_input(line)
+    def job_status(self, msg, level):
+        self.parent.add_status(msg, level)
 
-    def read_stderror(self):
-        qba = self.proc.readAllStandardError()
-        line = qba.data()
-        self.parse_input(line)
+    def process_started(self, pid):
+        self.parent.add_status(f"Basic_Probe subprogram started with PID {pid}")
 
-    def process_finished(self, exitCode, exitStatus):
-        LOG.debug(f"Probe Process finished - exitCode {exitCode} exitStatus {exitCode}")
-        self.proc = None
-        STATUS.unblock_error_polling()
+    def parse_reply(self, kind, data):
+        if kind == "ERROR INFO":
+            self.parent.add_status(data, WARNING)
+        elif kind == "ERROR":
+            STATUS.unblock_error_polling()
+            self.parent.add_status(data, WARNING)
+        elif kind == "COMPLETE":
+            STATUS.unblock_error_polling()
+            self.show_results(data)
+            self.parent.add_status("Basic Probing routine completed without errors")
+        elif kind == "HISTORY":
+            if 'finish' in data:
+                self.parent.add_status(data, WARNING)
+            else:
+                STATUS.emit('update-machine-log', data, 'TIME')
+                self.parent.add_status("Probe history updated to machine log")
+        elif kind == "RESULT":
+            self.job.add_result(data)
+        elif kind == "JOB":
+            self.parent.add_status(f"Probe job finished {data['done']} of {data['total']} features")
+        elif kind == "DONE":
+            STATUS.unblock_error_polling()
+            self.job.job_finished()
+        elif kind == "LOG":
+            self.parse_log(data)
 
-    def parse_input(self, line):
-        line = line.decode("utf-8")
+    # lines from the subprogram that are not replies, mostly its logging output on stderr
+    def parse_log(self, line):
         if "ERROR INFO" in line:
             text = line.replace("ERROR INFO", "")
             self.parent.add_status(text, WARNING)
@@ -331,19 +352,6 @@ class BasicProbe(QWidget, _HalWidgetBase):
             self.parent.add_status(text)
             if LOG.getEffectiveLevel() < logger.INFO:
                 print(line)
-        elif "COMPLETE" in line:
-            STATUS.unblock_error_polling()
-            return_data = line.rstrip().split('$')
-            data = json.loads(return_data[1])
-            self.show_results(data)
-            self.parent.add_status("Basic Probing routine completed without errors")
-        elif "HISTORY" in line:
-            if 'finish' in line:
-                text = line.replace("HISTORY", "")
-                self.parent.add_status(text, WARNING)
-            else:
-                STATUS.emit('update-machine-log', line, 'TIME')
-                self.parent.add_status("Probe history updated to machine log")
         elif "DEBUG" in line:
             pass
         else:
@@ -362,6 +370,9 @@ class BasicProbe(QWidget, _HalWidgetBase):
 
     def probe_help_pressed(self):
         self.help.show()
+
+    def probe_job_pressed(self):
+        self.job.show()
        
     def probe_btn_clicked(self, button):
         cmd = button.property('probe')
@@ -23,12 +23,32 @@ import linuxcnc
 import struct
 import numpy as np
 
+from collections import deque
 from enum import Enum, unique
 
 SHM_PATH = '/dev/shm/linuxcnc_surface_map'
-MAX_NX = 200
-MAX_NY = 200
-HEADER_SIZE = 44
+# shared memory layout - must match utils/zlevel.py
+MAGIC = b'ZMAP'
+LAYOUT_VERSION = 2
+# the version word is a seqlock counter, odd while the writer is busy
+VERSION = struct.Struct("=I")
+# magic, layout, item size, nx, ny, interpolation mode, xmin, xmax, ymin, ymax
+HEADER = struct.Struct("=4sHHIII4d")
+HEADER_SIZE = VERSION.size + HEADER.size
+DTYPES = {4: np.float32, 8: np.float64}
+INTERP_BILINEAR = 0
+INTERP_BICUBIC = 1
+SEQLOCK_RETRIES = 3
+# Catmull-Rom basis, rows are the coefficients of t^0 .. t^3
+CATMULL_ROM = 0.5 * np.array([[ 0,  2,  0,  0],
+                              [-1,  0,  1,  0],
+                              [ 2, -5,  4, -1],
+                              [-1,  3, -3,  1]], dtype=np.float64)
+# servo loop period in seconds
+DEFAULT_PERIOD = 0.02
+MIN_PERIOD = 0.001
+# number of position samples used for the velocity estimate
+VELOCITY_SAMPLES = 4
 
 @unique
 class State(Enum):
@@ -39,78 +59,193 @@ class State(Enum):
     STOP = 5
 
 
+class Interpolator:
+    # precomputed surface map lookup engine
+    # bilinear cells store the coefficients of z = a + b*dx + c*dy + d*dx*dy
+    # bicubic cells store the 4x4 coefficients of z = sum(C[k,l] * dx^k * dy^l)
+    def __init__(self):
+        self.nx = 0
+        self.ny = 0
+        self.xmin = 0.0
+        self.ymin = 0.0
+        self.inv_x = 0.0
+        self.inv_y = 0.0
+        self.mode = INTERP_BILINEAR
+        self.coeffs = None
+        self.zbuf = np.empty(0, dtype=np.float64)
+        self.cbuf = np.empty(0, dtype=np.float64)
+
+    def reserve(self, nx, ny):
+        # backing buffers only grow, so reloading a map does not allocate
+        if self.zbuf.size < nx * ny:
+            self.zbuf = np.empty(nx * ny, dtype=np.float64)
+        cells = max(nx - 1, 0) * max(ny - 1, 0)
+        if self.cbuf.size < cells * 16:
+            self.cbuf = np.empty(cells * 16, dtype=np.float64)
+        return self.zbuf[:nx * ny].reshape((nx, ny))
+
+    def load(self, nx, ny, xmin, xmax, ymin, ymax, z, mode=INTERP_BILINEAR):
+        if nx < 2 or ny < 2 or xmax == xmin or ymax == ymin:
+            self.coeffs = None
+            return
+        self.nx = nx
+        self.ny = ny
+        self.xmin = xmin
+        self.ymin = ymin
+        self.inv_x = (nx - 1) / (xmax - xmin)
+        self.inv_y = (ny - 1) / (ymax - ymin)
+        self.mode = mode
+        self.reserve(nx, ny)
+        if mode == INTERP_BICUBIC:
+            self.coeffs = self.bicubic_coeffs(nx, ny, z)
+        else:
+            self.coeffs = self.bilinear_coeffs(nx, ny, z)
+
+    def bilinear_coeffs(self, nx, ny, z):
+        z00 = z[:-1, :-1]
+        z10 = z[1:, :-1]
+        z01 = z[:-1, 1:]
+        z11 = z[1:, 1:]
+        coeffs = self.cbuf[:(nx - 1) * (ny - 1) * 4].reshape((nx - 1, ny - 1, 4))
+        coeffs[..., 0] = z00
+        np.subtract(z10, z00, out=coeffs[..., 1])
+        np.subtract(z01, z00, out=coeffs[..., 2])
+        np.add(z11, z00, out=coeffs[..., 3])
+        coeffs[..., 3] -= z10
+        coeffs[..., 3] -= z01
+        return coeffs
+
+    def bicubic_coeffs(self, nx, ny, z):
+        # extend the grid by one linearly extrapolated row/column on each side
+        zp = np.pad(z, 1, mode='reflect', reflect_type='odd')
+        patches = np.lib.stride_tricks.sliding_window_view(zp, (4, 4))
+        coeffs = self.cbuf[:(nx - 1) * (ny - 1) * 16].reshape((nx - 1, ny - 1, 4, 4))
+        np.einsum('ka,ijab,lb->ijkl', CATMULL_ROM, patches, CATMULL_ROM, out=coeffs, optimize=True)
+        return coeffs.reshape((nx - 1, ny - 1, 16))
+
+    def interpolate(self, x, y):
+        if self.coeffs is None: return 0
+        fx = (x - self.xmin) * self.inv_x
+        fy = (y - self.ymin) * self.inv_y
+        xi = int(fx)
+        yi = int(fy)
+        if xi < 0 or yi < 0 or xi >= self.nx - 1 or yi >= self.ny - 1: return 0
+        dx = fx - xi
+        dy = fy - yi
+        if self.mode == INTERP_BICUBIC:
+            c = self.coeffs[xi, yi].tolist()
+            r0 = c[0] + dy*(c[1] + dy*(c[2] + dy*c[3]))
+            r1 = c[4] + dy*(c[5] + dy*(c[6] + dy*c[7]))
+            r2 = c[8] + dy*(c[9] + dy*(c[10] + dy*c[11]))
+            r3 = c[12] + dy*(c[13] + dy*(c[14] + dy*c[15]))
+            return r0 + dx*(r1 + dx*(r2 + dx*r3))
+        a, b, c, d = self.coeffs[xi, yi].tolist()
+        return a + b*dx + (c + d*dx)*dy
+
+    def interpolate_many(self, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        result = np.zeros(np.broadcast(xs, ys).shape, dtype=np.float64)
+        if self.coeffs is None: return result
+        fx = (xs - self.xmin) * self.inv_x
+        fy = (ys - self.ymin) * self.inv_y
+        # truncate toward zero to match the scalar path
+        xi = np.trunc(fx)
+        yi = np.trunc(fy)
+        valid = (xi >= 0) & (yi >= 0) & (xi < self.nx - 1) & (yi < self.ny - 1)
+        valid = np.broadcast_to(valid, result.shape)
+        xi = np.broadcast_to(xi, result.shape)[valid].astype(np.intp)
+        yi = np.broadcast_to(yi, result.shape)[valid].astype(np.intp)
+        dx = np.broadcast_to(fx, result.shape)[valid] - xi
+        dy = np.broadcast_to(fy, result.shape)[valid] - yi
+        result[valid] = self.evaluate(xi, yi, dx, dy)
+        return result
+
+    # values at offsets dx, dy within cells xi, yi
+    def evaluate(self, xi, yi, dx, dy):
+        c = self.coeffs[xi, yi]
+        if self.mode == INTERP_BICUBIC:
+            c = c.reshape((-1, 4, 4))
+            rows = c[:, :, 0] + dy[:, None]*(c[:, :, 1] + dy[:, None]*(c[:, :, 2] + dy[:, None]*c[:, :, 3]))
+            return rows[:, 0] + dx*(rows[:, 1] + dx*(rows[:, 2] + dx*rows[:, 3]))
+        return c[:, 0] + c[:, 1]*dx + (c[:, 2] + c[:, 3]*dx)*dy
+
+
 class SurfaceMap:
     def __init__(self):
         self.shm = None
         self.attached = False
         self.version = -1
-        self.grid = None
+        self.view = None
+        # the servo loop reads from engine while spare is refilled, then they are swapped
+        self.engine = Interpolator()
+        self.spare = Interpolator()
 
     def attach_shm(self):
         try:
             fd = os.open(SHM_PATH, os.O_RDWR)
+            if os.fstat(fd).st_size < HEADER_SIZE:
+                # writer has not sized the segment yet
+                os.close(fd)
+                return False
             shm = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
             os.close(fd)
         except FileNotFoundError:
-            return None
-        return shm
-
-    def check_update(self, shm):
-        version = struct.unpack_from("I", shm, 0)[0]
-        if version == self.version or version % 2:
             return False
-        self.version = version
-        nx = struct.unpack_from("I", shm, 4)[0]
-        ny = struct.unpack_from("I", shm, 8)[0]
-        xmin = struct.unpack_from("d", shm, 12)[0]
-        xmax = struct.unpack_from("d", shm, 20)[0]
-        ymin = struct.unpack_from("d", shm, 28)[0]
-        ymax = struct.unpack_from("d", shm, 36)[0]
-        offset = HEADER_SIZE
-        size = nx * ny * 8
-        z = np.frombuffer(shm[offset:offset+size], dtype=np.float64).copy()
-        z = z.reshape((nx, ny))
-
-        self.grid = {
-            "nx": nx,
-            "ny": ny,
-            "xmin": xmin,
-            "xmax": xmax,
-            "ymin": ymin,
-            "ymax": ymax,
-            "z": z}        
+        self.shm = shm
+        self.attached = True
         return True
 
-    def interpolate(self, x, y):
-        nx = self.grid["nx"]
-        ny = self.grid["ny"]
-        xmin = self.grid["xmin"]
-        xmax = self.grid["xmax"]
-        ymin = self.grid["ymin"]
-        ymax = self.grid["ymax"]
-        z = self.grid["z"]
+    def remap(self):
+        # the writer grew the segment for a larger grid
+        self.view = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+        self.shm = None
+        self.attached = False
+        return self.attach_shm()
 
-        fx = (x - xmin) / (xmax - xmin) * (nx - 1)
-        fy = (y - ymin) / (ymax - ymin) * (ny - 1)
+    def get_view(self, itemsize, count):
+        # zero copy view of the grid area, rebuilt only when the mapping or dtype changes
+        dtype = DTYPES[itemsize]
+        if self.view is None or self.view.dtype != dtype:
+            size = (len(self.shm) - HEADER_SIZE) // itemsize
+            self.view = np.frombuffer(self.shm, dtype=dtype, count=size, offset=HEADER_SIZE)
+        return self.view[:count]
 
-        xi = int(fx)
-        yi = int(fy)
-        
-        if xi < 0 or yi < 0 or xi >= nx-1 or yi >= ny-1: return 0
+    def check_update(self):
+        if not self.attached and not self.attach_shm(): return False
+        for i in range(SEQLOCK_RETRIES):
+            version = VERSION.unpack_from(self.shm, 0)[0]
+            if version == self.version: return False
+            if version % 2: continue
+            magic, layout, itemsize, nx, ny, mode, xmin, xmax, ymin, ymax = HEADER.unpack_from(self.shm, VERSION.size)
+            if VERSION.unpack_from(self.shm, 0)[0] != version: continue
+            if magic != MAGIC or layout != LAYOUT_VERSION or itemsize not in DTYPES:
+                # no valid map published yet
+                self.version = version
+                return False
+            if HEADER_SIZE + nx * ny * itemsize > len(self.shm):
+                if not self.remap(): return False
+                continue
+            z = self.spare.reserve(nx, ny)
+            np.copyto(z, self.get_view(itemsize, nx * ny).reshape((nx, ny)))
+            # discard the copy if the writer started while it was being read
+            if VERSION.unpack_from(self.shm, 0)[0] != version: continue
+            self.spare.load(nx, ny, xmin, xmax, ymin, ymax, z, mode)
+            self.engine, self.spare = self.spare, self.engine
+            self.version = version
+            return True
+        return False
 
-        dx = fx - xi
-        dy = fy - yi
+    def interpolate(self, x, y):
+        return self.engine.interpolate(x, y)
 
-        z00 = z[xi,yi]
-        z10 = z[xi+1,yi]
-        z01 = z[xi,yi+1]
-        z11 = z[xi+1,yi+1]
+    def interpolate_many(self, xs, ys):
+        return self.engine.interpolate_many(xs, ys)
 
-        return (
-            z00*(1-dx)*(1-dy) +
-            z10*dx*(1-dy) +
-            z01*(1-dx)*dy +
-            z11*dx*dy)
 
 class HALComp:
     def __init__(self):
@@ -119,19 +254,107 @@ class HALComp:
         self.h.newpin("clear", hal.HAL_BIT, hal.HAL_OUT)
         self.h.newpin("scale", hal.HAL_S32, hal.HAL_IN)
         self.h.newpin("z-offset", hal.HAL_S32, hal.HAL_OUT)
+        # loop timing - a period of 0 uses the INI setting
+        self.h.newpin("period", hal.HAL_FLOAT, hal.HAL_IN)
+        self.h.newpin("jitter", hal.HAL_FLOAT, hal.HAL_OUT)
+        self.h.newpin("overruns", hal.HAL_U32, hal.HAL_OUT)
+        self.h.newpin("compute-time", hal.HAL_FLOAT, hal.HAL_OUT)
+        # predictive mode - look-ahead time in seconds, 0 disables prediction
+        self.h.newparam("lookahead", hal.HAL_FLOAT, hal.HAL_RW)
+        self.h.newpin("x-vel", hal.HAL_FLOAT, hal.HAL_OUT)
+        self.h.newpin("y-vel", hal.HAL_FLOAT, hal.HAL_OUT)
+        # output filtering - max counts per period and smoothing time constant, 0 disables each
+        self.h.newpin("max-step", hal.HAL_S32, hal.HAL_IN)
+        self.h.newpin("smooth-time", hal.HAL_FLOAT, hal.HAL_IN)
+        self.h.newpin("pending", hal.HAL_S32, hal.HAL_OUT)
         self.h.ready()
         self.map = SurfaceMap()
         self.stat = linuxcnc.stat()
-        self.shm = None
+        self.ini_period = self.get_ini_period()
+        self.deadline = 0.0
+        self.samples = deque(maxlen=VELOCITY_SAMPLES)
+        self.filtered = 0.0
+        self.output = 0.0
+
+    def get_ini_period(self):
+        period = DEFAULT_PERIOD
+        ini_file = os.environ.get('INI_FILE_NAME')
+        if ini_file is None: return period
+        try:
+            value = linuxcnc.ini(ini_file).find('COMPENSATE', 'PERIOD')
+            if value is not None:
+                period = float(value)
+        except Exception as e:
+            print(f"compensate: invalid PERIOD in INI file - {e}")
+        return max(period, MIN_PERIOD)
+
+    def get_period(self):
+        period = self.h['period']
+        if period <= 0:
+            return self.ini_period
+        return max(period, MIN_PERIOD)
+
+    def predict_position(self, x, y, now):
+        self.samples.append((now, x, y))
+        vx = vy = 0.0
+        # current_vel is 0 whenever the planner is stopped, so stale samples are ignored
+        if len(self.samples) > 1 and self.stat.current_vel > 0:
+            t0, x0, y0 = self.samples[0]
+            dt = now - t0
+            if dt > 0:
+                vx = (x - x0) / dt
+                vy = (y - y0) / dt
+        self.h['x-vel'] = vx
+        self.h['y-vel'] = vy
+        lookahead = self.h['lookahead']
+        if lookahead <= 0:
+            return x, y
+        return x + vx * lookahead, y + vy * lookahead
+
+    def update_output(self, target):
+        tau = self.h['smooth-time']
+        if tau > 0:
+            period = self.get_period()
+            self.filtered += (target - self.filtered) * period / (tau + period)
+        else:
+            self.filtered = target
+        step = self.filtered - self.output
+        max_step = self.h['max-step']
+        if max_step > 0:
+            step = max(-max_step, min(max_step, step))
+        self.output += step
+        self.h["z-offset"] = int(self.output)
+        self.h['pending'] = int(target - self.output)
+
+    def reset_output(self):
+        self.filtered = 0.0
+        self.output = 0.0
+        self.h["z-offset"] = 0
+        self.h['pending'] = 0
+
+    def wait_for_deadline(self, start):
+        now = time.monotonic()
+        self.h['compute-time'] = now - start
+        self.deadline += self.get_period()
+        delay = self.deadline - now
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # missed the deadline - count it and restart the schedule from now
+            self.h['overruns'] += 1
+            self.deadline = now
 
     def run(self):
         currentState = State.START
-        self.h["z-offset"] = 0
+        self.reset_output()
+        self.h['overruns'] = 0
+        self.deadline = time.monotonic()
         try:
             while True:
+                start = time.monotonic()
+                self.h['jitter'] = start - self.deadline
                 if currentState == State.START:
-                    self.shm = self.map.attach_shm()
-                    if self.shm is not None:
+                    if self.map.attach_shm():
                         currentState = State.IDLE
 
                 elif currentState == State.IDLE:
@@ -139,29 +362,36 @@ class HALComp:
                         currentState = State.RUNNING
                         
                 elif currentState == State.RUNNING:
-                    self.map.check_update(self.shm)
+                    self.map.check_update()
                     self.stat.poll()
                     if self.h['enable']:
                         if self.stat.task_state == linuxcnc.STATE_ON:
                             x = self.stat.position[0] - self.stat.g5x_offset[0] - self.stat.g92_offset[0]
                             y = self.stat.position[1] - self.stat.g5x_offset[1] - self.stat.g92_offset[1]
+                            x, y = self.predict_position(x, y, start)
                             offset = self.map.interpolate(x, y)
-                            self.h["z-offset"] = int(offset * self.h["scale"])
+                            self.update_output(offset * self.h["scale"])
                         else:
-                            self.h["z-offset"] = 0
+                            self.samples.clear()
+                            self.reset_output()
                     else:
                         currentState = State.RESET
 
                 elif currentState == State.RESET:
-                    self.h["z-offset"] = 0
+                    self.reset_output()
+                    self.samples.clear()
                     # toggle the clear output
                     self.h["clear"] = 1;
                     time.sleep(0.1)
                     self.h["clear"] = 0;
                     currentState = State.IDLE
-                time.sleep(0.02)
+                    # the clear pulse is not a timing overrun
+                    self.deadline = time.monotonic()
+                    start = self.deadline
+                self.wait_for_deadline(start)
         except KeyboardInterrupt:
             raise SystemExit
 
-comp = HALComp()
-comp.run()
+if __name__ == "__main__":
+    comp = HALComp()
+    comp.run()
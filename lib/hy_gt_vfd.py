@@ -26,6 +26,13 @@ from pymodbus.client import ModbusSerialClient
 LOG = logger.getLogger(__name__)
 LOG.setLevel(logger.INFO)
 
+# at-speed prediction needs speed_estimator.py next to this file
+# without it at-speed is a fixed tolerance check of the last speed-fb reading
+try:
+    from speed_estimator import SpeedEstimator
+except ImportError:
+    SpeedEstimator = None
+
 # state machine states
 INIT = 1
 RUNNING = 2
@@ -37,33 +44,67 @@ byte_size = 8
 baud_rate = 38400
 parity = "N"
 stop_bits = 1
-slave = 1
-max_speed = 24000
-min_speed = 7200
-last_speed = 0
-period = 0.25 # seconds to sleep before each cycle
+# one entry per drive on the bus
+slaves = [1]
+max_speeds = [24000]
+min_speeds = [7200]
+tick = 0.01 # seconds to sleep between checks of the command pins
 retries = 3
-motor_is_on = False
+simulate = False
+tolerance = 2 # percent of speed-cmd for at-speed
+hysteresis = 1 # extra percent before at-speed is dropped
 baud_values = ["1200", "2400", "4800", "9600", "19200", "38400"]
 parity_values = ["E", "O", "N"]
 stop_values = ["1", "2"]
 byte_values = ["5", "6", "7", "8"]
 
+# telemetry classes and the seconds between their reads
+FAST = 0
+SLOW = 1
+read_periods = {FAST: 0.1, SLOW: 0.5}
+# registers read by the poller - address: (telemetry class, list of (pin, divisor))
+# a divisor of 1 writes the raw register value to the pin
+READ_REGISTERS = {0x3003: (SLOW, [('output-voltage', 1)]),
+                  0x3004: (SLOW, [('output-current', 1)]),
+                  0x3005: (FAST, [('speed-fb', 1), ('speed-rps', 60)]),
+                  0x5000: (SLOW, [('fault-info-code', 1)])}
+# seconds over which bus-load is averaged
+LOAD_WINDOW = 1.0
+# most registers read in one frame
+MAX_BLOCK = 16
+
 h = hal.component("hy_gt_vfd")
 parser = argparse.ArgumentParser()
 
 # Parse command line options
+# the slave, maxrpm and minrpm options take comma separated lists, one value per drive
+# a single maxrpm or minrpm value is used for all drives
 def parse_args():
-    global device, baud_rate, parity, stop_bits, byte_size, slave, max_speed, min_speed
+    global device, baud_rate, parity, stop_bits, byte_size, slaves, max_speeds, min_speeds, simulate
+    global tolerance, hysteresis
     parser.add_argument("-d", "--device", help="serial device")
     parser.add_argument("-b", "--bits", help="number of bits")
     parser.add_argument("-r", "--rate", help="baudrate")
     parser.add_argument("-p", "--parity", help="parity")
     parser.add_argument("-s", "--stopbits", help="stop bits")
-    parser.add_argument("-t", "--slave", help="modbus slave number")
-    parser.add_argument("-M", "--maxrpm", help="max motor speed in RPM")
-    parser.add_argument("-m", "--minrpm", help="min motor speed in RPM")
+    parser.add_argument("-t", "--slave", help="modbus slave numbers")
+    parser.add_argument("-M", "--maxrpm", help="max motor speeds in RPM")
+    parser.add_argument("-m", "--minrpm", help="min motor speeds in RPM")
+    parser.add_argument("--tolerance", help="at-speed tolerance in percent")
+    parser.add_argument("--hysteresis", help="extra percent before at-speed is dropped")
+    parser.add_argument("--sim", action="store_true", help="use a simulated VFD instead of the serial port")
     args = parser.parse_args()
+    simulate = args.sim
+    if args.tolerance:
+        if 0 < float(args.tolerance) < 100:
+            tolerance = float(args.tolerance)
+        else:
+            print("Tolerance must be between 0 and 100 percent")
+    if args.hysteresis:
+        if 0 <= float(args.hysteresis) < 100:
+            hysteresis = float(args.hysteresis)
+        else:
+            print("Hysteresis must be between 0 and 100 percent")
     if args.device:
         device = args.device
     if args.bits:
@@ -91,27 +132,48 @@ def parse_args():
             print("Invalid stop bits - using default of {}".format(stop_bits))
             print("Must be one of ", stop_values)
     if args.slave:
-        if 1 <= int(args.slave) <= 127:
-            slave = int(args.slave)
-        else:
+        addresses = [int(i) for i in args.slave.split(',')]
+        if not all(1 <= i <= 127 for i in addresses):
             print("Slave address must be between 1 and 127")
-    if args.maxrpm:
-        if float(args.maxrpm) == 0:
-            print('FATAL ERROR - Max RPM = 0')
-            raise SystemExit
-        elif float(args.maxrpm) > min_speed:
-            max_speed = float(args.maxrpm)
+        elif len(set(addresses)) != len(addresses):
+            print("Slave addresses must be unique")
         else:
-            print("Max RPM must be greater than Min RPM")
+            slaves = addresses
+    max_speeds = max_speeds * len(slaves)
+    min_speeds = min_speeds * len(slaves)
+    if args.maxrpm:
+        for i, rpm in enumerate(per_drive(args.maxrpm, "maxrpm")):
+            if rpm == 0:
+                print('FATAL ERROR - Max RPM = 0')
+                raise SystemExit
+            elif rpm > min_speeds[i]:
+                max_speeds[i] = rpm
+            else:
+                print("Max RPM must be greater than Min RPM")
     if args.minrpm:
-        if float(args.minrpm) < max_speed:
-            min_speed = float(args.minrpm)
-        else:
-            print("Min RPM must be less than Max RPM")
+        for i, rpm in enumerate(per_drive(args.minrpm, "minrpm")):
+            if rpm < max_speeds[i]:
+                min_speeds[i] = rpm
+            else:
+                print("Min RPM must be less than Max RPM")
+
+def per_drive(text, name):
+    values = [float(i) for i in text.split(',')]
+    if len(values) == 1:
+        return values * len(slaves)
+    if len(values) != len(slaves):
+        print(f"FATAL ERROR - {name} needs one value or one per slave")
+        raise SystemExit
+    return values
 
 # Initialize the serial port
 def init_serial():
     global vfd
+    if simulate:
+        from vfd_sim import SimulatedBus, SimulatedVFD
+        vfd = SimulatedBus({drive.slave: SimulatedVFD(max_speed=drive.max_speed, baud_rate=baud_rate)
+                            for drive in drives})
+        return vfd.connect()
     params = {'port': device,
               'baudrate': baud_rate,
               'parity': parity,
@@ -123,131 +185,237 @@ def init_serial():
     return False
  
 # Create HAL pins
+# a single drive keeps the plain pin names, several drives get hy_gt_vfd.N.* pins
 def init_pins():
-    h.newpin('speed-cmd', hal.HAL_FLOAT, hal.HAL_IN)
-    h.newpin('speed-fb', hal.HAL_FLOAT, hal.HAL_OUT)
-    h.newpin('speed-rps', hal.HAL_FLOAT, hal.HAL_OUT)
-    h.newpin('spindle-on', hal.HAL_BIT, hal.HAL_IN)
-    h.newpin('forward', hal.HAL_BIT, hal.HAL_IN)
-    h.newpin('reverse', hal.HAL_BIT, hal.HAL_IN)
-    h.newpin('at-speed', hal.HAL_BIT, hal.HAL_OUT)
-    h.newpin('output-current', hal.HAL_FLOAT, hal.HAL_OUT)
-    h.newpin('output-voltage', hal.HAL_FLOAT, hal.HAL_OUT)
-    h.newpin('fault-info-code', hal.HAL_U32, hal.HAL_OUT)
-    h.newpin('modbus-errors', hal.HAL_U32, hal.HAL_OUT)
-    h['modbus-errors'] = 0
+    for drive in drives:
+        p = drive.prefix
+        h.newpin(p + 'speed-cmd', hal.HAL_FLOAT, hal.HAL_IN)
+        h.newpin(p + 'speed-fb', hal.HAL_FLOAT, hal.HAL_OUT)
+        h.newpin(p + 'speed-rps', hal.HAL_FLOAT, hal.HAL_OUT)
+        h.newpin(p + 'spindle-on', hal.HAL_BIT, hal.HAL_IN)
+        h.newpin(p + 'forward', hal.HAL_BIT, hal.HAL_IN)
+        h.newpin(p + 'reverse', hal.HAL_BIT, hal.HAL_IN)
+        h.newpin(p + 'at-speed', hal.HAL_BIT, hal.HAL_OUT)
+        h.newpin(p + 'output-current', hal.HAL_FLOAT, hal.HAL_OUT)
+        h.newpin(p + 'output-voltage', hal.HAL_FLOAT, hal.HAL_OUT)
+        h.newpin(p + 'fault-info-code', hal.HAL_U32, hal.HAL_OUT)
+        h.newpin(p + 'modbus-errors', hal.HAL_U32, hal.HAL_OUT)
+        h.newpin(p + 'command-latency', hal.HAL_FLOAT, hal.HAL_OUT)
+        h[p + 'modbus-errors'] = 0
+    # the bus is shared by all drives
+    h.newpin('bus-load', hal.HAL_FLOAT, hal.HAL_OUT)
     h.ready()
 
-def set_motor_on():
-    global motor_is_on, retries
-    if motor_is_on: return
-    motor_is_on = True
-    error = True
-    direction = 2 if h['reverse'] else 1
-    for i in range(retries):
-        time.sleep(delay)
-        req = vfd.write_register(0x1000, direction, slave = slave)
-        if not req.isError():
-            error = False
-            break
-    if error is True:
-        h['modbus-errors'] += 1
-        print("Motor On: Error writing to register 0x1000")
-
-def set_motor_off():
-    global motor_is_on, retries
-    if not motor_is_on: return
-    motor_is_on = False
-    h['at-speed'] = False
-    error = True
-    for i in range(retries):
-        time.sleep(delay)
-        req = vfd.write_register(0x1000, 5, slave = slave)
-        if not req.isError():
-            error = False
-            break
-    if error is True:
-        h['modbus-errors'] += 1
-        print("Motor Off: Error writing to register 0x1000")
-
-# Set spindle speed as percentage of maximum speed
-def set_motor_speed():
-    global last_speed, retries
-    speed = h['speed-cmd']
-    if speed == last_speed: return
-    last_speed = speed
-    if speed > max_speed:
-        speed_cmd = 10000
-    elif speed < min_speed:
-        speed_cmd = int((min_speed / max_speed) * 10000)
-    else:
-        speed_cmd = int((speed / max_speed) * 10000)
-    error = True
-    for i in range(retries):
-        time.sleep(delay)
-        req = vfd.write_register(0x2000, speed_cmd, slave = slave)
-        if not req.isError():
-            error = False
-            break
-    if error is True:
-        h['modbus-errors'] += 1
-        print("Error writing to register 0x2000")
-
-def read_mb_register(addr):
-    global currentState, retries
-    rtn_data = None
-    # Try is in case of USB port disconnection. The state machine will go to ERROR state
-    # and then to INIT where it will remain until the connection is re-established.
+# every modbus transaction goes through here so the bus time can be measured
+def bus_call(func, *args, **kwargs):
+    global bus_time
+    start = time.monotonic()
     try:
+        time.sleep(delay)
+        return func(*args, **kwargs)
+    finally:
+        bus_time += time.monotonic() - start
+
+# merge contiguous register addresses into (start, count) blocks
+# so each block is read with one modbus frame
+def build_blocks(addresses):
+    blocks = []
+    for addr in sorted(addresses):
+        if blocks:
+            start, count = blocks[-1]
+            if addr == start + count and count < MAX_BLOCK:
+                blocks[-1] = (start, count + 1)
+                continue
+        blocks.append((addr, 1))
+    return blocks
+
+
+# same calls as SpeedEstimator, compares the last speed-fb reading with the command
+class FixedTolerance:
+    def __init__(self, tolerance, hysteresis):
+        self.tolerance = tolerance
+        self.hysteresis = hysteresis
+        self.speed = None
+        self.locked = False
+
+    def sample(self, speed, now):
+        self.speed = speed
+
+    def new_target(self):
+        self.locked = False
+
+    def at_speed(self, target, now):
+        if target == 0 or self.speed is None:
+            self.locked = False
+            return False
+        band = self.tolerance + (self.hysteresis if self.locked else 0)
+        self.locked = abs(target - self.speed) <= band * abs(target)
+        return self.locked
+
+
+# one VFD on the bus with its own slave address and HAL pins
+class Drive:
+    def __init__(self, index, slave, max_speed, min_speed):
+        self.prefix = f"{index}." if len(slaves) > 1 else ""
+        self.slave = slave
+        self.max_speed = max_speed
+        self.min_speed = min_speed
+        self.motor_is_on = False
+        self.last_speed = 0
+        self.next_read = {FAST: 0, SLOW: 0}
+        self.last_check = time.monotonic()
+        # speed-fb is extrapolated up to half a read period past the next read
+        if SpeedEstimator is None:
+            self.estimator = FixedTolerance(tolerance / 100, hysteresis / 100)
+        else:
+            self.estimator = SpeedEstimator(tolerance / 100, hysteresis / 100, horizon = 1.5 * read_periods[FAST])
+
+    def write_mb_register(self, addr, value, msg):
         for i in range(retries):
-            time.sleep(delay)
-            data = vfd.read_holding_registers(address = addr, count = 1, slave = slave)
-            if not data.isError():
-                rtn_data = data.registers[0]
-                break
-        if rtn_data is None:
-            h['modbus-errors'] += 1
-            print(f"Error reading register {hex(addr)}")
-    except Exception as e:
-        print(f"Exception - {e}")
-        currentState = ERROR
-    return rtn_data
-
-def get_vfd_data():
-    data = read_mb_register(0x3003)
-    if data is not None:
-        h['output-voltage'] = data
-    data = read_mb_register(0x3004)
-    if data is not None:
-        h['output-current'] = data
-    data = read_mb_register(0x3005)
-    if data is not None:
-        h['speed-fb'] = data
-        h['speed-rps'] = data / 60
-    data = read_mb_register(0x5000)
-    if data is not None:
-        h['fault-info-code'] = data
-
-def set_atspeed():
-    speed_cmd = h['speed-cmd']
-    speed_fb = h['speed-fb']
-    if speed_cmd == 0: 
-        h['at-speed'] = False
-    elif abs((speed_cmd - speed_fb) / speed_cmd) <= 0.02:
-        h['at-speed'] = True
-    else:
-        h['at-speed'] = False
+            req = bus_call(vfd.write_register, addr, value, slave = self.slave)
+            if not req.isError(): return
+        self['modbus-errors'] += 1
+        print(f"Slave {self.slave} {msg}: Error writing to register {hex(addr)}")
+
+    # the command writes return True when a frame was sent
+    def set_motor_on(self):
+        if self.motor_is_on: return False
+        self.motor_is_on = True
+        direction = 2 if self['reverse'] else 1
+        self.write_mb_register(0x1000, direction, "Motor On")
+        return True
+
+    def set_motor_off(self):
+        if not self.motor_is_on: return False
+        self.motor_is_on = False
+        self['at-speed'] = False
+        self.estimator.new_target()
+        self.write_mb_register(0x1000, 5, "Motor Off")
+        return True
+
+    # Set spindle speed as percentage of maximum speed
+    def set_motor_speed(self):
+        speed = self['speed-cmd']
+        if speed == self.last_speed: return False
+        self.last_speed = speed
+        self.estimator.new_target()
+        if speed > self.max_speed:
+            speed_cmd = 10000
+        elif speed < self.min_speed:
+            speed_cmd = int((self.min_speed / self.max_speed) * 10000)
+        else:
+            speed_cmd = int((speed / self.max_speed) * 10000)
+        self.write_mb_register(0x2000, speed_cmd, "Speed")
+        return True
+
+    def service_commands(self):
+        if not self['forward'] and not self['reverse']:
+            sent = self.set_motor_off()
+        elif self['spindle-on'] is True:
+            sent = self.set_motor_on()
+            sent = self.set_motor_speed() or sent
+        else:
+            sent = self.set_motor_off()
+        now = time.monotonic()
+        # the pin changed at some point since the previous check
+        if sent:
+            self['command-latency'] = now - self.last_check
+        self.last_check = now
+
+    def read_mb_registers(self, addr, count):
+        global currentState
+        rtn_data = None
+        # Try is in case of USB port disconnection. The state machine will go to ERROR state
+        # and then to INIT where it will remain until the connection is re-established.
+        try:
+            for i in range(retries):
+                data = bus_call(vfd.read_holding_registers, address = addr, count = count, slave = self.slave)
+                if not data.isError():
+                    rtn_data = data.registers
+                    break
+            if rtn_data is None:
+                self['modbus-errors'] += 1
+                print(f"Slave {self.slave}: Error reading {count} registers from {hex(addr)}")
+        except Exception as e:
+            print(f"Exception - {e}")
+            currentState = ERROR
+        return rtn_data
+
+    def read_block(self, start, count):
+        data = self.read_mb_registers(start, count)
+        if data is None: return
+        now = time.monotonic()
+        for addr, value in enumerate(data, start):
+            for pin, divisor in READ_REGISTERS[addr][1]:
+                self[pin] = value if divisor == 1 else value / divisor
+                if pin == 'speed-fb':
+                    self.estimator.sample(self[pin], now)
+
+    # the fast registers every fast period, all registers when the slow period is due
+    def due_blocks(self, now):
+        if now >= self.next_read[SLOW]:
+            self.next_read[SLOW] = now + read_periods[SLOW]
+            self.next_read[FAST] = now + read_periods[FAST]
+            return list(all_blocks)
+        if now >= self.next_read[FAST]:
+            self.next_read[FAST] = now + read_periods[FAST]
+            return list(fast_blocks)
+        return []
+
+    # checked every tick, the estimator predicts the speed between reads of speed-fb
+    def set_atspeed(self, now):
+        self['at-speed'] = self.estimator.at_speed(self['speed-cmd'], now)
+
+    def __getitem__(self, pin):
+        return h[self.prefix + pin]
+    def __setitem__(self, pin, value):
+        h[self.prefix + pin] = value
+
+
+def service_commands():
+    for drive in drives:
+        drive.service_commands()
+
+# telemetry frames are interleaved one per drive, starting with a different drive each cycle
+# command pins are checked again after each frame, so a command never waits behind
+# more than one telemetry read
+def get_vfd_data(now):
+    global turn
+    order = drives[turn:] + drives[:turn]
+    turn = (turn + 1) % len(drives)
+    queues = [(drive, drive.due_blocks(now)) for drive in order]
+    while any(blocks for drive, blocks in queues):
+        for drive, blocks in queues:
+            if not blocks: continue
+            drive.read_block(*blocks.pop(0))
+            if currentState != RUNNING: return
+            service_commands()
+
+def update_bus_load(now):
+    global bus_time, load_start
+    if now - load_start < LOAD_WINDOW: return
+    h['bus-load'] = 100 * bus_time / (now - load_start)
+    bus_time = 0
+    load_start = now
 
 ## start
 currentState = INIT
 prevState = None
-delay = 80 / baud_rate
 parse_args()
+delay = 80 / baud_rate
+all_blocks = build_blocks(READ_REGISTERS)
+fast_blocks = build_blocks([addr for addr in READ_REGISTERS if READ_REGISTERS[addr][0] == FAST])
+drives = [Drive(i, slaves[i], max_speeds[i], min_speeds[i]) for i in range(len(slaves))]
+turn = 0
+bus_time = 0
+load_start = time.monotonic()
 init_pins()
+if SpeedEstimator is None:
+    LOG.info("speed_estimator.py not found - at-speed uses a fixed tolerance")
 
 try:
     while True:
-        time.sleep(period)
+        time.sleep(tick)
         if currentState == INIT:
             if currentState != prevState:
                 LOG.info("State : VFD INIT")
@@ -264,15 +432,13 @@ try:
             if currentState != prevState:
                 LOG.info("State : VFD RUNNING")
                 prevState = currentState
-            get_vfd_data()
-            if not h['forward'] and not h['reverse']:
-                set_motor_off()
-            elif h['spindle-on'] is True:
-                set_motor_on()
-                set_motor_speed()
-                set_atspeed()
-            else:
-                set_motor_off()
+            service_commands()
+            now = time.monotonic()
+            get_vfd_data(now)
+            for drive in drives:
+                if drive.motor_is_on:
+                    drive.set_atspeed(time.monotonic())
+            update_bus_load(now)
 
         elif currentState == ERROR:
             LOG.info("State : VFD ERROR")
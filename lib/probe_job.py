@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025  Jim Sloot <persei802@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# a probe job is a list of probe routines, each run at its own XY location
+# jobs are loaded from csv or json files and run by the probe worker in one request
+# locations are in the current work coordinates, auto zero and auto skew are off for job runs
+#
+# csv - one row per feature with a header line
+#   routine,x,y,z,diameter_hint
+#   probe_round_pocket,10,10,2,8
+# json - a list of features or a dictionary with an 'entries' list
+#   {"safe_z": 10, "entries": [{"routine": "probe_round_pocket", "x": 10, "y": 10, "parms": {"diameter_hint": 8}}]}
+
+import os
+import csv
+import json
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QLineEdit,
+                             QTableWidget, QTableWidgetItem, QHeaderView, QFileDialog)
+from qtvcp import logger
+
+LOG = logger.getLogger(__name__)
+LOG.setLevel(logger.INFO) # One of DEBUG, INFO, WARNING, ERROR, CRITICAL
+
+# keys of a job entry that are not routine parameters
+LOCATION_KEYS = ('routine', 'x', 'y', 'z', 'parms')
+# StatusBar message alert levels
+DEFAULT =  0
+WARNING =  1
+# result values shown in the table and written to the report
+RESULT_KEYS = ['xm', 'xc', 'xp', 'ym', 'yc', 'yp', 'lx', 'ly', 'z', 'd', 'a']
+
+
+def load_job(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    safe_z = None
+    with open(filename, newline='') as f:
+        if ext == '.json':
+            data = json.load(f)
+            if isinstance(data, dict):
+                safe_z = data.get('safe_z')
+                data = data.get('entries', [])
+            rows = data
+        elif ext == '.csv':
+            rows = [row for row in csv.DictReader(f)]
+        else:
+            raise ValueError(f"Unknown job file type {ext}")
+    entries = []
+    for line, row in enumerate(rows, 1):
+        if not row.get('routine'):
+            raise ValueError(f"Entry {line} has no routine")
+        entry = {'routine': row['routine'].strip()}
+        try:
+            for key in ('x', 'y', 'z'):
+                val = row.get(key)
+                entry[key] = None if val in (None, '') else float(val)
+        except ValueError:
+            raise ValueError(f"Entry {line} has an invalid location")
+        if entry['x'] is None or entry['y'] is None:
+            raise ValueError(f"Entry {line} needs an X and Y location")
+        # parameters are sent to the subprogram as text, like the line edits
+        parms = {key: str(val) for key, val in row.items() if key not in LOCATION_KEYS and val not in (None, '')}
+        parms.update({key: str(val) for key, val in row.get('parms', {}).items()})
+        entry['parms'] = parms
+        entries.append(entry)
+    if safe_z is not None: safe_z = float(safe_z)
+    return entries, safe_z
+
+
+# the owner widget provides start_job(entries, safe_z), job_status(msg, level) and the probe worker
+class ProbeJob(QWidget):
+    def __init__(self, parent=None):
+        super(ProbeJob, self).__init__()
+        self.parent = parent
+        self.setMinimumWidth(800)
+        self.setMinimumHeight(400)
+        self.gm = None
+        self.setWindowTitle("Probe Job")
+        self.setWindowFlags(self.windowFlags() | Qt.WindowStaysOnTopHint)
+        self.filename = None
+        self.entries = []
+        self.report = None
+        self.report_writer = None
+        self.running = False
+        self.build_widget()
+        # signal connections
+        self.btn_load.pressed.connect(self.load_pressed)
+        self.btn_run.pressed.connect(self.run_pressed)
+        self.btn_stop.pressed.connect(self.stop_pressed)
+        self.btn_close.pressed.connect(self.close_pressed)
+        self.update_buttons()
+
+    def build_widget(self):
+        main_layout = QVBoxLayout()
+        btn_box = QHBoxLayout()
+        self.lbl_file = QLabel('No job loaded')
+        self.lineEdit_safe_z = QLineEdit()
+        self.lineEdit_safe_z.setPlaceholderText('current Z')
+        self.lineEdit_safe_z.setMaximumWidth(100)
+        self.btn_load = QPushButton('LOAD')
+        self.btn_run = QPushButton('RUN')
+        self.btn_stop = QPushButton('STOP')
+        self.btn_close = QPushButton('CLOSE')
+        btn_box.addWidget(self.lbl_file, 1)
+        btn_box.addWidget(QLabel('SAFE Z'))
+        btn_box.addWidget(self.lineEdit_safe_z)
+        btn_box.addWidget(self.btn_load)
+        btn_box.addWidget(self.btn_run)
+        btn_box.addWidget(self.btn_stop)
+        btn_box.addWidget(self.btn_close)
+        self.table = QTableWidget()
+        headers = ['ROUTINE', 'X', 'Y', 'STATUS'] + [key.upper() for key in RESULT_KEYS]
+        self.table.setColumnCount(len(headers))
+        self.table.setHorizontalHeaderLabels(headers)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        main_layout.addWidget(self.table)
+        main_layout.addLayout(btn_box)
+        self.setLayout(main_layout)
+
+    def load_pressed(self):
+        fname, _ = QFileDialog.getOpenFileName(self, 'Load Probe Job', os.path.expanduser('~'),
+                                               'Probe jobs (*.csv *.json)')
+        if fname: self.load_file(fname)
+
+    def load_file(self, fname):
+        try:
+            self.entries, safe_z = load_job(fname)
+        except Exception as e:
+            self.parent.job_status(f"Could not load probe job {fname}: {e}", WARNING)
+            return
+        self.filename = fname
+        self.lbl_file.setText(f"{os.path.basename(fname)} - {len(self.entries)} features")
+        if safe_z is not None:
+            self.lineEdit_safe_z.setText(str(safe_z))
+        self.table.setRowCount(len(self.entries))
+        for row, entry in enumerate(self.entries):
+            self.set_row(row, [entry['routine'], str(entry['x']), str(entry['y']), 'QUEUED'])
+        self.update_buttons()
+
+    def run_pressed(self):
+        if not self.entries or self.running: return
+        safe_z = self.lineEdit_safe_z.text().strip()
+        try:
+            safe_z = float(safe_z) if safe_z else None
+        except ValueError:
+            self.parent.job_status(f"Invalid safe Z value {safe_z}", WARNING)
+            return
+        for row in range(len(self.entries)):
+            self.set_row(row, ['QUEUED'] + [''] * len(RESULT_KEYS), 3)
+        if not self.parent.start_job(self.entries, safe_z): return
+        self.open_report()
+        self.running = True
+        self.update_buttons()
+
+    def stop_pressed(self):
+        if self.running:
+            self.parent.worker.cancel()
+
+    def close_pressed(self):
+        self.gm = self.geometry()
+        self.hide()
+
+    def showEvent(self, event):
+        if self.gm is not None:
+            self.setGeometry(self.gm)
+        super().showEvent(event)
+
+    # a result is sent by the subprogram as each feature finishes
+    def add_result(self, data):
+        row = data['index']
+        status = data.get('status')
+        if status is None:
+            self.set_row(row, ['FAILED'], 3)
+            self.table.item(row, 3).setToolTip(data.get('error', ''))
+        else:
+            self.set_row(row, ['DONE'] + ['' if status[key] == 'None' else status[key] for key in RESULT_KEYS], 3)
+        self.table.scrollToItem(self.table.item(row, 0))
+        if self.report_writer is not None:
+            entry = self.entries[row]
+            values = [status[key] if status else '' for key in RESULT_KEYS]
+            self.report_writer.writerow([row + 1, entry['routine'], entry['x'], entry['y'],
+                                         'DONE' if status else data.get('error', 'FAILED')] + values)
+            self.report.flush()
+
+    def job_finished(self):
+        if not self.running: return
+        self.running = False
+        if self.report is not None:
+            self.report.close()
+            self.parent.job_status(f"Probe job report saved to {self.report.name}", DEFAULT)
+        self.report = None
+        self.report_writer = None
+        self.update_buttons()
+
+    def open_report(self):
+        fname = os.path.splitext(self.filename)[0] + '_report.csv'
+        try:
+            self.report = open(fname, 'w', newline='')
+        except OSError as e:
+            self.parent.job_status(f"Could not open probe job report {fname}: {e}", WARNING)
+            return
+        self.report_writer = csv.writer(self.report)
+        self.report_writer.writerow(['feature', 'routine', 'x', 'y', 'status'] + RESULT_KEYS)
+
+    def set_row(self, row, values, column=0):
+        for col, val in enumerate(values, column):
+            self.table.setItem(row, col, QTableWidgetItem(val))
+
+    def update_buttons(self):
+        self.btn_load.setEnabled(not self.running)
+        self.btn_run.setEnabled(bool(self.entries) and not self.running)
+        self.btn_stop.setEnabled(self.running)
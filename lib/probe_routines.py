@@ -14,10 +14,14 @@
 # GNU General Public License for more details.
 
 import sys
+import os
+import glob
+import atexit
 import time
 import select
 import math
 import linuxcnc
+from fractions import Fraction
 from qtvcp.core import Status, Action
 from qtvcp import logger
 LOG = logger.getLogger(__name__)
@@ -26,9 +30,107 @@ LOG.setLevel(logger.INFO) # One of DEBUG, INFO, WARNING, ERROR, CRITICAL
 ACTION = Action()
 STATUS = Status()
 
+# longest wait for an error message after a command did not finish cleanly (sec)
+ERROR_WAIT = 0.1
+# first interval of the error poll, doubled after each empty poll (sec)
+ERROR_POLL = 0.002
+# compiled routines are written to this folder, it must be in SUBROUTINE_PATH
+COMPILE_DIR = 'qtprobe'
+# a compiled routine reports its results with a DEBUG message starting with this tag
+RESULT_TAG = 'QTPROBE'
+# DEBUG messages show 6 decimals, so results are sent multiplied by 2**RESULT_SCALE.
+# That is a whole number for any result above 1e-24 and comes back without losing a bit
+RESULT_SCALE = 128
+RESULT_KEYS = ('xm', 'xp', 'ym', 'yp')
+
+# the compiled routines are called with
+# 1 side edge length  2 xy clearance  3 latch return  4 max travel  5 search vel
+# 6 probe vel  7 rapid vel  8 z clearance  9 probe diameter
+# and leave xm, xp, ym, yp in #<_qtprobe_xm> ... #<_qtprobe_yp>
+Z_DOWN = "G91 G1 Z-#8 F#7\nG90"
+Z_UP = "G91 G1 Z#8 F#7\nG90"
+
+# same moves as ProbeRoutines.probe()
+def edge_gcode(axis, sign):
+    back = '' if sign == '-' else '-'
+    return f"""#<start> = #<_{axis.lower()}>
+G91
+G38.2 {axis}{sign}#4 F#5
+G1 {axis}{back}#3 F#7
+G4 P0.5
+G38.2 {axis}{sign}[1.2 * #3] F#6
+G90 G1 {axis}#<start> F#7"""
+
+# same moves as probe_xy_hole for one axis
+def hole_axis_gcode(axis, parm, n):
+    a = axis.lower()
+    return f"""o{n} if [[#1 - #2] GT 0]
+    G91 G1 {axis}-[#1 - #2] F#7
+    G90
+o{n} endif
+{edge_gcode(axis, '-')}
+#<{a}m> = [#{parm} - #9 / 2]
+o{n + 1} if [[2 * #1 - #3 - #2] GT 0]
+    G91 G1 {axis}[2 * #1 - #3 - #2] F#7
+    G90
+o{n + 1} endif
+{edge_gcode(axis, '')}
+#<{a}p> = [#{parm} + #9 / 2]"""
+
+# same moves as probe_outside_xy_boss for one axis
+def boss_axis_gcode(axis, parm):
+    a = axis.lower()
+    return f"""G91 G1 {axis}-[#1 + #2] F#7
+G90
+{Z_DOWN}
+{edge_gcode(axis, '')}
+#<{a}m> = [#{parm} + #9 / 2]
+{Z_UP}
+G91 G1 {axis}[2 * [#1 + #3 + #2]] F#7
+G90
+{Z_DOWN}
+{edge_gcode(axis, '-')}
+#<{a}p> = [#{parm} - #9 / 2]
+{Z_UP}"""
+
+def result_gcode():
+    lines = []
+    for key in RESULT_KEYS:
+        lines.append(f"""#<_qtprobe_{key}> = #<{key}>
+#<scaled> = [#<{key}> * [2 ** {RESULT_SCALE}]]
+(DEBUG,{RESULT_TAG} {key} #<scaled>)""")
+    return '\n'.join(lines)
+
+def compiled_sub(name, body):
+    return f"""; generated by QtDragon probe routines, removed when the probe worker exits
+o<{name}> sub
+{body}
+{result_gcode()}
+o<{name}> endsub
+M2
+"""
+
+COMPILED_SUBS = {
+    'qtprobe_xy_hole': compiled_sub('qtprobe_xy_hole', f"""{Z_DOWN}
+{hole_axis_gcode('X', 5061, 101)}
+G1 X[[#<xm> + #<xp>] / 2] F#7
+{hole_axis_gcode('Y', 5062, 103)}
+{Z_UP}
+G1 Y[[#<ym> + #<yp>] / 2] F#7"""),
+    'qtprobe_xy_boss': compiled_sub('qtprobe_xy_boss', f"""{boss_axis_gcode('X', 5061)}
+G1 X[[#<xm> + #<xp>] / 2] F#7
+{boss_axis_gcode('Y', 5062)}
+G1 Y[[#<ym> + #<yp>] / 2] F#7""")}
+
 class ProbeRoutines():
     def __init__(self):
         self.timeout = 30
+        # timing stats of the current routine
+        self.mdi_lines = 0
+        self.mdi_time = 0.0
+        # compiled mode runs the xy hole and boss routines as one o-word subroutine call
+        self.compile_path = self.get_compile_path()
+        self.compiled_results = {}
 
 ##################
 # Helper Functions
@@ -173,14 +275,21 @@ class ProbeRoutines():
         return 1
 
     def CALL_MDI_WAIT(self, code, timeout = 5):
+        return self.run_mdi(code, timeout)
+
+    def run_mdi(self, code, timeout):
         LOG.debug(f'MDI_WAIT_COMMAND= {code}, maxt = {timeout}')
         for l in code.split("\n"):
+            start = time.monotonic()
             ACTION.CALL_MDI( l )
             result = ACTION.cmd.wait_complete(timeout)
+            self.mdi_lines += 1
             try:
-                # give a chance for the error message to get to stdin
-                time.sleep(.1)
-                error = STATUS.ERROR.poll()
+                # a command that completed normally has its errors queued already,
+                # otherwise give the error message a short time to arrive
+                wait = 0 if result == linuxcnc.RCS_DONE else ERROR_WAIT
+                error = self.poll_error(wait)
+                self.mdi_time += time.monotonic() - start
                 if not error is None:
                     ACTION.ABORT()
                     return error[1]
@@ -196,6 +305,120 @@ class ProbeRoutines():
                 return 'MDI_COMMAND_WAIT RCS error'
         return 1
 
+    def poll_error(self, wait):
+        deadline = time.monotonic() + wait
+        interval = ERROR_POLL
+        while True:
+            error = STATUS.ERROR.poll()
+            if error is not None:
+                if not self.compiled_result(error[1]): return error
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return None
+            time.sleep(min(interval, remaining))
+            interval *= 2
+
+    ##################
+    # Compiled routines
+    ##################
+    # the subroutines are written to the SUBROUTINE_PATH folder named COMPILE_DIR
+    # and removed again when the worker exits
+    def get_compile_path(self):
+        ini_file = os.environ.get('INI_FILE_NAME')
+        if ini_file is None: return None
+        try:
+            ini = linuxcnc.ini(ini_file)
+            if str(ini.find('PROBE', 'COMPILE_ROUTINES')).lower() not in ('1', 'true', 'yes'):
+                return None
+            paths = ini.find('RS274NGC', 'SUBROUTINE_PATH') or ''
+        except Exception as e:
+            LOG.warning(f"Compiled probe routines disabled - {e}")
+            return None
+        for path in paths.split(':'):
+            path = os.path.expanduser(path.strip())
+            if os.path.basename(os.path.normpath(path)) != COMPILE_DIR: continue
+            if not os.path.isabs(path):
+                path = os.path.join(os.path.dirname(ini_file), path)
+            try:
+                os.makedirs(path, exist_ok=True)
+                self.write_compiled(path)
+            except OSError as e:
+                LOG.warning(f"Compiled probe routines disabled - {e}")
+                return None
+            atexit.register(self.remove_compiled, path)
+            return path
+        LOG.warning(f"Compiled probe routines disabled - no {COMPILE_DIR} folder in SUBROUTINE_PATH")
+        return None
+
+    def write_compiled(self, path):
+        # files left by a worker that was killed
+        self.remove_compiled(path)
+        for name, text in COMPILED_SUBS.items():
+            with open(os.path.join(path, name + '.ngc'), 'w') as f:
+                f.write(text)
+
+    def remove_compiled(self, path):
+        for filename in glob.glob(os.path.join(path, 'qtprobe_*.ngc')):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    # DEBUG messages from a compiled routine carry its results, they are not errors
+    def compiled_result(self, text):
+        if not str(text).startswith(RESULT_TAG): return False
+        try:
+            key, value = text.split()[1:3]
+            # Fraction keeps every digit of the text, the float of the quotient is exact
+            self.compiled_results[key] = float(Fraction(value) / 2 ** RESULT_SCALE)
+        except (ValueError, TypeError):
+            pass
+        return True
+
+    # the whole routine runs as one MDI call, probe results come back in a DEBUG message
+    def call_compiled(self, name, diameter):
+        z_stack = self.data_z_clearance + self.data_probe_diam + self.data_extra_depth
+        parms = [self.data_side_edge_length, self.data_xy_clearance, self.data_latch_return_dist,
+                 self.data_max_travel, self.data_search_vel, self.data_probe_vel, self.data_rapid_vel,
+                 z_stack, diameter]
+        self.compiled_results = {}
+        args = ' '.join(f'[{p}]' for p in parms)
+        # four probe cycles, each may take the normal timeout
+        rtn = self.run_mdi(f'o<{name}> call {args}', 4 * self.timeout)
+        if rtn != 1: return rtn
+        if any(key not in self.compiled_results for key in RESULT_KEYS):
+            return f'No results from compiled routine {name}'
+        self.status_xm = self.compiled_results['xm']
+        self.status_xp = self.compiled_results['xp']
+        self.status_ym = self.compiled_results['ym']
+        self.status_yp = self.compiled_results['yp']
+        return 1
+
+    # results and history of the compiled hole and boss routines
+    # the hole routine takes its diameter from the signed sides, the boss from the lengths
+    def compiled_xy(self, name, diameter, label, signed):
+        rtn = self.call_compiled(name, diameter)
+        if rtn != 1: return rtn
+        len_x = self.length_x()
+        len_y = self.length_y()
+        self.status_xc = (self.status_xm + self.status_xp) / 2
+        self.status_yc = (self.status_ym + self.status_yp) / 2
+        if signed:
+            self.status_d = ((self.status_xp - self.status_xm) + (self.status_yp - self.status_ym)) / 2
+        else:
+            self.status_d = (len_x + len_y) / 2
+        self.add_history(label, "XmXcXpLxYmYcYpLyD", self.status_xm, self.status_xc, self.status_xp, len_x,
+                         self.status_ym, self.status_yc, self.status_yp, len_y, 0, self.status_d, 0)
+        self.set_zero("XY")
+        return 1
+
+    def reset_timing(self):
+        self.mdi_lines = 0
+        self.mdi_time = 0.0
+
+    def timing_log(self, elapsed):
+        return f"Time[{elapsed:.2f}s {self.mdi_lines} lines MDI {self.mdi_time:.2f}s]"
+
     #####################
     # Tool Setter probing
     #####################
@@ -746,6 +969,14 @@ class ProbeRoutines():
 ###################
     def probe_xy_hole(self):
         method = 'probe_xy_hole:'
+        if self.compile_path is not None:
+            if self.data_side_edge_length - self.data_xy_clearance <= 0:
+                if self.data_max_travel < self.data_side_edge_length:
+                    return f'{method} Max travel is less then hole radius while xy_clearance is too large for rapid  positioning'
+                if self.data_max_travel < (2 * self.data_side_edge_length - self.data_latch_return_dist):
+                    return f'{method} Max travel is less then hole diameter while xy_clearance is too large for rapid  positioning'
+            rtn = self.compiled_xy('qtprobe_xy_hole', self.cal_diameter, 'Inside Hole ', True)
+            return rtn if rtn == 1 else f'{method} {rtn}'
         rtn = self.z_clearance_down()
         if rtn != 1:
             return f'{method} {rtn}'
@@ -1043,6 +1274,10 @@ class ProbeRoutines():
     # this routine is used by versaprobe only
     # basicprobe uses probe_rectangular_boss because it has hints for X and Y
     def probe_outside_xy_boss(self):
+        if self.compile_path is not None:
+            self.history_log = 'Probe outside_xy_boss did not finish'
+            rtn = self.compiled_xy('qtprobe_xy_boss', self.data_probe_diam, 'Outside Hole ', False)
+            return rtn if rtn == 1 else f'Probe outside_xy_boss: {rtn}'
 
         # probe_outside_length_x
         self.history_log = 'Probe outside_xy_boss did not finish'
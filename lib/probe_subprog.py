@@ -15,9 +15,11 @@
 # GNU General Public License for more details.
 # This subprogram is used by both versa_probe and basic_probe widgets
 
+import os
 import sys
 import time
 import json
+import select
 
 from PyQt5.QtCore import QObject
 from qtvcp.core import Status, Action, Info
@@ -140,67 +142,168 @@ class ProbeSubprog(QObject, ProbeRoutines):
         self.status_th = None
         self.status_bh = None
         self.history_log = ""
+        # bytes read from stdin that do not make a full line yet
+        self.stdin_buffer = b''
 
         self.process()
 
+    # the worker stays alive for the life of the screen, one json request per line
     def process(self):
+        self.reply(None, 'READY')
         while 1:
             try:
-                line = sys.stdin.readline()
+                line = self.read_line()
             except KeyboardInterrupt:
                 break
-            if line:
-                cmd = line
-                line = None
-                try:
-                    error = self.process_command(cmd)
-                    STATUS.block_error_polling()
-                    # error = 1 means success,
-                    # error = None means ignore,
-                    # anything else is an error - a returned string is an error message
-                    if error is not None:
-                        if error != 1:
-                            if type(error) == str:
-                                sys.stdout.write(f"ERROR INFO {error}\n")
-                            else:
-                                sys.stdout.write("ERROR Probe routine returned with error\n")
-                        else:
-                            self.collect_status()
-                            sys.stdout.write("COMPLETE$" + json.dumps(self.send_dict) + "\n")
-                            sys.stdout.flush()
-                        sys.stdout.flush()
+            # an empty read means the parent closed the pipe
+            if not line: break
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                self.reply(None, 'ERROR', f"Command Error: {e}")
+                continue
+            if not isinstance(request, dict):
+                self.reply(None, 'ERROR', f"Command Error: not a request - {line.strip()}")
+                continue
+            self.run_request(request.get('id'), request.get('cmd'), request.get('parms'))
+
+    def run_request(self, rid, cmd, parms):
+        if cmd == 'run_job':
+            self.run_job(rid, parms)
+            return
+        if cmd == 'cancel': return
+        try:
+            error = self.process_command(cmd, parms)
+            STATUS.block_error_polling()
+            # error = 1 means success,
+            # error = None means ignore,
+            # anything else is an error - a returned string is an error message
+            if error is not None:
+                if error != 1:
+                    if type(error) == str:
+                        self.reply(rid, 'ERROR INFO', error)
+                    else:
+                        self.reply(rid, 'ERROR', "Probe routine returned with error")
+                else:
+                    self.collect_status()
+                    self.reply(rid, 'COMPLETE', self.send_dict)
+
+            if self.history_log != "":
+                self.reply(rid, 'HISTORY', self.history_log)
+                self.history_log = ""
 
-                    # print history
-                    if self.history_log != "":
-                        time.sleep(0.1)
-                        sys.stdout.write("HISTORY {}\n".format(self.history_log))
-                        self.history_log = ""
-                        sys.stdout.flush()
+        except Exception as e:
+            self.reply(rid, 'ERROR', f"Command Error: {e}")
+        self.reply(rid, 'DONE')
 
-                except Exception as e:
-                    sys.stdout.write("ERROR Command Error: {}\n".format(e))
-                    sys.stdout.flush()
+    # features are run back to back, a RESULT is sent as each one finishes
+    # the job stops at the first failed feature or when the screen sends a cancel
+    def run_job(self, rid, job):
+        entries = job.get('entries', [])
+        done = 0
+        for index, entry in enumerate(entries):
+            if self.job_cancelled():
+                self.reply(rid, 'ERROR INFO', f"Probe job stopped after {done} of {len(entries)} features")
                 break
+            parms = dict(job['parms'])
+            parms.update(entry.get('parms', {}))
+            # the traverses are in work coordinates, so no feature may move the work offset
+            parms['allow_auto_zero'] = '0'
+            parms['allow_auto_skew'] = '0'
+            result = {'index': index, 'routine': entry['routine']}
+            try:
+                if not entry['routine'].startswith('probe_'):
+                    error = f"{entry['routine']} is not a probe routine"
+                else:
+                    error = self.traverse(entry, job.get('safe_z'), parms)
+                if error == 1:
+                    error = self.process_command(entry['routine'], parms)
+                STATUS.block_error_polling()
+            except Exception as e:
+                error = f"Command Error: {e}"
+            if error == 1:
+                self.collect_status()
+                result['status'] = dict(self.send_dict)
+                done += 1
+            else:
+                result['error'] = error if type(error) == str else 'Probe routine returned with error'
+            self.reply(rid, 'RESULT', result)
+            if self.history_log != "":
+                self.reply(rid, 'HISTORY', self.history_log)
+                self.history_log = ""
+            if error != 1:
+                self.reply(rid, 'ERROR INFO', f"Probe job stopped at feature {index + 1}: {result['error']}")
+                break
+        self.reply(rid, 'JOB', {'done': done, 'total': len(entries)})
+        self.reply(rid, 'DONE')
+
+    # move to the start of the next feature, above the parts if a safe Z is given
+    def traverse(self, entry, safe_z, parms):
+        rapid = parms.get('rapid_vel', self.data_rapid_vel)
+        s = "G90"
+        if safe_z is not None:
+            s += f"\nG1 Z{safe_z} F{rapid}"
+        s += f"\nG1 X{entry['x']} Y{entry['y']} F{rapid}"
+        if entry.get('z') is not None:
+            s += f"\nG1 Z{entry['z']} F{rapid}"
+        rtn = self.CALL_MDI_WAIT(s, self.timeout)
+        if rtn != 1:
+            return f"Traverse to X{entry['x']} Y{entry['y']} failed: {rtn}"
+        return 1
+
+    def job_cancelled(self):
+        while True:
+            line = self.read_line(wait=False)
+            if line is None: return False
+            if not line: return True
+            try:
+                request = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(request, dict) and request.get('cmd') == 'cancel': return True
+
+    # stdin is read with os.read into our own buffer, so select() on the fd never misses
+    # a line that is already buffered and a partial line never blocks a running job
+    # returns None when no full line is waiting and wait is False, '' when the pipe is closed
+    def read_line(self, wait=True):
+        fd = sys.stdin.fileno()
+        while b'\n' not in self.stdin_buffer:
+            if not wait and not select.select([fd], [], [], 0)[0]: return None
+            data = os.read(fd, 4096)
+            if not data: return ''
+            self.stdin_buffer += data
+        line, self.stdin_buffer = self.stdin_buffer.split(b'\n', 1)
+        return line.decode('utf-8', 'replace') + '\n'
+
+    def reply(self, rid, kind, data=None):
+        sys.stdout.write(json.dumps({'id': rid, 'type': kind, 'data': data}) + "\n")
+        sys.stdout.flush()
 
     # check that the command is actually a method in our class else
     # this message isn't for us - ignore it
-    def process_command(self, cmd):
-        cmd = cmd.rstrip().split('$')
-        if cmd[0] in dir(self):
+    def process_command(self, cmd, parms):
+        if cmd in dir(self):
+            STATUS.stat.poll()
             if not STATUS.is_on_and_idle(): return None
+            # errors raised while the worker was idle have already been shown by the screen
+            while STATUS.ERROR.poll() is not None: pass
             pre = self.prechecks()
             if pre is not None: return pre
-            parms = json.loads(cmd[1])
             self.update_data(parms)
             # start polling errors here - parent program should have blocked their polling
             STATUS.unblock_error_polling()
-            error = self[cmd[0]]()
+            self.reset_timing()
+            start = time.monotonic()
+            error = self[cmd]()
+            # the cycle time is added to the history so it shows in the machine log
+            if self.history_log != "":
+                self.history_log += ' ' + self.timing_log(time.monotonic() - start)
             if (error != 1 or type(error) == str) and STATUS.is_on_and_idle():
                 ACTION.CALL_MDI("G90")
             self.postreset()
             return error
         else:
-            return 'Command function {} not in probe routines'.format(cmd[0])
+            return 'Command function {} not in probe routines'.format(cmd)
 
     def update_data(self, parms):
         for key in parms:
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2025  Jim Sloot <persei802@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# keeps the probe subprogram running for the life of the screen
+# requests and replies are single lines of json, tagged with a request id
+
+import json
+from PyQt5.QtCore import QObject, QProcess, QTimer, pyqtSignal
+from qtvcp import logger
+
+LOG = logger.getLogger(__name__)
+LOG.setLevel(logger.INFO) # One of DEBUG, INFO, WARNING, ERROR, CRITICAL
+
+# delay before a worker that died is started again (msec)
+RESTART_DELAY = 1000
+# give up after this many restarts without a completed request
+MAX_RESTARTS = 5
+
+class ProbeWorker(QObject):
+    # emitted with the reply type and its data for the current request
+    reply = pyqtSignal(str, object)
+    # emitted with the process id each time the worker is started
+    started = pyqtSignal(int)
+
+    def __init__(self, program, parent=None):
+        super().__init__(parent)
+        self.program = program
+        self.proc = None
+        self.request_id = 0
+        self.busy = False
+        self.stopping = False
+        self.restarts = 0
+        self.stderr_buffer = b''
+
+    def start(self):
+        if self.proc is not None or self.stopping: return
+        self.proc = QProcess()
+        self.proc.setReadChannel(QProcess.StandardOutput)
+        self.proc.started.connect(lambda: self.started.emit(self.proc.processId()))
+        self.proc.readyReadStandardOutput.connect(self.read_stdout)
+        self.proc.readyReadStandardError.connect(self.read_stderror)
+        self.proc.finished.connect(self.process_finished)
+        self.proc.start('python3', [self.program])
+
+    def stop(self):
+        self.stopping = True
+        if self.proc is None: return
+        # closing stdin lets the worker leave its command loop
+        self.proc.closeWriteChannel()
+        if not self.proc.waitForFinished(1000):
+            self.proc.terminate()
+
+    def send(self, cmd, parms):
+        if self.busy or self.proc is None or self.proc.state() != QProcess.Running:
+            return None
+        self.request_id += 1
+        self.busy = True
+        request = json.dumps({'id': self.request_id, 'cmd': cmd, 'parms': parms}) + '\n'
+        self.proc.write(bytes(request, 'utf-8'))
+        return self.request_id
+
+    # a running job checks for a cancel request between features
+    def cancel(self):
+        if not self.busy or self.proc is None: return
+        request = json.dumps({'id': self.request_id, 'cmd': 'cancel'}) + '\n'
+        self.proc.write(bytes(request, 'utf-8'))
+
+    def read_stdout(self):
+        while self.proc.canReadLine():
+            line = bytes(self.proc.readLine()).decode('utf-8', 'replace').rstrip()
+            if not line: continue
+            try:
+                message = json.loads(line)
+            except ValueError:
+                message = None
+            # anything that is not a reply, such as a print from a probe routine, goes to the log
+            if not isinstance(message, dict):
+                self.reply.emit('LOG', line)
+                continue
+            # replies to a request that was abandoned are dropped
+            if message.get('id') not in (None, self.request_id): continue
+            kind = message.get('type')
+            if kind == 'READY':
+                LOG.debug(f"Probe worker ready with PID {self.proc.processId()}")
+                continue
+            if kind == 'DONE':
+                self.busy = False
+                self.restarts = 0
+            self.reply.emit(kind, message.get('data'))
+
+    def read_stderror(self):
+        self.stderr_buffer += bytes(self.proc.readAllStandardError())
+        *lines, self.stderr_buffer = self.stderr_buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                self.reply.emit('LOG', line.decode('utf-8', 'replace'))
+
+    def process_finished(self, exitCode, exitStatus):
+        LOG.debug(f"Probe worker finished - exitCode {exitCode} exitStatus {exitStatus}")
+        self.proc = None
+        self.stderr_buffer = b''
+        if self.busy:
+            self.busy = False
+            self.reply.emit('ERROR', 'Probe worker stopped during a probe routine')
+            self.reply.emit('DONE', None)
+        if self.stopping: return
+        if self.restarts >= MAX_RESTARTS:
+            self.reply.emit('ERROR', 'Probe worker keeps stopping, it will not be restarted')
+            return
+        self.restarts += 1
+        QTimer.singleShot(RESTART_DELAY, self.start)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+#    Spindle at-speed detection from sampled speed feedback.
+
+#    Copyright (C) 2026 Jim Sloot <persei802@gmail.com>
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation, version 2.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    General Public License for more details.
+
+#    The speed feedback is only read a few times per second. Between reads the speed is
+#    extrapolated along the measured ramp, so at-speed is raised when the spindle arrives
+#    instead of at the next read after it arrived.
+
+
+class SpeedEstimator:
+    def __init__(self, tolerance=0.02, hysteresis=0.01, horizon=0.15, smoothing=0.5):
+        self.tolerance = tolerance # fraction of the commanded speed
+        self.hysteresis = hysteresis # extra fraction allowed before at-speed is dropped
+        self.horizon = horizon # longest time in seconds a sample is extrapolated
+        self.smoothing = smoothing # weight of the newest rate in the ramp estimate
+        self.speed = None
+        self.time = None
+        self.rate = None # rpm/s
+        self.locked = False
+
+    def sample(self, speed, now):
+        if self.time is not None and now > self.time:
+            rate = (speed - self.speed) / (now - self.time)
+            # a change of direction starts a new ramp
+            if self.rate is None or rate * self.rate <= 0:
+                self.rate = rate
+            else:
+                self.rate += self.smoothing * (rate - self.rate)
+        self.speed = speed
+        self.time = now
+
+    # a new speed command has to settle within the tolerance again
+    def new_target(self):
+        self.locked = False
+
+    def predict(self, target, now):
+        if self.time is None: return None
+        error = target - self.speed
+        # only extrapolate a ramp that is heading for the target
+        if not self.rate or error * self.rate <= 0: return self.speed
+        step = self.rate * min(now - self.time, self.horizon)
+        # the drive stops at its setpoint
+        if abs(step) > abs(error): return target
+        return self.speed + step
+
+    def at_speed(self, target, now):
+        speed = self.predict(target, now)
+        if target == 0 or speed is None:
+            self.locked = False
+            return False
+        band = self.tolerance + (self.hysteresis if self.locked else 0)
+        self.locked = abs(target - speed) <= band * abs(target)
+        return self.locked
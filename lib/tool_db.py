@@ -19,7 +19,7 @@ from PyQt5 import uic
 from PyQt5.QtSql import QSqlQuery, QSqlDatabase
 from PyQt5.QtWidgets import QWidget, QFileDialog, QLineEdit, QTreeWidget, QTreeWidgetItem, QMenu
 from PyQt5.QtGui import QPixmap, QDoubleValidator, QFont, QCursor
-from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal
+from PyQt5.QtCore import Qt, QObject, QTimer, QCoreApplication, pyqtSignal
 
 from qtvcp import logger
 from qtvcp.core import Action, Status, Info, Path, Tool
@@ -39,6 +39,8 @@ LOG.setLevel(logger.INFO) # One of DEBUG, INFO, WARNING, ERROR, CRITICAL
 
 VERSION = '2.0'
 DB_NAME = 'tool_database.db'
+# delay before time in spindle updates are written (msec)
+TIME_WRITE_DELAY = 2000
 HERE = os.path.dirname(os.path.abspath(__file__))
 DEFAULT =  0
 WARNING =  1
@@ -122,6 +124,17 @@ class SqlAgent(QObject):
         self.tree.setSortingEnabled(True)
         self.group_items = {}
         self.tool_items = {}
+        # prepared queries, keyed by their sql text
+        self.queries = {}
+        # tool times waiting to be written, tool number: time
+        self.pending_times = {}
+        self.time_timer = QTimer(self)
+        self.time_timer.setSingleShot(True)
+        self.time_timer.timeout.connect(self.flush_tool_times)
+        # times still waiting when the application quits are written then
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.flush_tool_times)
         self.tree.item_moved.connect(self.update_item_group)
 
     def create_connection(self):
@@ -130,9 +143,48 @@ class SqlAgent(QObject):
         if not db.open():
             LOG.debug(f"Database Error: {db.lastError().databaseText()}")
             return False
-        QSqlQuery().exec_("PRAGMA foreign_keys = ON")
+        query = QSqlQuery()
+        # WAL with synchronous NORMAL only syncs at checkpoints, not on every commit
+        for pragma in ["PRAGMA foreign_keys = ON", "PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL"]:
+            if not query.exec_(pragma):
+                LOG.debug(f"{pragma} failed: {query.lastError().text()}")
         return db.tables()
 
+    # schema changes after the tables were created, PRAGMA user_version holds the last one applied
+    def migrate_schema(self):
+        migrations = [
+            ["CREATE INDEX IF NOT EXISTS tools_group_id ON tools(group_id)",
+             "CREATE INDEX IF NOT EXISTS params_material_id ON params(material_id)"]]
+        query = QSqlQuery()
+        if not (query.exec_("PRAGMA user_version") and query.next()):
+            LOG.debug(f"Read schema version failed: {query.lastError().text()}")
+            return
+        version = query.value(0)
+        query.finish()
+        db = QSqlDatabase.database()
+        for number, statements in enumerate(migrations[version:], version + 1):
+            db.transaction()
+            for sql in statements + [f"PRAGMA user_version = {number}"]:
+                if not query.exec_(sql):
+                    LOG.debug(f"Schema migration {number} failed: {query.lastError().text()}")
+                    db.rollback()
+                    return
+            db.commit()
+            LOG.debug(f"Tool database schema migrated to version {number}")
+
+    def prepared(self, sql, *values):
+        query = self.queries.get(sql)
+        if query is None:
+            query = QSqlQuery()
+            if not query.prepare(sql):
+                LOG.debug(f"Prepare query failed: {query.lastError().text()}")
+            self.queries[sql] = query
+        # release the result of the previous run
+        query.finish()
+        for i, value in enumerate(values):
+            query.bindValue(i, value)
+        return query
+
     def create_tool_table(self):
         query = QSqlQuery()
         query.prepare('''
@@ -199,70 +251,93 @@ class SqlAgent(QObject):
         else:
             LOG.debug(f"Create params table error: {query.lastError().text()}")
 
+    # one joined query fetches every group, tool and material
+    # items are built detached and added to the tree in one call
     def build_tree(self):
+        self.tree.setUpdatesEnabled(False)
+        self.tree.setSortingEnabled(False)
         self.tree.clear()
-        # create group items
-        query = QSqlQuery("SELECT id, NAME FROM groups")
-        while query.next():
-            group_id = query.value(0)
-            group_name = query.value(1)
-            group_item = self.create_group_item(group_name, group_id)
-            self.populate_tools(group_id)
-        self.tree.sortItems(0, Qt.AscendingOrder)
-        self.tree.expandAll()
-
-    def populate_tools(self, group_id):
-        query = QSqlQuery()
-        query.prepare("SELECT TOOL, NAME FROM tools WHERE group_id=?")
-        query.addBindValue(group_id)
-        query.exec_()
-        while query.next():
-            tool_num = query.value(0)
-            tool_name = query.value(1)
-            tool_item = self.create_tool_item(group_id, tool_num, tool_name)
-            self.populate_materials(tool_item, tool_num)
-
-    def populate_materials(self, parent, tool_num):
+        self.group_items = {}
+        self.tool_items = {}
         query = QSqlQuery()
-        query.prepare("""
+        query.setForwardOnly(True)
+        if not query.exec_("""
             SELECT
+                groups.id,
+                groups.NAME,
+                tools.TOOL,
+                tools.NAME,
                 materials.id,
                 materials.NAME
-            FROM params
-            JOIN materials ON materials.id = params.material_id
-            WHERE params.tool_no = ?
-            """)
-        query.addBindValue(tool_num)
-        if not query.exec_():
-            LOG.debug(f"SELECT material params failed: {query.lastError().text()}")
-            return None
+            FROM groups
+            LEFT JOIN tools ON tools.group_id = groups.id
+            LEFT JOIN params ON params.tool_no = tools.TOOL
+            LEFT JOIN materials ON materials.id = params.material_id
+            """):
+            LOG.debug(f"SELECT tool tree failed: {query.lastError().text()}")
+        hidden = []
         while query.next():
-            material_id = query.value(0)
-            material = query.value(1)
-            material_item = self.create_material_item(parent, material, material_id)
+            group_id = query.value(0)
+            group_item = self.group_items.get(group_id)
+            if group_item is None:
+                group_item = self.new_group_item(query.value(1), group_id)
+            # a group without tools or a tool without materials returns NULL columns
+            if not query.isNull(2):
+                tool_num = query.value(2)
+                tool_item = self.tool_items.get(tool_num)
+                if tool_item is None:
+                    tool_item = self.new_tool_item(tool_num, query.value(3))
+                    group_item.addChild(tool_item)
+                if not query.isNull(4):
+                    material_id = query.value(4)
+                    material_item = self.new_material_item(query.value(5), material_id)
+                    tool_item.addChild(material_item)
+                    if query.value(5) == 'None': hidden.append(material_item)
+        self.tree.addTopLevelItems(list(self.group_items.values()))
+        # items can only be hidden once they are in the tree
+        for item in hidden:
+            item.setHidden(True)
+        self.tree.setSortingEnabled(True)
+        self.tree.sortItems(0, Qt.AscendingOrder)
+        self.tree.expandAll()
+        self.tree.setUpdatesEnabled(True)
 
-    def create_group_item(self, name, group_id):
-        group_item = QTreeWidgetItem(self.tree)
+    def new_group_item(self, name, group_id):
+        group_item = QTreeWidgetItem()
         group_item.setText(0, name)
         group_item.setData(0, grpRole, group_id)
         group_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsDropEnabled)
         self.group_items[group_id] = group_item
         return group_item
 
-    def create_tool_item(self, group_id, tno, name):
-        parent = self.group_items[group_id]
-        tool_item = QTreeWidgetItem(parent)
+    def new_tool_item(self, tno, name):
+        tool_item = QTreeWidgetItem()
         tool_item.setText(0, f'T{tno} - {name}')
         tool_item.setData(0, tnoRole, tno)
         tool_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsDragEnabled)
         self.tool_items[tno] = tool_item
         return tool_item
 
-    def create_material_item(self, parent, name, material_id):
-        material_item = QTreeWidgetItem(parent)
+    def new_material_item(self, name, material_id):
+        material_item = QTreeWidgetItem()
         material_item.setText(0, name)
         material_item.setData(0, midRole, material_id)
         material_item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+        return material_item
+
+    def create_group_item(self, name, group_id):
+        group_item = self.new_group_item(name, group_id)
+        self.tree.addTopLevelItem(group_item)
+        return group_item
+
+    def create_tool_item(self, group_id, tno, name):
+        tool_item = self.new_tool_item(tno, name)
+        self.group_items[group_id].addChild(tool_item)
+        return tool_item
+
+    def create_material_item(self, parent, name, material_id):
+        material_item = self.new_material_item(name, material_id)
+        parent.addChild(material_item)
         if name == 'None':
             material_item.setHidden(True)
         return material_item
@@ -277,40 +352,35 @@ class SqlAgent(QObject):
             if idx >= 0:
                 self.tree.takeTopLevelItem(idx)
             self.group_items.pop(group_id)
-            query = QSqlQuery(f"DELETE FROM groups WHERE id={group_id}")
+            query = self.prepared("DELETE FROM groups WHERE id=?", group_id)
+            if not query.exec_():
+                LOG.debug(f"Delete group failed: {query.lastError().text()}")
         elif tool_no:
             item.parent().removeChild(item)
             self.tool_items.pop(tool_no)
             self.delete_tool(tool_no)
         elif material_id:
             item.parent().removeChild(item)
-            query = QSqlQuery(f'DELETE FROM params WHERE tool_no={tno} AND material_id={material_id}')
+            query = self.prepared("DELETE FROM params WHERE tool_no=? AND material_id=?", tno, material_id)
+            if not query.exec_():
+                LOG.debug(f"Delete material params failed: {query.lastError().text()}")
         else: return False
         return True
 
     def update_item_group(self, data):
         tool_no, group_id = data
-        query = QSqlQuery()
-        query.prepare("UPDATE tools SET group_id=? WHERE TOOL=?")
-        query.addBindValue(group_id)
-        query.addBindValue(tool_no)
+        query = self.prepared("UPDATE tools SET group_id=? WHERE TOOL=?", group_id, tool_no)
         if not query.exec_():
             LOG.debug(f"Update tool group failed: {query.lastError().text()}")
 
 ## CRUD operations
     def add_tool_to_table(self, group_id, tno, tlo, dia, name):
-        query = QSqlQuery()
-        query.prepare("""
+        query = self.prepared("""
             INSERT INTO tools
                 (group_id, TOOL, NAME, TLO, DIA)
             VALUES (?, ?, ?, ?, ?)
             ON CONFLICT(TOOL) DO NOTHING
-        """)
-        query.addBindValue(group_id)
-        query.addBindValue(tno)
-        query.addBindValue(name)
-        query.addBindValue(tlo)
-        query.addBindValue(dia)
+        """, group_id, tno, name, tlo, dia)
         if not query.exec_():
             LOG.debug(f"Add tool failed: {query.lastError().text()}")
             return None
@@ -320,20 +390,70 @@ class SqlAgent(QObject):
         return True
 
     def delete_tool(self, tno):
-        query = QSqlQuery("DELETE FROM tools WHERE TOOL=?")
-        query.addBindValue(tno)
+        self.pending_times.pop(tno, None)
+        query = self.prepared("DELETE FROM tools WHERE TOOL=?", tno)
         if not query.exec_():
             LOG.debug(f"Delete tool failed: {query.lastError().text()}")
             return None
         return True
 
-    def add_material_to_table(self, material):
+    # bring the tools table in line with the linuxcnc tool table
+    # tools is a dictionary of tool number: (tlo, dia, name)
+    # all inserts, deletes and updates are done in one transaction
+    def sync_tools(self, group_id, tools):
+        db_tools = {}
         query = QSqlQuery()
-        query.prepare("""
+        query.setForwardOnly(True)
+        if not query.exec_("SELECT TOOL, TLO, DIA, NAME FROM tools"):
+            LOG.debug(f"SELECT tools failed: {query.lastError().text()}")
+            return None
+        while query.next():
+            db_tools[query.value(0)] = (query.value(1), query.value(2), query.value(3))
+        added = [tno for tno in tools if tno not in db_tools]
+        deleted = [tno for tno in db_tools if tno not in tools]
+        updated = [tno for tno in tools if tno in db_tools and tools[tno] != db_tools[tno]]
+        if not (added or deleted or updated): return added, deleted, updated
+        db = QSqlDatabase.database()
+        db.transaction()
+        batches = [("INSERT INTO tools (group_id, TOOL, TLO, DIA, NAME) VALUES (?, ?, ?, ?, ?)",
+                    [[group_id] * len(added), added] + [list(col) for col in zip(*[tools[tno] for tno in added])]),
+                   ("DELETE FROM tools WHERE TOOL=?", [deleted]),
+                   ("UPDATE tools SET TLO=?, DIA=?, NAME=? WHERE TOOL=?",
+                    [list(col) for col in zip(*[tools[tno] for tno in updated])] + [updated])]
+        for sql, columns in batches:
+            if not columns[-1]: continue
+            query = QSqlQuery()
+            query.prepare(sql)
+            for col in columns:
+                query.addBindValue(col)
+            if not query.execBatch():
+                LOG.debug(f"Sync tools failed: {query.lastError().text()}")
+                db.rollback()
+                return None
+        if not db.commit():
+            LOG.debug(f"Sync tools commit failed: {db.lastError().text()}")
+            db.rollback()
+            return None
+        # patch the tree with the changes
+        for tno in added:
+            self.create_tool_item(group_id, tno, tools[tno][2])
+        for tno in deleted:
+            self.pending_times.pop(tno, None)
+            item = self.tool_items.pop(tno, None)
+            if item is not None:
+                item.parent().removeChild(item)
+        # tools not shown in the tree are picked up by the next build_tree
+        for tno in updated:
+            item = self.tool_items.get(tno)
+            if item is not None:
+                item.setText(0, f'T{tno} - {tools[tno][2]}')
+        return added, deleted, updated
+
+    def add_material_to_table(self, material):
+        query = self.prepared("""
             INSERT INTO materials (NAME) VALUES(?)
             ON CONFLICT (NAME) DO UPDATE SET NAME=excluded.NAME
-            """)
-        query.addBindValue(material)
+            """, material)
         if not query.exec_():
             LOG.debug(f"Add material error: {query.lastError().text()}")
             return None
@@ -341,9 +461,7 @@ class SqlAgent(QObject):
         return material_id
 
     def add_group_to_table(self, group):
-        query = QSqlQuery()
-        query.prepare("INSERT INTO groups (NAME) VALUES(?)")
-        query.addBindValue(group)
+        query = self.prepared("INSERT INTO groups (NAME) VALUES(?)", group)
         if not query.exec_():
             LOG.debug(f"Add group failed: {query.lastError().text()}")
             return None
@@ -352,18 +470,14 @@ class SqlAgent(QObject):
         return group_id
 
     def remove_material(self, material):
-        query = QSqlQuery()
-        query.prepare("DELETE FROM materials WHERE NAME=?")
-        query.addBindValue(material)
+        query = self.prepared("DELETE FROM materials WHERE NAME=?", material)
         if not query.exec_():
             LOG.debug(f"Delete materials failed: {query.lastError().text()}")
             return None
         return True
 
     def get_tool_data(self, tool_no):
-        query = QSqlQuery()
-        query.prepare("SELECT * FROM tools WHERE TOOL=?")
-        query.addBindValue(tool_no)
+        query = self.prepared("SELECT * FROM tools WHERE TOOL=?", tool_no)
         if query.exec_() and query.next():
             rtn_dict = {
                 'tool':   query.value(0),
@@ -373,7 +487,7 @@ class SqlAgent(QObject):
                 'dia':    query.value(4),
                 'flutes': query.value(5),
                 'length': query.value(6),
-                'time':   query.value(7),
+                'time':   self.pending_times.get(tool_no, query.value(7)),
                 'icon':   query.value(8),
                 'mfg':    query.value(9)}
             return rtn_dict
@@ -381,10 +495,7 @@ class SqlAgent(QObject):
         return None
 
     def get_material_data(self, tool_no, material_id):
-        query = QSqlQuery()
-        query.prepare("SELECT * FROM params WHERE tool_no=? AND material_id=?")
-        query.addBindValue(tool_no)
-        query.addBindValue(material_id)
+        query = self.prepared("SELECT * FROM params WHERE tool_no=? AND material_id=?", tool_no, material_id)
         if query.exec_() and query.next():
             rtn_dict = {
                 'tool_no':     query.value(0),
@@ -404,9 +515,7 @@ class SqlAgent(QObject):
         return None
 
     def get_material_id(self, name):
-        query = QSqlQuery()
-        query.prepare("SELECT id FROM materials WHERE NAME=?")
-        query.addBindValue(name)
+        query = self.prepared("SELECT id FROM materials WHERE NAME=?", name)
         if query.exec_() and query.next():
             return query.value(0)
         else:
@@ -429,12 +538,7 @@ class SqlAgent(QObject):
 
     # this updates columns Z, DIA and Comment from the linuxcnc tool table
     def update_tool_table(self, tool_no, data):
-        query = QSqlQuery()
-        query.prepare("UPDATE tools SET TLO=? , DIA=?, NAME=? WHERE TOOL = ?")
-        query.addBindValue(data[0])
-        query.addBindValue(data[1])
-        query.addBindValue(data[2])
-        query.addBindValue(tool_no)
+        query = self.prepared("UPDATE tools SET TLO=? , DIA=?, NAME=? WHERE TOOL = ?", data[0], data[1], data[2], tool_no)
         if not query.exec_():
             LOG.debug(f"Update tool table error: {query.lastError().text()}")
             return None
@@ -447,21 +551,18 @@ class SqlAgent(QObject):
 
     # this updates a table row with data from the UI tool data values
     def update_tool_data(self, data, tool_no):
-        query = QSqlQuery()
-        query.prepare("""
+        query = self.prepared("""
             UPDATE tools
             SET FLUTES=?, LENGTH=?, TIME=?, ICON=?, MFG=?
             WHERE TOOL=?
-        """)
-        for item in data:
-            query.addBindValue(item)
-        query.addBindValue(tool_no)
+        """, *data, tool_no)
+        # this also writes the time in spindle
+        self.pending_times.pop(tool_no, None)
         if not query.exec_():
             LOG.debug(f"Update tool data error: {query.lastError().text()}")
         
     def update_material_data(self, data, tool_no, material_id):
-        query = QSqlQuery()
-        query.prepare("""
+        query = self.prepared("""
             INSERT INTO params (
                 tool_no,
                 material_id,
@@ -476,11 +577,7 @@ class SqlAgent(QObject):
                 FEED=excluded.FEED,
                 STEPOVER=excluded.STEPOVER,
                 DEPTH=excluded.DEPTH
-        """)
-        query.addBindValue(tool_no)
-        query.addBindValue(material_id)
-        for value in data:
-            query.addBindValue(value)
+        """, tool_no, material_id, *data)
         if not query.exec_():
             LOG.debug(f"Update material Error: {query.lastError().text()}")
             return None
@@ -490,10 +587,7 @@ class SqlAgent(QObject):
         return query.lastInsertId()
 
     def update_tool_number(self, tool_no, new):
-        query = QSqlQuery()
-        query.prepare("UPDATE tools SET TOOL=? WHERE TOOL=?")
-        query.addBindValue(new)
-        query.addBindValue(tool_no)
+        query = self.prepared("UPDATE tools SET TOOL=? WHERE TOOL=?", new, tool_no)
         if not query.exec_():
             LOG.debug(f"Update tool number error: {query.lastError().text()}")
             return False
@@ -505,15 +599,29 @@ class SqlAgent(QObject):
         item.setText(0, new_name)
         self.tool_items[new] = item
         self.tool_items.pop(tool_no)
+        if tool_no in self.pending_times:
+            self.pending_times[new] = self.pending_times.pop(tool_no)
         return True
 
+    # time in spindle is written behind, many updates end up in one transaction
     def update_tool_time(self, tool_no, time):
-        query = QSqlQuery()
-        query.prepare("UPDATE tools SET TIME=? WHERE TOOL=?")
-        query.addBindValue(time)
-        query.addBindValue(tool_no)
-        if not query.exec_():
+        self.pending_times[tool_no] = time
+        self.time_timer.start(TIME_WRITE_DELAY)
+        return True
+
+    def flush_tool_times(self):
+        self.time_timer.stop()
+        if not self.pending_times: return True
+        times, self.pending_times = self.pending_times, {}
+        db = QSqlDatabase.database()
+        db.transaction()
+        query = self.prepared("UPDATE tools SET TIME=? WHERE TOOL=?", list(times.values()), list(times.keys()))
+        if not query.execBatch() or not db.commit():
             LOG.debug(f"Update tool time error: {query.lastError().text()}")
+            db.rollback()
+            # keep the times for the next flush, newer updates take precedence
+            times.update(self.pending_times)
+            self.pending_times = times
             return None
         return True
 
@@ -579,6 +687,7 @@ class Tool_Database(QWidget):
         if 'params' not in tables:
             LOG.debug("Creating parameters table")
             self.agent.create_params_table()
+        self.agent.migrate_schema()
         LOG.info(f"Using TOOL DATABASE version {VERSION}")
 
         self.set_unit_labels()
@@ -593,7 +702,7 @@ class Tool_Database(QWidget):
         self.default_style = self.lineEdit_rpm.styleSheet()
 
     def closing_cleanup__(self):
-        pass
+        self.agent.flush_tool_times()
 
     def init_comboboxes(self):
         # icon combobox
@@ -625,21 +734,13 @@ class Tool_Database(QWidget):
     def load_tool_table(self, tlist):
         LOG.info("Updating tool database")
         group_id = self.agent.get_group_id('Misc')
-        tools = []
-        tool_table = TOOL.GET_TOOL_ARRAY()
-        # look for tools to add
-        db_list = self.agent.get_all_tools()
-        for line in tool_table:
-            tools.append(line[0])
-            if line[0] in db_list: continue
-            LOG.debug(f'Adding tool {line[0]}')
-            if self.agent.add_tool_to_table(group_id, line[0], line[4], line[11], line[15]):
-                self.agent.create_tool_item(group_id, line[0], line[15])
-        # look for tools to delete
-        for tno in db_list:
-            if tno in tools: continue
-            LOG.debug(f'Deleting tool {tno}')
-            self.delete_tool(tno)
+        tools = {line[0]: (line[4], line[11], line[15]) for line in TOOL.GET_TOOL_ARRAY()}
+        result = self.agent.sync_tools(group_id, tools)
+        if result is None:
+            LOG.error("Tool database sync with tool table failed")
+            return
+        added, deleted, updated = result
+        LOG.debug(f'Added tools {added}, deleted tools {deleted}, updated tools {updated}')
         LOG.info("Successfully built tool tree")
 
 ## callbacks from widgets
@@ -1048,9 +1149,52 @@ class Testing:
         result = self.module.run()
         print(f'Test result: {result}')
         
+# time build_tree on generated databases
+# python3 tool_db.py benchmark [number of tools ...]
+def benchmark(sizes):
+    import tempfile
+    import shutil
+    import time
+    import random
+    for size in sizes:
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, DB_NAME)
+        agent = SqlAgent(path, ToolTree())
+        agent.create_connection()
+        agent.create_group_table()
+        agent.create_material_table()
+        agent.create_tool_table()
+        agent.create_params_table()
+        con = sqlite3.connect(path)
+        groups = max(1, size // 100)
+        con.executemany("INSERT INTO groups (NAME) VALUES (?)", [(f'Group {i}',) for i in range(groups)])
+        con.executemany("INSERT INTO materials (NAME) VALUES (?)", [(f'Material {i}',) for i in range(20)])
+        con.executemany("INSERT INTO tools (TOOL, NAME, group_id) VALUES (?, ?, ?)",
+                        [(tno, f'Tool {tno}', random.randint(1, groups)) for tno in range(1, size + 1)])
+        con.executemany("INSERT OR IGNORE INTO params (tool_no, material_id) VALUES (?, ?)",
+                        [(tno, random.randint(1, 20)) for tno in range(1, size + 1) for _ in range(3)])
+        con.commit()
+        con.close()
+        start = time.perf_counter()
+        agent.build_tree()
+        elapsed = time.perf_counter() - start
+        print(f"{size:6d} tools  {groups:4d} groups  build_tree {elapsed * 1000:8.1f} ms")
+        agent.tree.clear()
+        # the cached queries hold the connection open, drop them before removing it
+        agent.queries.clear()
+        db = QSqlDatabase.database()
+        name = db.connectionName()
+        db.close()
+        del db
+        QSqlDatabase.removeDatabase(name)
+        shutil.rmtree(folder, ignore_errors=True)
+
 if __name__ == "__main__":
     from PyQt5.QtWidgets import QApplication
     app = QApplication(sys.argv)
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark([int(n) for n in sys.argv[2:]] or [1000, 5000, 10000])
+        sys.exit(0)
     test = Testing()
     test.run_test()
     sys.exit( app.exec_() )
@@ -18,16 +18,21 @@
 import sys
 import os
 import hal
-import json
 
 from PyQt5 import QtGui, QtCore, QtWidgets, uic
-from PyQt5.QtCore import QProcess, QEvent, Qt
+from PyQt5.QtCore import QEvent, Qt
 from PyQt5.QtWidgets import QDialogButtonBox, QAbstractSlider
 
 from qtvcp.widgets.widget_baseclass import _HalWidgetBase
 from qtvcp.core import Status, Action, Info, Path
 from qtvcp.widgets.dialogMixin import GeometryMixin
 from qtvcp import logger
+try:
+    from .probe_worker import ProbeWorker
+    from .probe_job import ProbeJob
+except ImportError:
+    from lib.probe_worker import ProbeWorker
+    from lib.probe_job import ProbeJob
 # Instantiate the libraries with global reference
 # STATUS gives us status messages from linuxcnc
 # LOG is for running code logging
@@ -50,7 +55,10 @@ ICONPATH = os.path.join(PATH.find_image_path(), 'probe_icons')
 class VersaProbe(QtWidgets.QWidget, _HalWidgetBase):
     def __init__(self, parent=None):
         super(VersaProbe, self).__init__(parent)
-        self.proc = None
+        self.worker = ProbeWorker(SUBPROGRAM, self)
+        self.worker.started.connect(self.process_started)
+        self.worker.reply.connect(self.parse_reply)
+        self.job = ProbeJob(self)
         self.tool_diameter = None
         self.tool_number = None
         STATUS.connect('tool-info-changed', lambda w, data: self._tool_info(data))
@@ -81,6 +89,7 @@ class VersaProbe(QtWidgets.QWidget, _HalWidgetBase):
             self['input_' + i].setValidator(self.valid)
         # button connections
         self.btn_help.clicked.connect(self.help_clicked)
+        self.btn_probe_job.clicked.connect(self.job.show)
         self.inside_buttonGroup.buttonClicked.connect(self.probe_btn_clicked)
         self.outside_buttonGroup.buttonClicked.connect(self.probe_btn_clicked)
         self.skew_buttonGroup.buttonClicked.connect(self.probe_btn_clicked)
@@ -222,9 +231,12 @@ class VersaProbe(QtWidgets.QWidget, _HalWidgetBase):
         self.input_tool_probe_height.textChanged.connect(self.update_probe_height_pin)
         self.input_tool_block_height.textChanged.connect(self.update_block_height_pin)
         self.input_latch_return_dist.textChanged.connect(self.update_latch_return_dist_pin)
+        # the probe subprogram is started once and kept running
+        self.worker.start()
 
     # when qtvcp closes this gets called
     def _hal_cleanup(self):
+        self.worker.stop()
         if self.PREFS_:
             LOG.debug('Saving Versa probe data to preference file.')
             self.PREFS_.putpref( "ps_searchvel", float(self.input_search_vel.text()), float, 'VERSA_PROBE_OPTIONS')
@@ -276,49 +288,59 @@ class VersaProbe(QtWidgets.QWidget, _HalWidgetBase):
 #############################################
 # process control
 #############################################
-    def start_process(self):
-        self.proc = QProcess()
-        self.proc.setReadChannel(QProcess.StandardOutput)
-        self.proc.started.connect(self.process_started)
-        self.proc.readyReadStandardOutput.connect(self.read_stdout)
-        self.proc.readyReadStandardError.connect(self.read_stderror)
-        self.proc.finished.connect(self.process_finished)
-        self.proc.start('python3 {}'.format(SUBPROGRAM))
-
-    def start_probe(self, cmd):
-        if self.proc is not None:
+    def start_probe(self, cmd, parms=None):
+        if parms is None: parms = self.send_dict
+        if self.worker.busy:
             LOG.info("Probe Routine processor is busy")
-            return
-        self.start_process()
-        string_to_send = cmd + '$' + json.dumps(self.send_dict) + '\n'
-        #print("String to send ", string_to_send)
+            return False
         STATUS.block_error_polling()
-        self.proc.writeData(bytes(string_to_send, 'utf-8'))
+        if self.worker.send(cmd, parms) is None:
+            STATUS.unblock_error_polling()
+            LOG.error("Probe Routine processor is not running")
+            return False
+        return True
 
-    def process_started(self):
-        LOG.info("Versa_Probe started with PID {}\n".format(self.proc.processId()))
+    # the current parameters are the defaults for every feature of the job
+    def start_job(self, entries, safe_z):
+        self.get_parms()
+        return self.start_probe('run_job', {'parms': self.send_dict, 'entries': entries, 'safe_z': safe_z})
 
-    def read_stdout(self):
-        qba = self.proc.readAllStandardOutput()
-        line = qba.data()
-        self.parse_input(line)
+    def job_status(self, msg, level):
+        if not self.set_statusbar(msg, level):
+            LOG.info(msg)
 
-    def read_stderror(self):
-        qba = self.proc.readAllStandardError()
-        line = qba.data()
-        self.parse_input(line)
+    def process_started(self, pid):
+        LOG.info("Versa_Probe started with PID {}\n".format(pid))
 
-    def process_finished(self, exitCode, exitStatus):
-        LOG.info(("Probe Process finished - exitCode {} exitStatus {}".format(exitCode, exitStatus)))
-        self.proc = None
-        STATUS.unblock_error_polling()
+    def parse_reply(self, kind, data):
+        if kind == "ERROR INFO":
+            ACTION.SET_ERROR_MESSAGE(data)
+        elif kind == "ERROR":
+            LOG.error(data)
+            STATUS.unblock_error_polling()
+            ACTION.SET_ERROR_MESSAGE('Versa Probe process finished in error')
+        elif kind == "COMPLETE":
+            STATUS.unblock_error_polling()
+            LOG.info("Versa Probing routine completed without errors")
+            self.show_results(data)
+        elif kind == "HISTORY":
+            if not self.set_statusbar(data,1):
+                STATUS.emit('update-machine-log', data, 'TIME')
+        elif kind == "RESULT":
+            self.job.add_result(data)
+        elif kind == "JOB":
+            self.job_status("Probe job finished {} of {} features".format(data['done'], data['total']), 0)
+        elif kind == "DONE":
+            STATUS.unblock_error_polling()
+            self.job.job_finished()
+        elif kind == "LOG":
+            self.parse_log(data)
 
-    def parse_input(self, line):
-        line = line.decode("utf-8")
+    # lines from the subprogram that are not replies, mostly its logging output on stderr
+    def parse_log(self, line):
         if "ERROR INFO" in line:
             ACTION.SET_ERROR_MESSAGE(line)
         elif "ERROR" in line:
-            #print(line)
             STATUS.unblock_error_polling()
             ACTION.SET_ERROR_MESSAGE('Versa Probe process finished in error')
         elif "PROBE_ROUTINES" in line:
@@ -326,15 +348,6 @@ class VersaProbe(QtWidgets.QWidget, _HalWidgetBase):
                 print(line)
         elif "INFO" in line:
             pass
-        elif "COMPLETE" in line:
-            STATUS.unblock_error_polling()
-            LOG.info("Versa Probing routine completed without errors")
-            return_data = line.rstrip().split('$')
-            data = json.loads(return_data[1])
-            self.show_results(data)
-        elif "HISTORY" in line:
-            if not self.set_statusbar(line,1):
-                STATUS.emit('update-machine-log', line, 'TIME')
         elif "DEBUG" in line:
             pass
         else:
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+#    A simulated Huanyang GT-series VFD for testing hy_gt_vfd.py without a drive.
+
+#    Copyright (C) 2026 Jim Sloot <persei802@gmail.com>
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation, version 2.
+
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    General Public License for more details.
+
+#    SimulatedVFD has the same calls as the pymodbus ModbusSerialClient used by hy_gt_vfd.py,
+#    so the component runs against it with the --sim option.
+#    Run on its own to benchmark the modbus loop in simulated time:
+#    python3 vfd_sim.py benchmark [-r rate] [--period s] [--retries n] [--delay s] [--error-rate e]
+
+import time
+import random
+import argparse
+from speed_estimator import SpeedEstimator
+
+# drive registers
+CONTROL = 0x1000
+SETPOINT = 0x2000
+VOLTAGE = 0x3003
+CURRENT = 0x3004
+SPEED = 0x3005
+FAULT = 0x5000
+# control register values
+RUN_FWD = 1
+RUN_REV = 2
+STOP = 5
+# bytes on the wire for each transaction, including the 2 byte CRC
+WRITE_BYTES = 8 + 8
+READ_BYTES = 8 + 5 # plus 2 per register read
+
+
+class SimResponse:
+    def __init__(self, registers=None, error=None):
+        self.registers = registers
+        self.error = error
+
+    def isError(self):
+        return self.error is not None
+
+    def __str__(self):
+        return self.error or f"SimResponse {self.registers}"
+
+
+# a clock that only moves when something sleeps, so a benchmark runs as fast as it can
+class VirtualClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SimulatedVFD:
+    def __init__(self, max_speed=24000, baud_rate=38400, accel=8000, decel=8000,
+                 turnaround=0.002, crc_rate=0, drop_rate=0, timeout=1,
+                 clock=time.monotonic, sleep=time.sleep, seed=None):
+        self.max_speed = max_speed
+        self.baud_rate = baud_rate
+        self.accel = accel # rpm/s
+        self.decel = decel
+        self.turnaround = turnaround # seconds the drive takes to answer
+        self.crc_rate = crc_rate # fraction of replies with a bad CRC
+        self.drop_rate = drop_rate # fraction of requests that are never answered
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random.Random(seed)
+        self.connected = False
+        self.control = STOP
+        self.setpoint = 0
+        self.fault_code = 0
+        self.speed = 0.0
+        self.last_update = clock()
+        self.transactions = 0
+        self.errors = 0
+
+    def connect(self):
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def inject_fault(self, code):
+        self.update()
+        self.fault_code = code
+        self.control = STOP
+
+    def clear_fault(self):
+        self.fault_code = 0
+
+    def target_speed(self):
+        if self.fault_code or self.control not in (RUN_FWD, RUN_REV): return 0.0
+        return self.max_speed * self.setpoint / 10000
+
+    # move the spindle speed along its ramp up to the present time
+    def update(self):
+        now = self.clock()
+        dt = now - self.last_update
+        self.last_update = now
+        target = self.target_speed()
+        if self.speed < target:
+            self.speed = min(target, self.speed + self.accel * dt)
+        else:
+            self.speed = max(target, self.speed - self.decel * dt)
+
+    # seconds from now until the speed is within tolerance of the target
+    def settle_time(self, tolerance):
+        self.update()
+        target = self.target_speed()
+        error = abs(target - self.speed) - tolerance * target
+        if error <= 0: return 0.0
+        return error / (self.accel if self.speed < target else self.decel)
+
+    def register(self, addr):
+        if addr == CONTROL: return self.control
+        if addr == SETPOINT: return self.setpoint
+        if addr == VOLTAGE: return int(220 * self.speed / self.max_speed)
+        if addr == CURRENT:
+            # more current while the spindle is still accelerating
+            ramping = self.speed < self.target_speed()
+            return int(10 * self.speed / self.max_speed) + (20 if ramping else 0)
+        if addr == SPEED: return int(self.speed)
+        if addr == FAULT: return self.fault_code
+        return 0
+
+    def transaction(self, nbytes):
+        self.transactions += 1
+        if self.random.random() < self.drop_rate:
+            self.sleep(self.timeout)
+            self.errors += 1
+            return "Modbus Error: No response received"
+        self.sleep(nbytes * 10 / self.baud_rate + self.turnaround)
+        self.update()
+        if self.random.random() < self.crc_rate:
+            self.errors += 1
+            return "Modbus Error: CRC check failed"
+        return None
+
+    def write_register(self, address, value, slave=1):
+        error = self.transaction(WRITE_BYTES)
+        if error is not None: return SimResponse(error=error)
+        if address == CONTROL:
+            self.control = value
+        elif address == SETPOINT:
+            self.setpoint = max(0, min(value, 10000))
+        else:
+            return SimResponse(error=f"Modbus Error: illegal address {hex(address)}")
+        return SimResponse([value])
+
+    def read_holding_registers(self, address, count=1, slave=1):
+        error = self.transaction(READ_BYTES + 2 * count)
+        if error is not None: return SimResponse(error=error)
+        return SimResponse([self.register(addr) for addr in range(address, address + count)])
+
+
+# several simulated drives sharing one bus, requests go to the drive with the matching slave address
+class SimulatedBus:
+    def __init__(self, drives):
+        self.drives = drives
+
+    def connect(self):
+        return all(vfd.connect() for vfd in self.drives.values())
+
+    def close(self):
+        for vfd in self.drives.values():
+            vfd.close()
+
+    def write_register(self, address, value, slave=1):
+        if slave not in self.drives: return SimResponse(error=f"Modbus Error: no reply from slave {slave}")
+        return self.drives[slave].write_register(address, value, slave)
+
+    def read_holding_registers(self, address, count=1, slave=1):
+        if slave not in self.drives: return SimResponse(error=f"Modbus Error: no reply from slave {slave}")
+        return self.drives[slave].read_holding_registers(address, count, slave)
+
+
+## benchmark
+# a stand-in for the hy_gt_vfd.py main loop with the same timing parameters
+class LoopModel:
+    def __init__(self, vfd, clock, tick=0.01, period=0.1, retries=3, delay=80/38400):
+        self.vfd = vfd
+        self.clock = clock
+        self.tick = tick
+        self.period = period
+        self.retries = retries
+        self.delay = delay
+        self.attempts = 0
+        self.failures = 0
+
+    def call(self, func, *args, **kwargs):
+        for i in range(self.retries):
+            self.clock.sleep(self.delay)
+            self.attempts += 1
+            rtn = func(*args, **kwargs)
+            if not rtn.isError(): return rtn
+        self.failures += 1
+        return None
+
+    def start(self, rpm):
+        self.call(self.vfd.write_register, SETPOINT, int(rpm / self.vfd.max_speed * 10000))
+        self.call(self.vfd.write_register, CONTROL, RUN_FWD)
+
+    def stop(self):
+        self.call(self.vfd.write_register, CONTROL, STOP)
+
+    # seconds from the spindle reaching speed until at-speed would be raised
+    # without an estimator at-speed is a fixed tolerance check of the last speed read
+    def at_speed_delay(self, rpm, tolerance=0.02, estimator=None, limit=30):
+        self.start(rpm)
+        if estimator is not None: estimator.new_target()
+        start = self.clock.time()
+        reached = start + self.vfd.settle_time(tolerance)
+        next_read = start
+        speed = None
+        while self.clock.time() - start < limit:
+            self.clock.sleep(self.tick)
+            now = self.clock.time()
+            if now >= next_read:
+                next_read = now + self.period
+                data = self.call(self.vfd.read_holding_registers, address=VOLTAGE, count=3)
+                if data is not None:
+                    speed = data.registers[2]
+                    if estimator is not None: estimator.sample(speed, self.clock.time())
+            if estimator is not None:
+                if estimator.at_speed(rpm, self.clock.time()):
+                    return self.clock.time() - reached
+            elif speed is not None and abs(rpm - speed) <= tolerance * rpm:
+                return self.clock.time() - reached
+        return None
+
+
+def benchmark(period=0.1, retries=3, delay=None, baud_rate=38400, error_rates=(0, 0.01, 0.05, 0.2), count=1000):
+    if delay is None: delay = 80 / baud_rate
+    print(f"baud {baud_rate}  period {period}s  retries {retries}  delay {delay * 1000:.2f}ms")
+    # command throughput with a clean bus
+    clock = VirtualClock()
+    vfd = SimulatedVFD(baud_rate=baud_rate, clock=clock.time, sleep=clock.sleep, seed=1)
+    loop = LoopModel(vfd, clock, period=period, retries=retries, delay=delay)
+    for i in range(count):
+        loop.call(vfd.write_register, SETPOINT, i % 10000)
+    print(f"commands/s            {count / clock.time():8.1f}")
+    # at-speed detection after a start and after speed changes, negative is early
+    for name, estimator in (('fixed', None), ('predicted', SpeedEstimator(horizon=1.5 * period))):
+        clock = VirtualClock()
+        vfd = SimulatedVFD(baud_rate=baud_rate, clock=clock.time, sleep=clock.sleep, seed=1)
+        loop = LoopModel(vfd, clock, period=period, retries=retries, delay=delay)
+        delays = [loop.at_speed_delay(rpm, estimator=estimator) for rpm in (12000, 18000, 24000, 9000)]
+        shown = ' '.join('timeout' if d is None else f"{d * 1000:.0f}" for d in delays)
+        print(f"at-speed delay (ms)   {shown}  {name}")
+    # retries against a noisy bus, half of the errors are lost replies
+    print(f"{'error rate':>10} {'attempts':>9} {'failed':>8} {'reads/s':>9}")
+    for rate in error_rates:
+        clock = VirtualClock()
+        vfd = SimulatedVFD(baud_rate=baud_rate, crc_rate=rate / 2, drop_rate=rate / 2,
+                           clock=clock.time, sleep=clock.sleep, seed=1)
+        loop = LoopModel(vfd, clock, period=period, retries=retries, delay=delay)
+        for i in range(count):
+            loop.call(vfd.read_holding_registers, address=VOLTAGE, count=3)
+        print(f"{rate:>10.2f} {loop.attempts / count:>9.3f} {loop.failures:>8} {count / clock.time():>9.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["benchmark"])
+    parser.add_argument("-r", "--rate", type=int, default=38400, help="baudrate")
+    parser.add_argument("--period", type=float, default=0.1, help="seconds between speed reads")
+    parser.add_argument("--retries", type=int, default=3, help="attempts per transaction")
+    parser.add_argument("--delay", type=float, help="seconds of bus idle before each frame")
+    parser.add_argument("--error-rate", type=float, action="append", help="fraction of failed frames")
+    parser.add_argument("-n", "--count", type=int, default=1000, help="transactions per test")
+    args = parser.parse_args()
+    benchmark(args.period, args.retries, args.delay, args.rate,
+              args.error_rate or (0, 0.01, 0.05, 0.2), args.count)
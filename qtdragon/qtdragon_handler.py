@@ -399,6 +399,8 @@ class HandlerClass:
         self.w.spinBox_duration.setValue(self.w.PREFS_.getpref('Status Timeout', '10', int, 'CUSTOM_FORM_ENTRIES'))
 
     def closing_cleanup__(self):
+        # tool times are written even when there are no preferences to save
+        self.tool_db.closing_cleanup__()
         if not self.w.PREFS_: return
         for checkbox in self.settings_checkboxes:
             self.w.PREFS_.putpref(checkbox.objectName(), checkbox.isChecked(), bool, 'CUSTOM_FORM_ENTRIES')
@@ -419,7 +421,6 @@ class HandlerClass:
 
         # check for closing cleanup methods in imported utilities
         self.setup_utils.closing_cleanup__()
-        self.tool_db.closing_cleanup__()
 
     def init_widgets(self):
         self.w.main_tab_widget.setCurrentIndex(TAB_MAIN)
@@ -19,7 +19,7 @@ import shutil
 import zmq
 
 from PyQt5 import QtCore, QtWidgets, uic
-from PyQt5.QtCore import QObject, QProcess, QFile, Qt, pyqtSignal, QEvent
+from PyQt5.QtCore import QObject, QProcess, QFile, Qt, pyqtSignal, QEvent, QSocketNotifier, QTimer
 from PyQt5.QtWidgets import QWidget, QFileDialog
 from qtvcp.core import Action, Info, Path, Status
 
@@ -30,6 +30,9 @@ STATUS = Status()
 HERE = os.path.dirname(os.path.abspath(__file__))
 HELP = os.path.join(PATH.CONFIGPATH, "help_files")
 SUBPROGRAM = os.path.join(HERE, "rapid_subprog.py")
+COMPRESSED = ('.gz', '.xz')
+# msec to wait for messages still in transit after the converter exits
+EXIT_GRACE = 500
 
 class MouseClickFilter(QObject):
     mouse_clicked = pyqtSignal()
@@ -48,6 +51,9 @@ class Rapid_Rotary(QWidget):
         self.w = parent.w
         self.units = 'MM'
         self.convert = None
+        self.context = None
+        self.socket = None
+        self.notifier = None
         self.input_file = None
         self.output_file = None
         self.help_file = "rapid_rotary_help.html"
@@ -111,11 +117,13 @@ class Rapid_Rotary(QWidget):
         if self.output_file == "":
             self.status_output.appendPlainText("Invalid output file specified")
             return
-        # set up Zero Message Queue as server
+        # set up Zero Message Queue as server, messages are read when the socket signals it has data
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
+        self.socket = self.context.socket(zmq.PULL)
         self.socket.bind('tcp://*:4096')
-        
+        self.notifier = QSocketNotifier(self.socket.getsockopt(zmq.FD), QSocketNotifier.Read, self)
+        self.notifier.activated.connect(self.read_messages)
+
         self.wrapped_file = True
         self.g90_found = True
         self.g93_found = False
@@ -136,24 +144,59 @@ class Rapid_Rotary(QWidget):
                                    self.units,
                                    self.wrap_all])
         self.convert.setReadChannel(QProcess.StandardOutput)
+        self.convert.finished.connect(self.convert_exited)
         self.convert.start()
-        # now wait for messages from rapid subprogram
-        try:
-            while True:
-                message = self.socket.recv()
+
+    def read_messages(self):
+        # the zmq descriptor is edge triggered so everything queued must be read now
+        while self.socket is not None and self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            for message in self.socket.recv_multipart(zmq.NOBLOCK):
                 self.parse_message(message.decode('utf-8'))
-                self.socket.send(b'ACK')
-                if self.convert is None: break
-        except KeyboardInterrupt:
-            pass
-        self.socket.close()
+            if self.convert is None:
+                self.close_channel()
+
+    def convert_exited(self, code, status):
+        if self.socket is None: return
+        self.drain_messages()
+        # anything still in transit is collected before deciding the converter failed
+        if self.convert is not None:
+            proc = self.convert
+            QTimer.singleShot(EXIT_GRACE, lambda: self.finish_convert(proc, code))
+
+    def finish_convert(self, proc, code):
+        # the completion message may have arrived, or a new conversion started, in the meantime
+        if self.convert is not proc: return
+        self.drain_messages()
+        if self.convert is proc:
+            self.convert = None
+            self.status_output.appendPlainText(f"File converter exited unexpectedly (exit code {code})")
+            self.close_channel()
+
+    # read without blocking until the queue is empty
+    def drain_messages(self):
+        while self.socket is not None:
+            try:
+                message = self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            self.parse_message(message.decode('utf-8'))
+            if self.convert is None:
+                self.close_channel()
+
+    def close_channel(self):
+        self.notifier.setEnabled(False)
+        self.notifier.deleteLater()
+        self.notifier = None
+        self.socket.close(linger=0)
         self.context.term()
+        self.socket = None
+        self.context = None
 
     def get_input_file(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         _dir = os.path.expanduser('~/linuxcnc/nc_files')
-        _filter = "GCode Files (*.ngc *.nc)"
+        _filter = "GCode Files (*.ngc *.nc *.gz *.xz)"
         fileName, _ = QFileDialog.getOpenFileName(self, "Open Source File", _dir, _filter, options=options)
         if fileName:
             self.lineEdit_input_file.setText(fileName)
@@ -165,12 +208,15 @@ class Rapid_Rotary(QWidget):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         _dir = os.path.expanduser('~/linuxcnc/nc_files')
-        _filter = "GCode Files (*.ngc *.nc)"
+        _filter = "GCode Files (*.ngc *.nc *.gz *.xz)"
         fileName, _ = QFileDialog.getSaveFileName(self, "Save Converted File", _dir, _filter, options=options)
         if fileName:
             self.lineEdit_output_file.setText(fileName)
             self.output_file = fileName
-            self.temp_file = self.make_temp()[1]
+            # the converter compresses its output based on the file extension
+            ext = os.path.splitext(fileName)[1]
+            self.temp_file = self.make_temp(ext if ext in COMPRESSED else '.ngc')[1]
+            self.btn_send.setEnabled(False)
         self.output_set = (self.lineEdit_output_file.text() != "")
         self.btn_convert.setEnabled(self.input_set is True and self.output_set is True)
 
@@ -207,17 +253,27 @@ class Rapid_Rotary(QWidget):
             self.convert = None
             if self.wrapped_file is True and self.g90_found is True and self.g93_found is False and self.g94_found is True:
                 shutil.move(self.temp_file, self.output_file)
-                self.btn_send.setEnabled(True)
+                # LinuxCNC can not interpret a compressed program
+                if self.is_compressed(self.output_file):
+                    self.status_output.appendPlainText("Compressed output can not be sent to LinuxCNC - use a .ngc output file to send it")
+                else:
+                    self.btn_send.setEnabled(True)
 
     def send_to_linuxcnc(self):
+        if self.is_compressed(self.output_file):
+            self.status_output.appendPlainText(f"File {self.output_file} is compressed and can not be loaded")
+            return
         ACTION.OPEN_PROGRAM(self.output_file)
 
+    def is_compressed(self, fname):
+        return os.path.splitext(fname)[1] in COMPRESSED
+
     def show_help(self):
         fname = os.path.join(HELP, self.help_file)
         self.parent.show_help_page(fname)
 
-    def make_temp(self):
-        _tmp = tempfile.mkstemp(prefix='rapid_rotary', suffix='.ngc')
+    def make_temp(self, suffix='.ngc'):
+        _tmp = tempfile.mkstemp(prefix='rapid_rotary', suffix=suffix)
         atexit.register(lambda: os.remove(_tmp[1]))
         return _tmp
 
@@ -14,87 +14,134 @@
 
 import sys
 import os
+import io
+import re
+import gzip
+import lzma
 import time
 import math
 import zmq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from PyQt5.QtCore import QObject
 
+# approximate number of input bytes converted per batch
+CHUNK_SIZE = 256 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+# minimum time between progress reports (seconds)
+PROGRESS_INTERVAL = 0.1
+# warnings beyond this count are tallied but not sent
+MAX_WARNINGS = 50
+
+# word tables used to classify each word of a line by its letter
+FEED_WORD, MODAL_WORD, AXIS_WORD, STOP_WORD = range(4)
+WORD_KINDS = {'F': FEED_WORD, 'G': MODAL_WORD, 'M': STOP_WORD, '%': STOP_WORD,
+              'X': AXIS_WORD, 'Y': AXIS_WORD, 'Z': AXIS_WORD, 'A': AXIS_WORD,
+              'I': AXIS_WORD, 'J': AXIS_WORD, 'K': AXIS_WORD}
+MOVE_WORDS = {"G0": 0, "G00": 0, "G1": 1, "G01": 1, "G2": 2, "G02": 2, "G3": 3, "G03": 3}
+# an axis word without a movement word repeats the last movement
+IMPLICIT_WORDS = frozenset('XYZA')
+IMPLICIT_MOVE = -2
+
+# inputs smaller than this are always converted in a single process
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+# patterns used to scan a chunk for the modal state it leaves behind
+COMMENT = re.compile(r'\(.*')
+WORD_TAIL = re.compile(r'\S*')
+STOP_CODES = re.compile(r'(?<!\S)(%|M2|M30)')
+# totals and flags combined from the chunks of a parallel conversion
+CHUNK_TOTALS = ('totalToolPathDistance', 'totalDegreesRotated', 'numberLinesWithRotaryMoves',
+                'totalG00lines', 'totalG01lines', 'totalG02lines', 'totalG03lines')
+CHUNK_FLAGS = ('G90Found', 'G93Found', 'G94Found')
+PUBLISH_EVENT, NOTICE_EVENT, WARN_EVENT = range(3)
+
+def last_words(text, letter):
+    # yields the values of the words starting with letter, last word first
+    end = len(text)
+    while True:
+        pos = text.rfind(letter, 0, end)
+        if pos < 0: return
+        if pos == 0 or text[pos - 1].isspace():
+            yield WORD_TAIL.match(text, pos + 1).group()
+        end = pos
+
+def scan_modal_state(lines, state):
+    # quickly finds the modal state at the end of a chunk from the last word of each kind
+    # the result is only a guess, it is checked against the state of the converted chunk
+    x, y, z, a, feed, move, plane, plane_found, start_found, end_found = state
+    text = COMMENT.sub('', ''.join(lines)).upper()
+    axes = [x, y, z, a]
+    for i, letter in enumerate('XYZA'):
+        for value in last_words(text, letter):
+            axes[i] = float(value)
+            break
+    for value in last_words(text, 'F'):
+        feed = float(value)
+        break
+    move_seen = plane_seen = False
+    for value in last_words(text, 'G'):
+        code = MOVE_WORDS.get('G' + value)
+        if code is not None and not move_seen:
+            move = code
+            move_seen = True
+        elif value.lstrip('0') in ('17', '18', '19') and not plane_seen:
+            plane = int(value)
+            plane_seen = plane_found = True
+        if move_seen and plane_seen: break
+    if '%' in text or 'M2' in text or 'M30' in text:
+        for code in STOP_CODES.findall(text):
+            if code != '%':
+                end_found = True
+            elif not start_found:
+                start_found = True
+            else:
+                end_found = True
+    return (*axes, feed, move, plane, plane_found, start_found, end_found)
 
 class GCode_Coordinate:
     MIN_Z_RADIUS = 0.25  # units (this could be .25in or .25mm [this case is very fast] - in the future may want to take into account metric to help safeguard this better)
+    # an axis value of None means the axis has not been set
+    __slots__ = ('parent', 'X', 'Y', 'Z', 'A', 'I', 'J', 'K')
 
-    def __init__(self, parent, lineParts=None):
+    def __init__(self, parent):
         self.parent = parent
-        self.X = 0
-        self.Y = 0
-        self.Z = 0
-        self.A = 0
-        self.I = 0
-        self.J = 0
-        self.K = 0
-        self.Xset = False
-        self.Yset = False
-        self.Zset = False
-        self.Aset = False
-        self.Iset = False
-        self.Jset = False
-        self.Kset = False
-        if lineParts is not None: self.create_coords(lineParts)
-
-    def create_coords(self, lineParts):
-        for part in lineParts:
-            if part.startswith("X"):
-                value = part[1:]
-                self.setX(float(value))
-            elif part.startswith("Y"):
-                value = part[1:]
-                self.setY(float(value))
-            elif part.startswith("Z"):
-                value = part[1:]
-                self.setZ(float(value))
-            elif part.startswith("A"):
-                value = part[1:]
-                self.setA(float(value))
-            elif part.startswith("I"):
-                value = part[1:]
-                self.setI(float(value))
-            elif part.startswith("J"):
-                value = part[1:]
-                self.setJ(float(value))
-            elif part.startswith("K"):
-                value = part[1:]
-                self.setK(float(value))
-
-    def copy_unset_from_previous(self, previous_coord):
-        if not self.isXset() and previous_coord.isXset():
-            self.setX(previous_coord.getX())
-        if not self.isYset() and previous_coord.isYset():
-            self.setY(previous_coord.getY())
-        if not self.isZset() and previous_coord.isZset():
-            self.setZ(previous_coord.getZ())
-        if not self.isAset() and previous_coord.isAset():
-            self.setA(previous_coord.getA())
+        self.X = self.Y = self.Z = self.A = None
+        self.I = self.J = self.K = None
+
+    def update(self, previous_coord, words):
+        # axes not given on this line keep their previous value, arc offsets only apply to this line
+        get = words.get
+        self.X = get('X', previous_coord.X)
+        self.Y = get('Y', previous_coord.Y)
+        self.Z = get('Z', previous_coord.Z)
+        self.A = get('A', previous_coord.A)
+        self.I = get('I')
+        self.J = get('J')
+        self.K = get('K')
 
     def straight_distance(self, previous_coord, z0_offset, dist_units, error_if_not_set, line_number):
+        # an axis is never unset after being set, so only a newly set axis has no starting point
         square_sum_dist = 0
-        if self.Xset and previous_coord.Xset:
+        if previous_coord.X is not None:
             square_sum_dist += (self.X - previous_coord.X) ** 2
-        elif self.Xset != previous_coord.Xset and error_if_not_set:
-            self.parent.publish(f"G01 movement without an initial X starting point. (line: {line_number})")
-        if self.Yset and previous_coord.Yset:
+        elif self.X is not None and error_if_not_set:
+            self.parent.warn(f"G01 movement without an initial X starting point. (line: {line_number})")
+        if previous_coord.Y is not None:
             square_sum_dist += (self.Y - previous_coord.Y) ** 2
-        elif self.Yset != previous_coord.Yset and error_if_not_set:
-            self.parent.publish(f"G01 movement without an initial Y starting point. (line: {line_number})")
-        if self.Zset and previous_coord.Zset:
+        elif self.Y is not None and error_if_not_set:
+            self.parent.warn(f"G01 movement without an initial Y starting point. (line: {line_number})")
+        if previous_coord.Z is not None:
             square_sum_dist += (self.Z - previous_coord.Z) ** 2
-        elif self.Zset != previous_coord.Zset and error_if_not_set:
-            self.parent.publish(f"G01 movement without an initial Z starting point. (line: {line_number})")
-        if self.Aset and previous_coord.Aset:
-            if not self.Zset and not previous_coord.Zset:
-                self.parent.publish(f"A-axis movement requires a prior Z-axis movement (for distance calculation). (line: {line_number})")
-
-            max_z = max(abs(self.Z + z0_offset), abs(previous_coord.Z + z0_offset))
+        elif self.Z is not None and error_if_not_set:
+            self.parent.warn(f"G01 movement without an initial Z starting point. (line: {line_number})")
+        if previous_coord.A is not None:
+            if self.Z is None:
+                self.parent.warn(f"A-axis movement requires a prior Z-axis movement (for distance calculation). (line: {line_number})")
+                max_z = abs(z0_offset)
+            else:
+                max_z = max(abs(self.Z + z0_offset), abs((0 if previous_coord.Z is None else previous_coord.Z) + z0_offset))
             tolerance_scale = 1.0
             if dist_units == "mm":
                 tolerance_scale = 25.4
@@ -110,43 +157,26 @@ class GCode_Coordinate:
 
     def arc_distance_from_previous_coordinate(self, previous_coord, clockwise_direction, dist_units, line_number, current_plane_selected):
         if current_plane_selected == 17:
-            if not previous_coord.Xset or not previous_coord.Yset:
-                self.parent.publish(f"G02/G03 movement requires both X and Y to have been previously set (G17). (line: {line_number})")
-            if not self.Xset or not self.Yset or not self.Iset or not self.Jset:
-                self.parent.publish(f"G02/G03 movement requires X, Y, I, J arguments (G17). One or more are missing. (line: {line_number})")
+            if previous_coord.X is None or previous_coord.Y is None:
+                self.parent.warn(f"G02/G03 movement requires both X and Y to have been previously set (G17). (line: {line_number})")
+            if self.X is None or self.Y is None or self.I is None or self.J is None:
+                self.parent.warn(f"G02/G03 movement requires X, Y, I, J arguments (G17). One or more are missing. (line: {line_number})")
+            values = (previous_coord.X, previous_coord.Y, self.X, self.Y, self.I, self.J)
         elif current_plane_selected == 18:
-            if not previous_coord.Xset or not previous_coord.Zset:
-                self.parent.publish(f"G02/G03 movement requires both Z and X to have been previously set (G18). (line: {line_number})")
-            if not self.Xset or not self.Zset or not self.Iset or not self.Kset:
-                self.parent.publish(f"G02/G03 movement requires X, Z, I, K arguments (G18). One or more are missing. (line: {line_number})")
+            if previous_coord.X is None or previous_coord.Z is None:
+                self.parent.warn(f"G02/G03 movement requires both Z and X to have been previously set (G18). (line: {line_number})")
+            if self.X is None or self.Z is None or self.I is None or self.K is None:
+                self.parent.warn(f"G02/G03 movement requires X, Z, I, K arguments (G18). One or more are missing. (line: {line_number})")
+            values = (previous_coord.X, previous_coord.Z, self.X, self.Z, self.I, self.K)
         elif current_plane_selected == 19:
-            if not previous_coord.Yset or not previous_coord.Zset:
-                self.parent.publish(f"G02/G03 movement requires both Y and Z to have been previously set (G19). (line: {line_number})")
-            if not self.Yset or not self.Zset or not self.Jset or not self.Kset:
-                self.parent.publish(f"G02/G03 movement requires Y, Z, J, K arguments (G19). One or more are missing. (line: {line_number})")
-
-        if current_plane_selected == 17:
-            prev_x = previous_coord.X
-            prev_y = previous_coord.Y
-            curr_x = self.X
-            curr_y = self.Y
-            curr_i = self.I
-            curr_j = self.J
-        elif current_plane_selected == 18:
-            prev_x = previous_coord.X
-            prev_y = previous_coord.Z
-            curr_x = self.X
-            curr_y = self.Z
-            curr_i = self.I
-            curr_j = self.K
-        elif current_plane_selected == 19:
-            prev_x = previous_coord.Y
-            prev_y = previous_coord.Z
-            curr_x = self.Y
-            curr_y = self.Z
-            curr_i = self.J
-            curr_j = self.K
-
+            if previous_coord.Y is None or previous_coord.Z is None:
+                self.parent.warn(f"G02/G03 movement requires both Y and Z to have been previously set (G19). (line: {line_number})")
+            if self.Y is None or self.Z is None or self.J is None or self.K is None:
+                self.parent.warn(f"G02/G03 movement requires Y, Z, J, K arguments (G19). One or more are missing. (line: {line_number})")
+            values = (previous_coord.Y, previous_coord.Z, self.Y, self.Z, self.J, self.K)
+
+        # unset values are taken as 0
+        prev_x, prev_y, curr_x, curr_y, curr_i, curr_j = (0 if v is None else v for v in values)
         return self.arc_length(prev_x, prev_y, curr_x, curr_y, curr_i, curr_j, clockwise_direction, dist_units, line_number)
 
     def arc_length(self, prev_x, prev_y, curr_x, curr_y, curr_i, curr_j, clockwise_direction, dist_units, line_number):
@@ -160,7 +190,7 @@ class GCode_Coordinate:
             tolerance_scale = 25.4
 
         if r_error > (0.001 * tolerance_scale):
-            self.publish(f"G02/G03 movement is not circular. (line {line_number})")
+            self.parent.warn(f"G02/G03 movement is not circular. (line {line_number})")
 
         xx_1 = prev_x - center_point_x
         xx_2 = prev_y - center_point_y
@@ -185,101 +215,13 @@ class GCode_Coordinate:
         return counterClockwiseArcLength
 
     def rotationAbsoluteDifferenceDegrees(self, previousCoord):
-        if self.isAset() is False or previousCoord.isAset() is False:
+        if self.A is None or previousCoord.A is None:
             return 0
-        return abs(self.getA() - previousCoord.getA())
-        
-    def getX(self):
-        return self.X
-
-    def getY(self):
-        return self.Y
-
-    def getZ(self):
-        return self.Z
-
-    def getA(self):
-        return self.A
-
-    def getI(self):
-        return self.I
-
-    def getJ(self):
-        return self.J
-
-    def getK(self):
-        return self.K
-
-    def setX(self, x):
-        self.X = x
-        self.Xset = True
-
-    def setY(self, y):
-        self.Y = y
-        self.Yset = True
-
-    def setZ(self, z):
-        self.Z = z
-        self.Zset = True
-
-    def setA(self, a):
-        self.A = a
-        self.Aset = True
-
-    def setI(self, i):
-        self.I = i
-        self.Iset = True
-
-    def setJ(self, j):
-        self.J = j
-        self.Jset = True
-
-    def setK(self, k):
-        self.K = k
-        self.Kset = True
-
-    def isXset(self):
-        return self.Xset
-
-    def isYset(self):
-        return self.Yset
-
-    def isZset(self):
-        return self.Zset
-
-    def isAset(self):
-        return self.Aset
-
-    def isIset(self):
-        return self.Iset
-
-    def isJset(self):
-        return self.Jset
-
-    def isKset(self):
-        return self.Kset
-
-
-class GCodeMovementResult:
-    def __init__(self, is_movement_line, is_implicit_movement, gcode_string):
-        self.is_movement_line = is_movement_line
-        self.is_implicit_movement = is_implicit_movement
-        
-        if self.is_movement_line is True and self.is_implicit_movement is False:
-            self.set_gcode(gcode_string)
-        else:
-            self.gcode_movement_type = -1  # not valid
-
-    def set_gcode(self, gcode_string):
-        if len(gcode_string) < 2:
-            self.gcode_movement_type = -1  # not valid
-        else:
-            gcode_str = gcode_string[1:]
-            self.gcode_movement_type = int(gcode_str)
+        return abs(self.A - previousCoord.A)
 
 
 class File_Converter(QObject):
-    def __init__(self, infile, outfile, offset, units, mode):
+    def __init__(self, infile, outfile, offset, units, mode, jobs='0'):
         QObject.__init__(self)
         self.inputFilePath = infile
         self.outputFilePath = outfile
@@ -291,6 +233,7 @@ class File_Converter(QObject):
         self.endOfProgramFound = False
         self.start_percent_found = False
         self.lastCoordinate = GCode_Coordinate(self)
+        self.nextCoordinate = GCode_Coordinate(self)
         self.currentFeedRate = -1
         self.lastGCode = -1
         self.G17_18_19_Found = False
@@ -311,42 +254,51 @@ class File_Converter(QObject):
         self.numberLinesWithRotaryMoves = 0
         self.fOutputPrecision = 3
         self.wrap_all = True if mode == '1' else False
+        # number of worker processes for large files, 0 uses all cores
+        self.jobs = int(jobs)
         self.startTime = 0
         self.last_progress = 0
+        self.last_progress_time = 0
+        self.pending = []
+        self.notices = {}
+        self.warnings = 0
+        # blocks of a parallel conversion and the ones converted again after a wrong scan
+        self.chunks = 0
+        self.rescans = 0
         self.start_process()
-        # close the zmq connection
-        self.socket.close()
-        self.context.term()
 
     def start_process(self):
         # set up zero message queue as client
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REQ)
+        self.socket = self.context.socket(zmq.PUSH)
+        # give queued messages a chance to reach the gui when the socket is closed
+        self.socket.setsockopt(zmq.LINGER, 5000)
         self.socket.connect('tcp://localhost:4096')
-        
+        self.convert_file()
+        # close the zmq connection
+        self.socket.close()
+        self.context.term()
+
+    def convert_file(self):
         self.clear_all_data()
         self.startTime = time.time()
 
-        totalLinesInFile = self.countLinesInFile(self.inputFilePath)
-        self.publish(f"Total lines in input file is {totalLinesInFile}")
-
         try:
-            out_file = open(self.outputFilePath, 'w')
-            in_file = open(self.inputFilePath, 'r')
-            nextLine = in_file.readline()
-            self.linesProcessed = 0
-            while nextLine:
-                line2Write = self.processInputLine(nextLine) + '\n'
-                out_file.write(line2Write)
-                self.linesProcessed += 1
-                progress = round((self.linesProcessed * 100) / totalLinesInFile)
-                if self.linesProcessed % 100 == 0 and progress != self.last_progress:
-                    self.last_progress = progress
-                    self.publish(f"Progress:{progress}")
-                nextLine = in_file.readline()
-
-            in_file.close()
-            out_file.close()
+            raw_file, in_file = self.open_input(self.inputFilePath)
+            totalBytes = os.fstat(raw_file.fileno()).st_size
+            self.publish(f"Input file size is {totalBytes} bytes")
+            jobs = self.jobs or os.cpu_count() or 1
+            with raw_file, in_file, self.open_output(self.outputFilePath) as out_file:
+                self.linesProcessed = 0
+                if jobs > 1 and totalBytes >= PARALLEL_MIN_BYTES:
+                    self.publish(f"Converting with {jobs} processes")
+                    self.convert_parallel(raw_file, in_file, out_file, totalBytes, jobs)
+                else:
+                    while True:
+                        lines = in_file.readlines(CHUNK_SIZE)
+                        if not lines: break
+                        out_file.write(self.convert_lines(lines))
+                        self.report_progress(raw_file.tell(), totalBytes)
 
         except Exception as e:
             self.publish(f"\nERROR PROCESSING FILE - {e}")
@@ -361,8 +313,100 @@ class File_Converter(QObject):
         if not self.endOfProgramFound:
             self.publish("WARNING - no end of program found (%, M2, or M30). G94 not inserted at the end of output file.")
 
+        self.report_repeats()
         self.done()
         self.publish("Finished:Convert finished")
+        self.flush()
+
+    def convert_lines(self, lines):
+        output = []
+        for nextLine in lines:
+            output.append(self.processInputLine(nextLine))
+            self.linesProcessed += 1
+        output.append('')
+        return '\n'.join(output)
+
+    def convert_parallel(self, raw_file, in_file, out_file, totalBytes, jobs):
+        # each chunk is sent to the pool with the modal state scanned from the chunks before it
+        # and the results are stitched together in order
+        args = (self.z0_offset, self.distUnits, '1' if self.wrap_all else '0')
+        state = self.get_state()
+        first_line = 0
+        pending = deque()
+        pool = ProcessPoolExecutor(jobs)
+        try:
+            while True:
+                lines = in_file.readlines(CHUNK_SIZE)
+                if not lines: break
+                future = pool.submit(convert_chunk, *args, state, first_line, lines)
+                pending.append((future, state, first_line, lines, raw_file.tell()))
+                state = scan_modal_state(lines, state)
+                first_line += len(lines)
+                # limit the number of chunks held in memory
+                if len(pending) > 2 * jobs:
+                    self.collect_chunk(pending.popleft(), args, out_file, totalBytes)
+            while pending:
+                self.collect_chunk(pending.popleft(), args, out_file, totalBytes)
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def collect_chunk(self, chunk, args, out_file, totalBytes):
+        future, state, first_line, lines, position = chunk
+        self.chunks += 1
+        if state == self.get_state():
+            result = future.result()
+        else:
+            # the scan guessed wrong, convert the chunk again from the exact state
+            future.cancel()
+            self.rescans += 1
+            result = convert_chunk(*args, self.get_state(), first_line, lines)
+        out_file.write(result['text'])
+        for event in result['events']:
+            if event[0] == NOTICE_EVENT:
+                self.add_notice(event[1], event[2], 0)
+            elif event[0] == WARN_EVENT:
+                self.warn(event[1])
+            else:
+                self.publish(event[1])
+        for code, count in result['notices'].items():
+            self.notices[code] += count
+        self.warnings += result['warnings'] - min(result['warnings'], MAX_WARNINGS)
+        for name in CHUNK_TOTALS:
+            setattr(self, name, getattr(self, name) + result[name])
+        for name in CHUNK_FLAGS:
+            if result[name]: setattr(self, name, True)
+        if result['rotaryMinMaxFound']:
+            if self.rotaryMinMaxFound is False:
+                self.rotaryMin = result['rotaryMin']
+                self.rotaryMax = result['rotaryMax']
+                self.rotaryMinMaxFound = True
+            else:
+                self.rotaryMin = min(self.rotaryMin, result['rotaryMin'])
+                self.rotaryMax = max(self.rotaryMax, result['rotaryMax'])
+        self.set_state(result['state'])
+        self.linesProcessed = result['lines']
+        self.report_progress(position, totalBytes)
+
+    def get_state(self):
+        # everything a line depends on from the lines before it
+        coord = self.lastCoordinate
+        return (coord.X, coord.Y, coord.Z, coord.A, self.currentFeedRate, self.lastGCode, self.currentPlaneSelected,
+                self.G17_18_19_Found, self.start_percent_found, self.endOfProgramFound)
+
+    def set_state(self, state):
+        coord = self.lastCoordinate
+        (coord.X, coord.Y, coord.Z, coord.A, self.currentFeedRate, self.lastGCode, self.currentPlaneSelected,
+         self.G17_18_19_Found, self.start_percent_found, self.endOfProgramFound) = state
+
+    def report_progress(self, position, totalBytes):
+        # progress is based on the position in the (possibly compressed) input file
+        progress = round((position * 100) / totalBytes) if totalBytes else 100
+        now = time.monotonic()
+        if progress != self.last_progress and now - self.last_progress_time >= PROGRESS_INTERVAL:
+            self.last_progress = progress
+            self.last_progress_time = now
+            self.publish(f"Progress:{progress}")
+        self.flush()
 
     def clear_all_data(self):
         self.errorMessage = ""
@@ -371,6 +415,9 @@ class File_Converter(QObject):
         self.endOfProgramFound = False
         self.start_percent_found = False
         self.lastCoordinate = GCode_Coordinate(self)
+        self.nextCoordinate = GCode_Coordinate(self)
+        self.notices = {}
+        self.warnings = 0
 
         self.currentFeedRate = -1
         self.lastGCode = -1
@@ -391,17 +438,25 @@ class File_Converter(QObject):
         self.rotaryMin = 0
         self.numberLinesWithRotaryMoves = 0
         
-    def countLinesInFile(self, pathToFile):
-        totalLines = 0
-        try:
-            infile = open(pathToFile)
-            while infile.readline():
-                totalLines += 1
-            infile.close()
-        except Exception as ignore:
-            self.publish(f"Error counting lines in input file - {ignore}")
-        
-        return totalLines
+    def open_input(self, pathToFile):
+        # gzip and xz compressed files are recognized by their contents
+        raw_file = open(pathToFile, 'rb')
+        magic = raw_file.peek(len(XZ_MAGIC))
+        if magic.startswith(GZIP_MAGIC):
+            stream = gzip.GzipFile(fileobj=raw_file, mode='rb')
+        elif magic.startswith(XZ_MAGIC):
+            stream = lzma.LZMAFile(raw_file, mode='rb')
+        else:
+            stream = raw_file
+        return raw_file, io.TextIOWrapper(stream)
+
+    def open_output(self, pathToFile):
+        # output is compressed according to the file extension
+        if pathToFile.endswith('.gz'):
+            return gzip.open(pathToFile, 'wt')
+        elif pathToFile.endswith('.xz'):
+            return lzma.open(pathToFile, 'wt')
+        return open(pathToFile, 'w')
 
     def processInputLine(self, lineIn):
         lineComments = ""
@@ -409,23 +464,41 @@ class File_Converter(QObject):
         if commentStart >= 0:
             lineComments = lineIn[commentStart:]
             lineIn = lineIn[:commentStart]
-        lineIn = lineIn.upper()
-        lineParts = lineIn.split()
-
-        feedString = self.process_feed_rate(lineParts)
-        self.process_non_moving(lineParts)
-        moveContainsRotaryChangeAndNotG00 = self.process_moving_implicit(lineParts)
 
-        StartFoundOnLine = self.process_start_stop(lineParts)
+        # sort the words of the line by kind in a single pass, feed words are removed from the line
+        lineParts = []
+        feedWords = []
+        modalWords = []
+        axisWords = {}
+        moveCode = None
+        stopFound = False
+        for word in lineIn.upper().split():
+            letter = word[0]
+            kind = WORD_KINDS.get(letter)
+            if kind == FEED_WORD:
+                feedWords.append(word[1:])
+                continue
+            if kind == AXIS_WORD:
+                axisWords[letter] = float(word[1:])
+                if moveCode is None and letter in IMPLICIT_WORDS:
+                    moveCode = IMPLICIT_MOVE
+            elif kind == MODAL_WORD:
+                modalWords.append(len(lineParts))
+                if moveCode is None:
+                    moveCode = MOVE_WORDS.get(word)
+            elif kind == STOP_WORD:
+                stopFound = True
+            lineParts.append(word)
+
+        feedString = self.process_feed_rate(feedWords)
+        if modalWords:
+            self.process_non_moving(lineParts, modalWords)
+        moveContainsRotaryChangeAndNotG00 = self.process_moving_implicit(lineParts, moveCode, axisWords)
+
+        StartFoundOnLine = self.process_start_stop(lineParts) if stopFound else False
 
         # **** re-combine all the parts of the line ****
-        returnLine = ""
-        for part in lineParts:
-            if len(part) > 0:
-                if len(returnLine) > 0:
-                    returnLine = returnLine + " " + part  # space needed between parts
-                else:
-                    returnLine = returnLine + part  # no space needed
+        returnLine = " ".join(lineParts)
 
         if self.wrap_all is False and not moveContainsRotaryChangeAndNotG00:
             if len(feedString) > 0:
@@ -452,73 +525,74 @@ class File_Converter(QObject):
 
         return returnLine.strip()
 
-    def process_feed_rate(self, lineParts):
+    def process_feed_rate(self, feedWords):
         feedStrings = ""
-        
-        for i in range(len(lineParts)):
-            if lineParts[i].startswith("F"):
-                feedStr = lineParts[i][1:]
-                self.currentFeedRate = float(feedStr)
-                feedStrings += (lineParts[i] + " ")
-                del lineParts[i]
+        for value in feedWords:
+            self.currentFeedRate = float(value)
+            feedStrings += f"F{value} "
         return feedStrings
 
-    def process_non_moving(self, lineParts):
-        for i in range(len(lineParts)):
-            if lineParts[i].startswith("G"):
-                gCodeStr = lineParts[i][1:]
-                gCode = int(gCodeStr)
-
-                if gCode == 94:
-                    self.G94Found = True
-                    if self.wrap_all is True:
-                        lineParts[i] = "G93"
-                    self.publish(f"- G94 found on Line {self.linesProcessed + 1}")
-
-                elif gCode == 93:
-                    self.publish(f"- G93 found on Line {self.linesProcessed + 1}")
-                    self.G93Found = True
-
-                elif gCode == 17:
-                    self.G17_18_19_Found = True
-                    self.currentPlaneSelected = 17
-                    self.publish(f"- G17 found on Line {self.linesProcessed + 1}")
-
-                elif gCode == 18:
-                    self.G17_18_19_Found = True 
-                    self.currentPlaneSelected = 18
-                    self.publish(f"- G18 found on Line {self.linesProcessed + 1}")
-
-                elif gCode == 19:
-                    self.G17_18_19_Found = True
-                    self.currentPlaneSelected = 19
-                    self.publish(f"- G19 found on Line {self.linesProcessed + 1}")
-
-                elif gCode == 90:
-                    self.G90Found = True
-                    self.publish(f"- G90 found on Line {self.linesProcessed + 1}")
-
-    def process_moving_implicit(self, lineParts):
+    def process_non_moving(self, lineParts, modalWords):
+        for i in modalWords:
+            try:
+                gCode = int(lineParts[i][1:])
+            except ValueError:
+                # codes such as G38.2 are passed through unchanged
+                continue
+
+            if gCode == 94:
+                self.G94Found = True
+                if self.wrap_all is True:
+                    lineParts[i] = "G93"
+                self.notice("G94")
+
+            elif gCode == 93:
+                self.notice("G93")
+                self.G93Found = True
+
+            elif gCode == 17:
+                self.G17_18_19_Found = True
+                self.currentPlaneSelected = 17
+                self.notice("G17")
+
+            elif gCode == 18:
+                self.G17_18_19_Found = True 
+                self.currentPlaneSelected = 18
+                self.notice("G18")
+
+            elif gCode == 19:
+                self.G17_18_19_Found = True
+                self.currentPlaneSelected = 19
+                self.notice("G19")
+
+            elif gCode == 90:
+                self.G90Found = True
+                self.notice("G90")
+
+    def process_moving_implicit(self, lineParts, moveCode, axisWords):
         rotary_and_not_g00 = False
-        moveCommandResult = self.check_for_move_command(lineParts)
-        if moveCommandResult.is_movement_line is False:
+        if moveCode is None:
             return False
 
-        currentMoveGCode = -1
-        if moveCommandResult.is_implicit_movement is True and self.lastGCode < 0:
-            self.publish(f"Implicit move command given before (G0/1/2/3). (line {self.linesProcessed + 1})")
-        currentMoveGCode = self.lastGCode if moveCommandResult.is_implicit_movement is True else moveCommandResult.gcode_movement_type
+        if moveCode == IMPLICIT_MOVE:
+            if self.lastGCode < 0:
+                self.warn(f"Implicit move command given before (G0/1/2/3). (line {self.linesProcessed + 1})")
+            currentMoveGCode = self.lastGCode
+        else:
+            currentMoveGCode = moveCode
 
         self.lastGCode = currentMoveGCode
 
         if currentMoveGCode != 0:
             if self.currentFeedRate < 0:
-                self.publish("Movement G-code (G01,G02,G03) found before the following requirements were set")
-                self.publish("Feedrate not set")
-            if self.G17_18_19_Found is False: self.publish("G17, G18 or G19 not set")
+                self.warn("Movement G-code (G01,G02,G03) found before the following requirements were set")
+                self.warn("Feedrate not set")
+            if self.G17_18_19_Found is False: self.warn("G17, G18 or G19 not set")
 
-        endCoordinate = GCode_Coordinate(self, lineParts)
-        endCoordinate.copy_unset_from_previous(self.lastCoordinate)
+        # the two coordinates are reused, the end point of this move becomes the last coordinate
+        lastCoordinate = self.lastCoordinate
+        endCoordinate = self.nextCoordinate
+        endCoordinate.update(lastCoordinate, axisWords)
 
         distanceTraveled = -1
         degreesRotated = -1
@@ -526,35 +600,29 @@ class File_Converter(QObject):
 
         if currentMoveGCode == 0:
             self.totalG00lines += 1
-            distanceTraveled = endCoordinate.straight_distance(self.lastCoordinate, self.z0_offset, self.distUnits, False, self.linesProcessed + 1)
-            degreesRotated = endCoordinate.rotationAbsoluteDifferenceDegrees(self.lastCoordinate)
+            distanceTraveled = endCoordinate.straight_distance(lastCoordinate, self.z0_offset, self.distUnits, False, self.linesProcessed + 1)
+            degreesRotated = endCoordinate.rotationAbsoluteDifferenceDegrees(lastCoordinate)
             appendFvalueToLine = False
 
         elif currentMoveGCode == 1:
             self.totalG01lines += 1
-            distanceTraveled = endCoordinate.straight_distance(self.lastCoordinate, self.z0_offset, self.distUnits, True, self.linesProcessed + 1)
-            degreesRotated = endCoordinate.rotationAbsoluteDifferenceDegrees(self.lastCoordinate)
+            distanceTraveled = endCoordinate.straight_distance(lastCoordinate, self.z0_offset, self.distUnits, True, self.linesProcessed + 1)
+            degreesRotated = endCoordinate.rotationAbsoluteDifferenceDegrees(lastCoordinate)
             appendFvalueToLine = True
 
         elif currentMoveGCode == 2:
             self.totalG02lines += 1
-            distanceTraveled = endCoordinate.arc_distance_from_previous_coordinate(self.lastCoordinate, True, self.distUnits, self.linesProcessed + 1, self.currentPlaneSelected)
+            distanceTraveled = endCoordinate.arc_distance_from_previous_coordinate(lastCoordinate, True, self.distUnits, self.linesProcessed + 1, self.currentPlaneSelected)
             degreesRotated = 0
             appendFvalueToLine = True
 
         elif currentMoveGCode == 3:
             self.totalG03lines += 1
-            distanceTraveled = endCoordinate.arc_distance_from_previous_coordinate(self.lastCoordinate, False, self.distUnits, self.linesProcessed + 1, self.currentPlaneSelected)
+            distanceTraveled = endCoordinate.arc_distance_from_previous_coordinate(lastCoordinate, False, self.distUnits, self.linesProcessed + 1, self.currentPlaneSelected)
             degreesRotated = 0
             appendFvalueToLine = True
 
-        if endCoordinate.isAset() is True and self.lastCoordinate.isAset() is False:
-            self.numberLinesWithRotaryMoves += 1
-
-            if currentMoveGCode != 0:
-                rotary_and_not_g00 = True
-
-        elif endCoordinate.isAset() is True and endCoordinate.getA() != self.lastCoordinate.getA():
+        if endCoordinate.A is not None and (lastCoordinate.A is None or endCoordinate.A != lastCoordinate.A):
             self.numberLinesWithRotaryMoves += 1
 
             if currentMoveGCode != 0:
@@ -567,7 +635,7 @@ class File_Converter(QObject):
 
         if appendFvalueToLine:
             if self.currentFeedRate <= 0:
-                self.publish(f"Feedrate must be positive and non-zero (line {self.linesProcessed + 1})")
+                self.warn(f"Feedrate must be positive and non-zero (line {self.linesProcessed + 1})")
 
             timeForStepInMinutes = distanceTraveled / self.currentFeedRate
 
@@ -575,7 +643,7 @@ class File_Converter(QObject):
             if timeForStepInMinutes > 0:
                 frn = 1.0 / timeForStepInMinutes
             else:
-                self.publish(f"WARNING - zero distance, zero speed, or infinite speed for move on line {self.linesProcessed + 1}")
+                self.warn(f"WARNING - zero distance, zero speed, or infinite speed for move on line {self.linesProcessed + 1}")
             if frn <= 1.0:
                 lineParts.append(f"F{frn:.2f}")
             else:
@@ -587,36 +655,23 @@ class File_Converter(QObject):
         if degreesRotated >= 0:
             self.totalDegreesRotated += degreesRotated
 
-        self.lastCoordinate = GCode_Coordinate(self, lineParts)
-        self.lastCoordinate.copy_unset_from_previous(endCoordinate)
+        self.lastCoordinate = endCoordinate
+        self.nextCoordinate = lastCoordinate
 
-        if self.lastCoordinate.isAset() is True:
+        if endCoordinate.A is not None:
             if self.rotaryMinMaxFound is False:
-                self.rotaryMax = self.lastCoordinate.getA()
-                self.rotaryMin = self.lastCoordinate.getA()
+                self.rotaryMax = endCoordinate.A
+                self.rotaryMin = endCoordinate.A
                 self.rotaryMinMaxFound = True
             else:
-                if self.lastCoordinate.getA() > self.rotaryMax:
-                    self.rotaryMax = self.lastCoordinate.getA()
+                if endCoordinate.A > self.rotaryMax:
+                    self.rotaryMax = endCoordinate.A
 
-                if self.lastCoordinate.getA() < self.rotaryMin:
-                    self.rotaryMin = self.lastCoordinate.getA()
+                if endCoordinate.A < self.rotaryMin:
+                    self.rotaryMin = endCoordinate.A
 
         return rotary_and_not_g00
 
-    def check_for_move_command(self, lineParts):
-        movementKeys = ["G0", "G00", "G01", "G1", "G02", "G2", "G03", "G3"]
-        implicitKeys = ["X", "Y", "Z", "A"]
-        for part in lineParts:
-            if part in movementKeys:
-                return GCodeMovementResult(True, False, part)
-
-            for key in implicitKeys:
-                if part.startswith(key):
-                    return GCodeMovementResult(True, True, "")
-
-        return GCodeMovementResult(False, False, "")
-
     def process_start_stop(self, lineParts):
         percent_found = False
 
@@ -640,8 +695,35 @@ class File_Converter(QObject):
         return percent_found
 
     def publish(self, message):
-        self.socket.send(message.encode('utf-8'))
-        message = self.socket.recv()
+        self.pending.append(message.encode('utf-8'))
+
+    def flush(self):
+        # messages are sent in batches, one frame per message
+        if self.pending:
+            self.socket.send_multipart(self.pending)
+            self.pending = []
+
+    def notice(self, code):
+        self.add_notice(code, self.linesProcessed + 1, 1)
+
+    def add_notice(self, code, line, count):
+        # only the first occurrence of each modal code is reported, repeats are counted
+        if code not in self.notices:
+            self.notices[code] = 0
+            self.publish(f"- {code} found on Line {line}")
+        self.notices[code] += count
+
+    def warn(self, message):
+        self.warnings += 1
+        if self.warnings <= MAX_WARNINGS:
+            self.publish(message)
+
+    def report_repeats(self):
+        for code, count in self.notices.items():
+            if count > 1:
+                self.publish(f"- {code} found on {count} lines")
+        if self.warnings > MAX_WARNINGS:
+            self.publish(f"WARNING - {self.warnings - MAX_WARNINGS} more warnings not shown")
 
     def done(self):
         if not self.last_progress == 100:
@@ -664,6 +746,7 @@ class File_Converter(QObject):
             self.totalG0123Lines = self.totalG00lines + self.totalG01lines + self.totalG02lines + self.totalG03lines
             fractionLinesWithAM = float(self.numberLinesWithRotaryMoves / self.totalG0123Lines) if self.totalG0123Lines != 0 else 0.0
             self.publish(" ")
+            self.publish(f"Total lines in input file - {self.linesProcessed}")
             self.publish(f"Number of G00 lines - {self.totalG00lines}")
             self.publish(f"Number of G01 lines - {self.totalG01lines}")
             self.publish(f"Number of G02 lines - {self.totalG02lines}")
@@ -696,5 +779,144 @@ class File_Converter(QObject):
         sys.stderr.write(error + "\n")
         sys.stderr.flush()
         
+
+class Chunk_Converter(File_Converter):
+    # converts one chunk of a parallel conversion, messages are kept as events for the parent to merge
+    def __init__(self, offset, units, mode):
+        QObject.__init__(self)
+        self.z0_offset = float(offset)
+        self.distUnits = units
+        self.wrap_all = True if mode == '1' else False
+        self.currentPlaneSelected = 17
+        self.events = []
+        self.clear_all_data()
+
+    def publish(self, message):
+        self.events.append((PUBLISH_EVENT, message))
+
+    def notice(self, code):
+        if code not in self.notices:
+            self.notices[code] = 0
+            self.events.append((NOTICE_EVENT, code, self.linesProcessed + 1))
+        self.notices[code] += 1
+
+    def warn(self, message):
+        self.warnings += 1
+        if self.warnings <= MAX_WARNINGS:
+            self.events.append((WARN_EVENT, message))
+
+    def get_result(self, text):
+        result = {'text': text,
+                  'state': self.get_state(),
+                  'lines': self.linesProcessed,
+                  'events': self.events,
+                  'notices': self.notices,
+                  'warnings': self.warnings,
+                  'rotaryMinMaxFound': self.rotaryMinMaxFound,
+                  'rotaryMin': self.rotaryMin,
+                  'rotaryMax': self.rotaryMax}
+        for name in CHUNK_TOTALS + CHUNK_FLAGS:
+            result[name] = getattr(self, name)
+        return result
+
+def convert_chunk(offset, units, mode, state, first_line, lines):
+    converter = Chunk_Converter(offset, units, mode)
+    converter.set_state(state)
+    converter.linesProcessed = first_line
+    return converter.get_result(converter.convert_lines(lines))
+
+## benchmark
+# z0 offset used for the generated program
+BENCHMARK_OFFSET = '20'
+
+class Benchmark_Converter(File_Converter):
+    # converts a file without the gui, messages are kept in a list
+    def start_process(self):
+        self.messages = []
+        self.convert_file()
+
+    def publish(self, message):
+        self.messages.append(message)
+
+    def flush(self):
+        pass
+
+# a wrapped program with rapids, G1 moves and implicit moves, as written by 4th axis CAM
+def make_program(path, lines, seed=1):
+    import random
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write("%\n(rapid_subprog benchmark)\nG21 G90 G94 G17\nG0 Z10.000 A0.000\n")
+        x = a = 0.0
+        z = 5.0
+        for i in range(max(0, lines - 7)):
+            x = round(x + rnd.uniform(-1, 1), 3)
+            z = round(min(10, max(0, z + rnd.uniform(-0.2, 0.2))), 3)
+            a = round(a + rnd.uniform(-3, 3), 3)
+            kind = i % 10
+            if kind == 0:
+                f.write(f"G0 X{x:.3f} Z{z:.3f}\n")
+            elif kind < 4:
+                f.write(f"G1 X{x:.3f} Z{z:.3f} A{a:.3f} F{rnd.choice((300, 600, 1200))}\n")
+            else:
+                f.write(f"X{x:.3f} Z{z:.3f} A{a:.3f}\n")
+        f.write("G0 Z10.000\nM30\n%\n")
+
+# python3 rapid_subprog.py benchmark [number of lines] [number of processes ...]
+def benchmark(lines, jobs):
+    import tempfile
+    import shutil
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'benchmark.ngc')
+        make_program(path, lines)
+        with open(path) as f:
+            program = f.readlines()
+        print(f"{len(program)} lines  {os.path.getsize(path)} bytes")
+        # cost of processInputLine per line in both conversion modes
+        for mode, name in (('1', 'G93 for entire file'), ('0', 'wrap each rotary move')):
+            converter = Chunk_Converter(BENCHMARK_OFFSET, 'mm', mode)
+            start = time.perf_counter()
+            converter.convert_lines(program)
+            elapsed = time.perf_counter() - start
+            print(f"{name:24s} {elapsed * 1e6 / len(program):6.2f} us/line")
+        # the scan that finds the state each block starts from
+        state = Chunk_Converter(BENCHMARK_OFFSET, 'mm', '1').get_state()
+        blocks = 0
+        start = time.perf_counter()
+        with open(path) as f:
+            while True:
+                block = f.readlines(CHUNK_SIZE)
+                if not block: break
+                state = scan_modal_state(block, state)
+                blocks += 1
+        print(f"modal state scan         {time.perf_counter() - start:6.3f} s  {blocks} blocks of {CHUNK_SIZE // 1024}KB")
+        # whole file conversion, serial against parallel
+        if os.path.getsize(path) < PARALLEL_MIN_BYTES:
+            print(f"files under {PARALLEL_MIN_BYTES} bytes are always converted serially")
+        serial = None
+        for count in [1] + jobs:
+            outfile = os.path.join(folder, f'output{count}.ngc')
+            start = time.perf_counter()
+            converter = Benchmark_Converter(path, outfile, BENCHMARK_OFFSET, 'mm', '1', str(count))
+            elapsed = time.perf_counter() - start
+            with open(outfile, 'rb') as f:
+                output = f.read()
+            if serial is None:
+                serial = output
+                print(f"serial                   {elapsed:6.3f} s")
+            else:
+                same = 'identical' if output == serial else 'DIFFERENT'
+                print(f"{count:2d} processes             {elapsed:6.3f} s  rescans {converter.rescans}/{converter.chunks}  output {same}")
+            os.remove(outfile)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
 if __name__ == "__main__":
-    app = File_Converter(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        lines = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+        jobs = [int(n) for n in sys.argv[3:]] or sorted({2, os.cpu_count() or 1} - {1})
+        benchmark(lines, jobs)
+        sys.exit(0)
+    jobs = sys.argv[6] if len(sys.argv) > 6 else '0'
+    app = File_Converter(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], jobs)
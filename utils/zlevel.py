@@ -20,6 +20,7 @@ import hal
 import struct
 
 from lib.event_filter import EventFilter
+from lib.compensate import Interpolator
 from utils.utils_mixin import Common
 
 from PyQt5 import uic
@@ -30,6 +31,7 @@ from PyQt5.QtCore import QRectF
 # IMPORTANT - do not import this before importing PyQt5 stuff
 import pyqtgraph as pg
 import numpy as np
+from scipy.interpolate import griddata
 
 from qtvcp.core import Status, Action, Info, Path, Qhal
 
@@ -43,11 +45,21 @@ HELP = os.path.join(PATH.CONFIGPATH, "help_files")
 WARNING = 1
 ERROR = 2
 SHM_PATH = '/dev/shm/linuxcnc_surface_map'
-MAX_NX = 200
-MAX_NY = 200
-HEADER_SIZE = 44
-GRID_SIZE = MAX_NX * MAX_NY * 8
-TOTAL_SIZE = HEADER_SIZE + GRID_SIZE
+MAX_NX = 500
+MAX_NY = 500
+# shared memory layout - must match lib/compensate.py
+MAGIC = b'ZMAP'
+LAYOUT_VERSION = 2
+VERSION = struct.Struct("=I")
+HEADER = struct.Struct("=4sHHIII4d")
+HEADER_SIZE = VERSION.size + HEADER.size
+MAP_DTYPE = np.float64
+INTERP_BILINEAR = 0
+INTERP_BICUBIC = 1
+# probe coordinates are rounded to this many decimals when checking for a complete lattice
+LATTICE_DECIMALS = 3
+# each refined cell is probed at its edge midpoints and centre, in half cell steps
+REFINE_OFFSETS = ((1, 0), (0, 1), (1, 1), (2, 1), (1, 2))
 
 
 class SurfaceMap(QWidget):
@@ -120,10 +132,15 @@ class ZLevel(QWidget, Common):
 
         # Initial values
         self.probe_results = None
+        self.grid = None
+        self.map_points = None
+        self.map_program = None
+        # last refine program saved, it only adds points to the loaded map
+        self.refine_program = None
         self.help_text = []
 
         self.int_inputs = ['size_x', 'size_y', 'steps_x', 'steps_y', 'probe_tool', 'probe_vel']
-        self.float_inputs = ['z_safe', 'max_probe', 'start_height']
+        self.float_inputs = ['z_safe', 'max_probe', 'start_height', 'refine_tol']
         # quickest way to initialize variables
         self.set_unit_labels()
         self.validate()
@@ -139,6 +156,7 @@ class ZLevel(QWidget, Common):
         self.lineEdit_z_safe.setValidator(QDoubleValidator(0, 999, 3))
         self.lineEdit_max_probe.setValidator(QDoubleValidator(0, 999, 3))
         self.lineEdit_start_height.setValidator(QDoubleValidator(0, 999, 3))
+        self.lineEdit_refine_tol.setValidator(QDoubleValidator(0, 999, 3))
         
         # setup event filter to catch focus_in events
         self.event_filter = EventFilter(self)
@@ -166,6 +184,7 @@ class ZLevel(QWidget, Common):
         self.rbtn_offset.clicked.connect(lambda state: self.steps_changed(state))
         self.btn_save_gcode.pressed.connect(self.save_gcode)
         self.btn_help.pressed.connect(self.show_help)
+        self.chk_bicubic.stateChanged.connect(self.interp_changed)
         self.surfaceMap = SurfaceMap(self.layout_surfacemap)
 
     def _hal_init(self):
@@ -229,8 +248,16 @@ class ZLevel(QWidget, Common):
                 obj.setText(str(int(rtn)))
 
     def program_loaded(self, fname):
+        # the loaded map stays in place, the refine results are merged when its parent program is loaded again
+        if fname == self.refine_program or os.path.splitext(os.path.basename(fname))[0].endswith('_refine'):
+            self.lineEdit_probe_program.setText(fname)
+            if self.grid is not None:
+                parent = os.path.basename(self.map_program)
+                self.parent.add_status(f"Reload {parent} after running the refine program to merge its points")
+            return
         self.surfaceMap.clear_plot()
         self.probe_results = None
+        self.grid = None
         path = os.path.dirname(fname)
         base = os.path.basename(fname)
         if base.startswith('probe_'):
@@ -243,12 +270,28 @@ class ZLevel(QWidget, Common):
             self.probe_results = probe_results
             # create probe points file and plot maps
             points = self.load_probe_file(probe_results)
+            if points is None: return
+            shape = None
+            refine = self.get_refine_file(probe_results)
+            if os.path.isfile(refine):
+                extra = self.load_probe_file(refine)
+                if extra is not None:
+                    # resample at the refined point spacing
+                    nx = len(np.unique(np.round(points[:,0], LATTICE_DECIMALS)))
+                    ny = len(np.unique(np.round(points[:,1], LATTICE_DECIMALS)))
+                    shape = (min(2 * nx - 1, MAX_NX), min(2 * ny - 1, MAX_NY))
+                    points = np.vstack((points, extra))
+                    self.parent.add_status(f"Added {len(extra)} refined probe points from {refine}")
             plane = self.fit_plane(points)
             comp_map = self.generate_map(points, plane)
-            grid = self.build_grid(comp_map)
-            if points is not None:
+            grid = self.build_grid(comp_map, shape)
+            if grid is not None:
+                self.grid = grid
+                self.map_points = comp_map
+                self.map_program = fname
                 self.write_shared_memory(grid)
-                data = self.get_plot_data(comp_map)
+                self.report_residuals(probe_results, comp_map, grid)
+                data = self.get_plot_data(grid)
                 self.surfaceMap.plot_surface(data)
                 if self.chk_add_contours.isChecked():
                     self.surfaceMap.add_contours(data)
@@ -258,6 +301,9 @@ class ZLevel(QWidget, Common):
 ## Calls from widgets
     def save_gcode(self):
         if not self.validate(): return
+        if self.chk_refine.isChecked():
+            self.save_refine_gcode()
+            return
         if not self.calculate_steps(): return
         pre = self.lineEdit_probe_program.text()
         caption = 'Save Probe Program'
@@ -282,6 +328,38 @@ class ZLevel(QWidget, Common):
         else:
             self.parent.add_status('Probe program save cancelled')
 
+    def save_refine_gcode(self):
+        if self.grid is None or self.probe_results is None:
+            self.parent.add_status("A surface map must be loaded before it can be refined", WARNING)
+            return
+        points = self.refine_points(self.grid, self.refine_tol)
+        if points is None:
+            self.parent.add_status(f"No area of the loaded map exceeds the refine tolerance of {self.refine_tol}")
+            return
+        pre = os.path.basename(self.probe_results).replace('.txt', '_refine.ngc')
+        caption = 'Save Refine Probe Program'
+        _dir = os.path.dirname(self.probe_results)
+        _dir = f'{_dir}/{pre}'
+        _filter = "ngc Files (*.ngc)"
+        fname, _ = self.save_program_file(self, caption, _dir, _filter)
+        if fname:
+            base, ext = os.path.splitext(fname)
+            saveFile = base + '.ngc'
+            # results must sit next to the coarse results so they are merged on the next load
+            probe_name = self.get_refine_file(self.probe_results)
+            self.calculate_refine_gcode(saveFile, probe_name, points)
+            self.refine_program = saveFile
+            ACTION.OPEN_PROGRAM(saveFile)
+            self.parent.add_status(f'Saved {len(points)} point refine program to {saveFile}')
+        else:
+            self.parent.add_status('Probe program save cancelled')
+
+    def interp_changed(self, state):
+        # republish the current map with the new interpolation mode
+        if self.grid is not None:
+            self.write_shared_memory(self.grid)
+            self.report_residuals(self.probe_results, self.map_points, self.grid)
+
     def steps_changed(self, state):
         if state and self.sender() == self.rbtn_offset:
             self.lineEdit_steps_x.setValidator(QDoubleValidator(0, 999, 3))
@@ -320,10 +398,12 @@ class ZLevel(QWidget, Common):
         self.parent.show_help_page(fname)
 
 ## Helper functions
-    def create_or_open_shm(self):
+    def create_or_open_shm(self, size=HEADER_SIZE):
         fd = os.open(SHM_PATH, os.O_CREAT | os.O_RDWR)
-        os.ftruncate(fd, TOTAL_SIZE)
-        shm = mmap.mmap(fd, TOTAL_SIZE, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
+        # the segment never shrinks, so a reader can not map past its end
+        size = max(size, os.fstat(fd).st_size)
+        os.ftruncate(fd, size)
+        shm = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_WRITE | mmap.PROT_READ)
         os.close(fd)
         return shm
 
@@ -331,71 +411,178 @@ class ZLevel(QWidget, Common):
         X = points[:,0]
         Y = points[:,1]
         Z = points[:,2]
-        A = np.c_[X, Y, np.ones(len(X))]
+        A = np.column_stack((X, Y, np.ones_like(X)))
         C, _, _, _ = np.linalg.lstsq(A, Z, rcond=None)
         a, b, c = C
         return a, b, c
     
     def generate_map(self, points, plane):
         a, b, c = plane
-        result = []
-        for x, y, z in points:
-            plane_z = a*x + b*y + c
-            deviation = z - plane_z
-            result.append((x, y, deviation))
-        return result
+        x = points[:,0]
+        y = points[:,1]
+        deviation = points[:,2] - (a*x + b*y + c)
+        return np.column_stack((x, y, deviation))
 
     def load_probe_file(self, fname):
         try:
-            data = np.loadtxt(fname, dtype = float, delimiter = " ", usecols = (0, 1, 2))
-        except Error as e:
-            self.parent.add_status(f'Unable to read surface map data', ERROR)
+            data = np.loadtxt(fname, dtype = float, delimiter = " ", usecols = (0, 1, 2), ndmin = 2)
+        except (OSError, ValueError) as e:
+            self.parent.add_status(f'Unable to read surface map data - {e}', ERROR)
             return None
         return data
 
-    def get_plot_data(self, map_data):
-        pts = []
-        for parts in map_data:
-            x = float(parts[0])
-            y = float(parts[1])
-            z = float(parts[2])
-            pts.append((x, y, z))
-        data = np.array(pts)
-        x = np.round(data[:, 0], 1)
-        y = np.round(data[:, 1], 1)
-        z = np.round(data[:, 2], 3)
-        x_unique = np.unique(x)
-        y_unique = np.unique(y)
-        X,Y = np.meshgrid(x_unique, y_unique)
-        Z = z.reshape(len(y_unique), len(x_unique))
+    def get_plot_data(self, grid):
+        xs = np.linspace(grid["xmin"], grid["xmax"], grid["nx"])
+        ys = np.linspace(grid["ymin"], grid["ymax"], grid["ny"])
+        X,Y = np.meshgrid(xs, ys)
+        Z = np.round(grid["zgrid"].T, 3)
         return (X, Y, Z)
 
-    def build_grid(self, points):
-        pts = np.array(points)
-        xs = np.unique(pts[:,0])
-        ys = np.unique(pts[:,1])
-        nx = len(xs)
-        ny = len(ys)
-        zgrid = np.zeros((nx, ny))
-        x_index = {x:i for i,x in enumerate(xs)}
-        y_index = {y:i for i,y in enumerate(ys)}
-        for x,y,z in pts:
-            ix = x_index[x]
-            iy = y_index[y]
-            zgrid[ix,iy] = z
-        xmin = xs.min()
-        xmax = xs.max()
-        ymin = ys.min()
-        ymax = ys.max()
+    def build_grid(self, points, shape=None):
+        pts = np.asarray(points, dtype=float)
+        if len(pts) < 3:
+            self.parent.add_status("At least 3 probe points are required for a surface map", ERROR)
+            return None
+        xy = np.round(pts[:,:2], LATTICE_DECIMALS)
+        xs, ix = np.unique(xy[:,0], return_inverse=True)
+        ys, iy = np.unique(xy[:,1], return_inverse=True)
+        cells = np.bincount(ix * len(ys) + iy, minlength=len(xs) * len(ys))
+        if len(cells) == len(pts) and np.all(cells == 1):
+            # probe points form a complete rectangular lattice
+            zgrid = np.zeros((len(xs), len(ys)))
+            zgrid[ix,iy] = pts[:,2]
+        else:
+            try:
+                xs, ys, zgrid = self.resample_grid(pts, shape)
+            except Exception as e:
+                self.parent.add_status(f"Unable to build surface map from probe points - {e}", ERROR)
+                return None
+            self.parent.add_status(f"Resampled {len(pts)} scattered probe points onto a {len(xs)} x {len(ys)} grid")
         return {
-            "nx": nx,
-            "ny": ny,
-            "xmin": xmin,
-            "xmax": xmax,
-            "ymin": ymin,
-            "ymax": ymax,
+            "nx": len(xs),
+            "ny": len(ys),
+            "xmin": xs.min(),
+            "xmax": xs.max(),
+            "ymin": ys.min(),
+            "ymax": ys.max(),
             "zgrid": zgrid}
 
+    def resample_grid(self, pts, shape=None):
+        xmin, ymin = pts[:,:2].min(axis=0)
+        xmax, ymax = pts[:,:2].max(axis=0)
+        span_x, span_y = np.ptp(np.round(pts[:,:2], LATTICE_DECIMALS), axis=0)
+        if span_x == 0 and span_y == 0:
+            raise ValueError("all probe points are at the same XY position")
+        if span_x == 0 or span_y == 0:
+            return self.resample_line(pts, shape, span_x == 0)
+        if shape is not None:
+            nx, ny = shape
+        else:
+            # about one grid node per probe point, with the grid aspect ratio matching the probed area
+            aspect = (xmax - xmin) / (ymax - ymin)
+            nx = int(np.clip(round(math.sqrt(len(pts) * aspect)), 2, MAX_NX))
+            ny = int(np.clip(round(len(pts) / nx), 2, MAX_NY))
+        xs = np.linspace(xmin, xmax, nx)
+        ys = np.linspace(ymin, ymax, ny)
+        gx, gy = np.meshgrid(xs, ys, indexing='ij')
+        # piecewise linear interpolation over the Delaunay triangulation of the probe points
+        zgrid = griddata(pts[:,:2], pts[:,2], (gx, gy), method='linear')
+        # nodes outside the convex hull take the value of the nearest probe point
+        outside = np.isnan(zgrid)
+        if outside.any():
+            zgrid[outside] = griddata(pts[:,:2], pts[:,2], (gx[outside], gy[outside]), method='nearest')
+        return xs, ys, zgrid
+
+    # points along one line give a single row or column map, the same as a one row lattice
+    def resample_line(self, pts, shape, along_y):
+        axis = 1 if along_y else 0
+        # repeated probes of one position are averaged
+        pos, inverse = np.unique(np.round(pts[:,axis], LATTICE_DECIMALS), return_inverse=True)
+        z = np.bincount(inverse, weights=pts[:,2]) / np.bincount(inverse)
+        count = shape[axis] if shape is not None else len(pos)
+        count = int(np.clip(count, 2, MAX_NY if along_y else MAX_NX))
+        line = np.linspace(pos[0], pos[-1], count)
+        zline = np.interp(line, pos, z)
+        fixed = np.array([pts[0, 1 - axis]])
+        if along_y:
+            return fixed, line, zline.reshape((1, count))
+        return line, fixed, zline.reshape((count, 1))
+
+    def refine_points(self, grid, tolerance):
+        nx = grid["nx"]
+        ny = grid["ny"]
+        z = grid["zgrid"]
+        xs = np.linspace(grid["xmin"], grid["xmax"], nx)
+        ys = np.linspace(grid["ymin"], grid["ymax"], ny)
+        # midpoint error of linear interpolation estimated from the second differences
+        error = np.zeros_like(z)
+        error[1:-1,:] = np.abs(z[2:,:] - 2 * z[1:-1,:] + z[:-2,:]) / 8
+        error[:,1:-1] = np.maximum(error[:,1:-1], np.abs(z[:,2:] - 2 * z[:,1:-1] + z[:,:-2]) / 8)
+        node = error > tolerance
+        # a single row or column map is only refined along its other axis
+        if nx < 2 and ny < 2: return None
+        cells = node
+        if nx > 1: cells = cells[:-1,:] | cells[1:,:]
+        if ny > 1: cells = cells[:,:-1] | cells[:,1:]
+        ix, iy = np.nonzero(cells)
+        if len(ix) == 0: return None
+        hx = (xs[1] - xs[0]) / 2 if nx > 1 else 0
+        hy = (ys[1] - ys[0]) / 2 if ny > 1 else 0
+        pts = np.concatenate([np.column_stack((xs[ix] + ox * hx, ys[iy] + oy * hy))
+                              for ox, oy in REFINE_OFFSETS])
+        pts = np.unique(np.round(pts, LATTICE_DECIMALS), axis=0)
+        return self.serpentine_order(pts)
+
+    def serpentine_order(self, pts):
+        # rows of constant Y, alternate rows run in the opposite X direction
+        rows, row = np.unique(pts[:,1], return_inverse=True)
+        direction = np.where(row % 2, -1.0, 1.0)
+        order = np.lexsort((pts[:,0] * direction, row))
+        return pts[order]
+
+    def get_refine_file(self, fname):
+        base, ext = os.path.splitext(fname)
+        return f"{base}_refine{ext}"
+
+    def report_residuals(self, fname, points, grid):
+        # compare each probe point with the grid value the compensation module will use
+        pts = np.asarray(points, dtype=float)
+        residuals = pts[:,2] - self.map_values(grid, pts[:,0], pts[:,1], self.interp_mode())
+        base, ext = os.path.splitext(fname)
+        report = f"{base}_residuals{ext}"
+        try:
+            np.savetxt(report, np.column_stack((pts, residuals)), fmt='%.4f',
+                       header='X Y deviation residual')
+        except OSError as e:
+            self.parent.add_status(f"Unable to write residual report - {e}", WARNING)
+        rms = math.sqrt(np.mean(residuals ** 2))
+        worst = np.argmax(np.abs(residuals))
+        self.parent.add_status(f"Surface map residuals: RMS {rms:.4f}, max {residuals[worst]:.4f} "
+                               f"at X{pts[worst,0]:.3f} Y{pts[worst,1]:.3f}")
+        return residuals
+
+    # the map at x, y, interpolated by the compensation module's own engine
+    # points on the far edges of the map are evaluated at the end of the last cell
+    def map_values(self, grid, x, y, mode):
+        nx = grid["nx"]
+        ny = grid["ny"]
+        zgrid = np.asarray(grid["zgrid"], dtype=MAP_DTYPE)
+        if nx < 2 or ny < 2:
+            # compensation does not use a single row or column map, the fit is shown along its line
+            if nx > 1: return np.interp(x, np.linspace(grid["xmin"], grid["xmax"], nx), zgrid[:,0])
+            if ny > 1: return np.interp(y, np.linspace(grid["ymin"], grid["ymax"], ny), zgrid[0])
+            return np.full(len(x), zgrid[0,0])
+        engine = Interpolator()
+        engine.load(nx, ny, grid["xmin"], grid["xmax"], grid["ymin"], grid["ymax"], zgrid, mode)
+        fx = np.clip((x - engine.xmin) * engine.inv_x, 0, nx - 1)
+        fy = np.clip((y - engine.ymin) * engine.inv_y, 0, ny - 1)
+        xi = np.minimum(fx.astype(np.intp), nx - 2)
+        yi = np.minimum(fy.astype(np.intp), ny - 2)
+        return engine.evaluate(xi, yi, fx - xi, fy - yi)
+
+    def interp_mode(self):
+        return INTERP_BICUBIC if self.chk_bicubic.isChecked() else INTERP_BILINEAR
+
     def write_shared_memory(self, grid):
         nx = grid["nx"]
         ny = grid["ny"]
@@ -403,21 +590,20 @@ class ZLevel(QWidget, Common):
         xmax = grid["xmax"]
         ymin = grid["ymin"]
         ymax = grid["ymax"]
-        zgrid = grid["zgrid"]
-
-        version = struct.unpack_from("I", self.shm, 0)[0]
+        zgrid = np.ascontiguousarray(grid["zgrid"], dtype=MAP_DTYPE)
+        mode = self.interp_mode()
+
+        size = HEADER_SIZE + zgrid.nbytes
+        if len(self.shm) < size:
+            self.shm.close()
+            self.shm = self.create_or_open_shm(size)
+        version = VERSION.unpack_from(self.shm, 0)[0]
         version = (version + 1) | 1
-        struct.pack_into("I", self.shm, 0, version)
-        struct.pack_into("I", self.shm, 4, nx)
-        struct.pack_into("I", self.shm, 8, ny)
-        struct.pack_into("d", self.shm, 12, xmin)
-        struct.pack_into("d", self.shm, 20, xmax)
-        struct.pack_into("d", self.shm, 28, ymin)
-        struct.pack_into("d", self.shm, 36, ymax)
-        z_bytes = np.zeros(MAX_NX*MAX_NY, dtype=np.float64)
-        z_bytes[:nx*ny] = zgrid.ravel()
-        self.shm[HEADER_SIZE:HEADER_SIZE + (MAX_NX * MAX_NY * 8)] = z_bytes.tobytes()
-        struct.pack_into("I", self.shm, 0, version + 1)
+        VERSION.pack_into(self.shm, 0, version)
+        HEADER.pack_into(self.shm, VERSION.size, MAGIC, LAYOUT_VERSION, zgrid.itemsize,
+                         nx, ny, mode, xmin, xmax, ymin, ymax)
+        self.shm[HEADER_SIZE:size] = zgrid.tobytes()
+        VERSION.pack_into(self.shm, 0, version + 1)
 
     def calculate_gcode(self, fname, pname):
         # get start point
@@ -437,31 +623,64 @@ class ZLevel(QWidget, Common):
         self.file.write(f"(Steps: X {self.steps_x} by Y {self.steps_y})\n")
         self.file.write(f"(Safe Z travel height {self.z_safe})\n")
         self.file.write(f"(XY Zero point is {self.reference[zref]})\n")
-        self.next_line("G17 G40 G49 G64 G90 P0.03")
-        self.next_line("G92.1")
-        self.next_line(f"M6 T{self.probe_tool}")
-        self.next_line(f"G0 Z{self.z_safe}")
-        # main section
-        self.next_line(f"(PROBEOPEN {pname})")
+        self.write_preamble(pname)
+        # main section - serpentine order, odd rows run from right to left
         self.next_line("#100 = 0")
         self.next_line(f"O100 while [#100 LE {self.steps_y - 1}]")
         self.next_line(f"  G0 Y[{y_start} + {self.y_inc:.3f} * #100]")
         self.next_line("  #200 = 0")
         self.next_line(f"  O200 while [#200 LE {self.steps_x - 1}]")
-        self.next_line(f"    G0 X[{x_start} + {self.x_inc:.3f} * #200]")
+        self.next_line("    #201 = #200")
+        self.next_line("    O210 if [[#100 MOD 2] EQ 1]")
+        self.next_line(f"      #201 = [{self.steps_x - 1} - #200]")
+        self.next_line("    O210 endif")
+        self.next_line(f"    G0 X[{x_start} + {self.x_inc:.3f} * #201]")
         self.next_line(f"    G0 Z{self.start_height}")
         self.next_line(f"    G38.2 Z-{self.max_probe} F{self.probe_vel}")
-        self.next_line(f"    G0 Z{self.z_safe}")
+        self.next_line(f"    G0 Z{self.get_retract_height()}")
         self.next_line("    #200 = [#200 + 1]")
         self.next_line("  O200 endwhile")
         self.next_line("  #100 = [#100 + 1]")
         self.next_line("O100 endwhile")
+        self.write_postamble()
+
+    def calculate_refine_gcode(self, fname, pname, points):
+        self.line_num = 5
+        self.file = open(fname, 'w')
+        self.file.write("%\n")
+        self.file.write(f"({self.lineEdit_comment.text()})\n")
+        self.file.write(f"(Refine {os.path.basename(self.probe_results)} with {len(points)} points)\n")
+        self.file.write(f"(Refine tolerance {self.refine_tol})\n")
+        self.file.write(f"(Safe Z travel height {self.z_safe})\n")
+        self.write_preamble(pname)
+        retract = self.get_retract_height()
+        for x, y in points:
+            self.next_line(f"G0 X{x:.3f} Y{y:.3f}")
+            self.next_line(f"G0 Z{self.start_height}")
+            self.next_line(f"G38.2 Z-{self.max_probe} F{self.probe_vel}")
+            self.next_line(f"G0 Z{retract}")
+        self.write_postamble()
+
+    def write_preamble(self, pname):
+        self.next_line("G17 G40 G49 G64 G90 P0.03")
+        self.next_line("G92.1")
+        self.next_line(f"M6 T{self.probe_tool}")
+        self.next_line(f"G0 Z{self.z_safe}")
+        self.next_line(f"(PROBEOPEN {pname})")
+
+    def write_postamble(self):
+        self.next_line(f"G0 Z{self.z_safe}")
         self.next_line("(PROBECLOSE)")
-        # closing section
         self.next_line("M2")
         self.file.write("%\n")
         self.file.close()
 
+    def get_retract_height(self):
+        # adjacent points are only separated by one step, so a low retract is sufficient
+        if self.chk_low_retract.isChecked():
+            return self.start_height
+        return self.z_safe
+
     def validate(self):
         if not self.check_int_blanks(self.int_inputs): return False
         if not self.check_float_blanks(self.float_inputs): return False
@@ -500,6 +719,7 @@ class ZLevel(QWidget, Common):
         self.lbl_z_safe_unit.setText(unit)
         self.lbl_start_height_unit.setText(unit)
         self.lbl_max_probe_unit.setText(unit)
+        self.lbl_refine_tol_unit.setText(unit)
 
 ## Calls from handler
     def get_map(self, state):
@@ -532,8 +752,75 @@ class ZLevel(QWidget, Common):
     def __setitem__(self, item, value):
         return setattr(self, item, value)
 
+## benchmark
+# the map pipeline of ZLevel without the widget
+class MapPipeline:
+    load_probe_file = ZLevel.load_probe_file
+    fit_plane = ZLevel.fit_plane
+    generate_map = ZLevel.generate_map
+    build_grid = ZLevel.build_grid
+    resample_grid = ZLevel.resample_grid
+    resample_line = ZLevel.resample_line
+    get_plot_data = ZLevel.get_plot_data
+
+    def __init__(self):
+        self.parent = self
+
+    def add_status(self, msg, level=None):
+        pass
+
+# a probe results file as written by PROBEOPEN, a tilted and curved surface with some noise
+def make_probe_file(fname, nx, ny, seed=1):
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.linspace(0, 600, nx), np.linspace(0, 400, ny), indexing='ij')
+    z = 0.001 * x - 0.0005 * y + 0.05 * np.sin(x / 100) * np.cos(y / 80) + rng.normal(0, 0.002, x.shape)
+    data = np.zeros((nx * ny, 9))
+    data[:,0] = x.ravel()
+    data[:,1] = y.ravel()
+    data[:,2] = z.ravel()
+    # the probe program runs a serpentine path, the map must not depend on the point order
+    np.savetxt(fname, rng.permutation(data), fmt='%.6f', delimiter=' ')
+
+# time load_probe_file, fit_plane, generate_map, build_grid and get_plot_data
+# python3 zlevel.py benchmark [number of points ...]
+def benchmark(sizes, repeat=5):
+    import time
+    import tempfile
+    import shutil
+    maps = MapPipeline()
+    folder = tempfile.mkdtemp()
+    try:
+        print(f"{'points':>7} {'grid':>9} {'load':>8} {'plane':>8} {'map':>8} {'grid':>8} {'plot':>8} {'total':>8}  ms")
+        for size in sizes:
+            nx = int(round(math.sqrt(size * 1.5)))
+            ny = max(2, int(round(size / nx)))
+            fname = os.path.join(folder, f'probe_{size}.txt')
+            make_probe_file(fname, nx, ny)
+            times = np.zeros(5)
+            for i in range(repeat):
+                start = time.perf_counter()
+                points = maps.load_probe_file(fname)
+                t1 = time.perf_counter()
+                plane = maps.fit_plane(points)
+                t2 = time.perf_counter()
+                comp_map = maps.generate_map(points, plane)
+                t3 = time.perf_counter()
+                grid = maps.build_grid(comp_map)
+                t4 = time.perf_counter()
+                maps.get_plot_data(grid)
+                t5 = time.perf_counter()
+                times += np.diff([start, t1, t2, t3, t4, t5])
+            times *= 1000 / repeat
+            shown = ' '.join(f"{t:8.2f}" for t in times)
+            print(f"{nx * ny:7d} {f'{nx}x{ny}':>9} {shown} {times.sum():8.2f}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
 # for standalone testing
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark([int(n) for n in sys.argv[2:]] or [10000, 20000, 40000])
+        sys.exit(0)
     app = QtWidgets.QApplication(sys.argv)
     w = ZLevel()
     w.show()